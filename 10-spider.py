@@ -0,0 +1,94 @@
+import asyncio
+import click
+import json
+import signal
+import time
+from async_engine import HttpxTransport, fetch_file
+from event_loop import IO_WORKERS, IOExecutor
+from hasher import expected_digest
+from logger import logger
+from metrics import Metrics, start_exporters
+from preallocate import DiskSpace
+from probe_cache import CACHE_TTL, ProbeCache
+from retry import MAX_ATTEMPTS
+from scheduler import MAX_CONNECTIONS, MAX_CONNECTIONS_PER_HOST, AsyncConnectionBudget
+from throttle import BandwidthLimiter, load_rate_limits, parse_rate, reload_rate_limits
+try:  # HTTP/2 引擎需要额外安装: pip install 'httpx[http2]'
+    import httpx
+except ImportError:
+    httpx = None
+
+
+MAX_H2_CONNECTIONS = 4  # 连接池中最多的连接数，HTTP/2 下同一个 host 的所有范围都是同一个连接上的不同的流，只有流的数目超过服务器的上限时才会再建立连接
+
+
+async def _fetchOneFile(client, url, *args, **kwargs):
+    '''用 httpx.AsyncClient 下载单个大文件，其它参数见 async_engine.fetch_file()，下载成功 (或者之前已经下载完成) 时返回正式文件名，失败时返回 None
+    临时文件和配置文件 (.swp、.swp.cfg) 与 8-spider.py、9-spider.py 完全相同，可以互相续传
+    '''
+    return await fetch_file(HttpxTransport(client), url, *args, **kwargs)
+
+
+async def crawl(config='config.json', rate_limit=None):
+    '''rate_limit: 命令行指定的全局限速 (字节/秒，可以带 K、M、G 后缀)，优先于 config.json 中的 rate_limit'''
+    tasks = []  # 保存所有任务的列表
+    with open(config, 'r') as fp:  # 读取包含多个大文件相关信息(url、dest_filename、multipart_chunksize)的配置文件 config.json
+        cfg = json.load(fp)
+    # 运行指标 (可选 metrics_port: Prometheus 的 /metrics 端口，metrics_file、metrics_interval: 定期写入 JSON 快照的文件和间隔秒数)
+    metrics = Metrics()
+    # 所有文件共享同一个预算 (可选 max_connections: 同时下载的范围总数，max_connections_per_host: 每个 host 同时下载的范围数)，HTTP/2 下它们限制的是流的数目
+    budget = AsyncConnectionBudget(cfg.get('max_connections', MAX_CONNECTIONS), cfg.get('max_connections_per_host', MAX_CONNECTIONS_PER_HOST), metrics=metrics)
+    # 连接池只需要很少的连接 (可选 http2_connections)，服务器不支持 HTTP/2 时退回 HTTP/1.1，此时每个连接同时只能下载一个范围，所以上限不能小于预算
+    limits = httpx.Limits(max_connections=max(cfg.get('http2_connections', MAX_H2_CONNECTIONS), budget.max_connections), max_keepalive_connections=budget.max_connections)
+    # https:// 通过 ALPN 协商 HTTP/2；http:// 默认使用 HTTP/1.1，可选 h2c 为 true 时直接使用明文 HTTP/2 (prior knowledge)
+    h2c = cfg.get('h2c', False)
+    try:
+        client = httpx.AsyncClient(http1=not h2c, http2=True, limits=limits, timeout=httpx.Timeout(60.0, connect=10.0), headers={'Accept-Encoding': 'identity'})  # 不压缩响应体，Range 的偏移才对应文件的字节
+    except ImportError as e:  # 没有安装 h2
+        logger.error('HTTP/2 support is not installed, run: pip install "httpx[http2]", the reason is that %s', e)
+        return
+
+    # 带宽限制: 所有协程共享全局令牌桶，files 中的各项可以再单独限速，没有单独限速的文件可以用掉剩余的带宽
+    rate, file_rates = load_rate_limits(cfg)
+    limiter = BandwidthLimiter(parse_rate(rate_limit) if rate_limit is not None else rate)
+    # 与 9-spider.py 一样，所有阻塞的文件系统操作都在专用的 I/O 线程池中执行 (可选 io_workers: 线程数)
+    io_executor = IOExecutor(cfg.get('io_workers', IO_WORKERS))
+    # 下载过程中修改了 config.json 中的限速后，发送 SIGHUP 信号 (kill -HUP <pid>) 即可生效，不需要重新下载 (在 I/O 线程中重新读取配置文件)
+    loop = asyncio.get_running_loop()
+    if hasattr(signal, 'SIGHUP'):
+        loop.add_signal_handler(signal.SIGHUP, io_executor.executor.submit, reload_rate_limits, limiter, config, rate_limit)
+
+    # 探测结果缓存 (可选 probe_cache: 缓存文件，例如 .probe_cache.json，默认不使用缓存；probe_cache_ttl: 有效期秒数)，cron 反复执行时缓存有效的文件不再发探测请求
+    cache = None
+    if cfg.get('probe_cache'):
+        cache = ProbeCache(cfg['probe_cache'], cfg.get('probe_cache_ttl', CACHE_TTL))
+
+    exporters = start_exporters(metrics, cfg)
+    async with client:  # 整个应用只创建一个 client，所有文件的所有范围共享它的连接池
+        disk_space = DiskSpace()  # 所有文件共享的磁盘空间预算
+        for f in cfg['files']:
+            task = asyncio.create_task(_fetchOneFile(client, f['url'], f['dest_filename'], f['multipart_chunksize'], writer_mode=cfg.get('writer', 'pwrite'), mmap_flush=cfg.get('mmap_flush', 'close'), disk_space=disk_space, max_attempts=cfg.get('max_attempts', MAX_ATTEMPTS), budget=budget, throttle=limiter.for_file(f['url'], file_rates.get(f['url'])), checksum=expected_digest(f), verify=cfg.get('verify_on_resume', False), cache=cache, mirror_urls=f.get('mirrors'), io_executor=io_executor, metrics=metrics))
+            tasks.append(task)
+        await asyncio.gather(*tasks)
+    if cache is not None:
+        await io_executor.run(cache.save)
+    if hasattr(signal, 'SIGHUP'):
+        loop.remove_signal_handler(signal.SIGHUP)
+    for exporter in exporters:
+        await io_executor.run(exporter.close)  # 会等待导出线程结束
+    io_executor.shutdown()
+
+
+@click.command()
+@click.option('--config', default='config.json', type=click.Path(exists=True), help="Configuration file with the files to download")
+@click.option('--rate_limit', help="Global bandwidth limit in bytes per second, K/M/G suffixes are allowed, e.g. 10M")
+def main(config, rate_limit):
+    if httpx is None:
+        raise click.ClickException('10-spider.py requires httpx with HTTP/2 support, run: pip install "httpx[http2]"')
+    t0 = time.time()
+    asyncio.run(crawl(config, rate_limit))
+    logger.info('Cost %.2f seconds', time.time() - t0)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,37 +4,64 @@ import os
 import time
 from tqdm import tqdm
 from custom_request import custom_request
+from hasher import StreamingHasher
 from logger import logger
+from preallocate import preallocate
 
 
-def _fetchByRange(url, filename, part_number, start, stop):
+READ_BUFFER_SIZE = 64 * 1024  # 流式读取响应体时的缓冲区大小
+
+
+def _fetchByRange(url, filename, hasher, part_number, start, stop):
     '''根据 HTTP headers 中的 Range 只下载一个块 (rb+ 模式)
     url: 远程目标文件的 URL 地址
     filename: 保存到此文件
+    hasher: 边下载边计算哈希值的 StreamingHasher
     part_number: 块编号(从 0 开始)
     start: 块的起始位置
     stop: 块的结束位置
     '''
     headers = {'Range': 'bytes=%d-%d' % (start, stop)}
-    r = custom_request('GET', url, info='Range: bytes={}-{}'.format(start, stop), headers=headers)
+    r = custom_request('GET', url, info='Range: bytes={}-{}'.format(start, stop), headers=headers, stream=True)  # stream=True: 边接收边写入，不把整个分块读入内存
 
     part_length = stop - start + 1
-    if not r or len(r.content) != part_length:  # 请求失败时，r 为 None; 或者，突然网络故障了，连接被服务器强制关闭了，此时客户端读取的响应体的长度不足
+    if not r:  # 请求失败时，r 为 None
         logger.error('Part Number {} [Range: bytes={}-{}] download failed'.format(part_number, start, stop))
         return {
             'failed': True  # 用于告知 _fetchByRange() 的调用方，此 Range 下载失败了
         }
 
-    with open(filename, 'rb+') as fp:  # 注意: 不能用 a 模式哦，那样的话就算用 seek(0, 0) 移动指针到文件开头后，还是会从文件末尾处追加
-        fp.seek(start)  # 移动文件指针
-        logger.debug('File point: {}'.format(fp.tell()))
-        fp.write(r.content)  # 写入已下载的字节
+    size = 0  # 已写入的字节数
+    try:
+        with open(filename, 'rb+') as fp:  # 注意: 不能用 a 模式哦，那样的话就算用 seek(0, 0) 移动指针到文件开头后，还是会从文件末尾处追加
+            fp.seek(start)  # 移动文件指针
+            logger.debug('File point: {}'.format(fp.tell()))
+            for chunk in r.iter_content(chunk_size=READ_BUFFER_SIZE):  # 每次最多只读取 READ_BUFFER_SIZE 个字节，内存占用与 multipart_chunksize 无关
+                fp.write(chunk)  # 写入已下载的字节
+                hasher.feed(start + size, chunk)  # 只有第 0 个分块是按顺序到达的，可以直接在内存中计算
+                size += len(chunk)
+    except Exception as e:
+        logger.error('Part Number {} [Range: bytes={}-{}] download failed, the reason is that {}'.format(part_number, start, stop, e))
+        return {
+            'failed': True
+        }
+    finally:
+        r.close()  # 释放连接，放回连接池
+
+    if size > 0:
+        hasher.done(start, start + size - 1)  # 填上缺口时，从临时文件读回后面已下载的分块继续计算
+
+    if size != part_length:  # 突然网络故障了，连接被服务器强制关闭了，此时客户端读取的响应体的长度不足
+        logger.error('Part Number {} [Range: bytes={}-{}] download failed, received {} bytes'.format(part_number, start, stop, size))
+        return {
+            'failed': True
+        }
 
     logger.debug('Part Number {} [Range: bytes={}-{}] downloaded'.format(part_number, start, stop))
     return {
         'part': {
             'part_number': part_number,
-            'size': len(r.content)
+            'size': size
         },
         'failed': False  # 用于告知 _fetchByRange() 的调用方，此 Range 成功下载
     }
@@ -43,8 +70,10 @@ def _fetchByRange(url, filename, part_number, start, stop):
 @click.command()
 @click.option('--dest_filename', type=click.Path(), help="Name of the local destination file with extension")
 @click.option('--multipart_chunksize', default=8*1024*1024, help="Size of chunk, unit is bytes")
+@click.option('--sha256', help="Expected SHA256 of the file, it is only renamed from .swp when they match")
+@click.option('--md5', help="Expected MD5 of the file, used instead of SHA256")
 @click.argument('url', type=click.Path())
-def crawl(dest_filename, multipart_chunksize, url):
+def crawl(dest_filename, multipart_chunksize, sha256, md5, url):
     t0 = time.time()
 
     # 如果没有指定本地保存时的文件名，则默认使用 URL 中最后一部分作为文件名
@@ -68,6 +97,10 @@ def crawl(dest_filename, multipart_chunksize, url):
             logger.warning('The filename [{}] has already exist, but it does not match the remote file'.format(official_filename))
             return
 
+    # 边下载边计算哈希值，乱序下载的分块等到前面的缺口被填上时才从临时文件 (page cache) 读回，最后一个字节写入时哈希值也就算好了
+    algorithm, expected = ('md5', md5) if md5 else ('sha256', sha256)
+    hasher = StreamingHasher(temp_filename, file_size, algorithm)
+
     # 首先需要判断此文件支不支持 Range 下载，请求第 1 个字节即可
     headers = {'Range': 'bytes=0-0'}
     r = custom_request('HEAD', url, info='Range: bytes=0-0', headers=headers)
@@ -86,6 +119,7 @@ def crawl(dest_filename, multipart_chunksize, url):
             with open(temp_filename, 'wb') as fp:
                 for chunk in r.iter_content(chunk_size=multipart_chunksize):
                     if chunk:
+                        hasher.feed(bar.n, chunk)  # 顺序下载，bar.n 就是此 chunk 的偏移
                         fp.write(chunk)
                         bar.update(len(chunk))
     else:  # 支持 Range 下载时
@@ -94,14 +128,11 @@ def crawl(dest_filename, multipart_chunksize, url):
         parts_count = div if mod == 0 else div + 1  # 计算出多少个分块
         logger.info('Chunk size: {} bytes, total parts: {}'.format(multipart_chunksize, parts_count))
 
-        # 由于 _fetchByRange() 中使用 rb+ 模式，必须先保证文件存在，所以要先创建指定大小的临时文件 (用0填充)
-        f = open(temp_filename, 'wb')
-        f.seek(file_size - 1)
-        f.write(b'\0')
-        f.close()
+        # 由于 _fetchByRange() 中使用 rb+ 模式，必须先保证文件存在，所以要先创建指定大小的临时文件 (用0填充，真正分配磁盘空间)
+        preallocate(temp_filename, file_size)
 
-        # 固定住 url、temp_filename，不用每次都传入相同的参数
-        _fetchByRange_partial = partial(_fetchByRange, url, temp_filename)
+        # 固定住 url、temp_filename、hasher，不用每次都传入相同的参数
+        _fetchByRange_partial = partial(_fetchByRange, url, temp_filename, hasher)
 
         # 倒序下载每一个分块 part，假设分块号 part_number 从 0 开始编号
         failed_parts = 0  # 下载失败的分块数目
@@ -122,7 +153,11 @@ def crawl(dest_filename, multipart_chunksize, url):
 
     if failed_parts > 0:
         logger.error('Failed to download {}, failed parts: {}, successful parts: {}'.format(official_filename, failed_parts, parts_count-failed_parts))
+    elif expected and not hasher.verify(expected):  # 乱序下载的结果与期望的哈希值不一致，保留临时文件以便排查
+        return
     else:
+        if not expected:
+            logger.info('{}: {}'.format(algorithm.upper(), hasher.hexdigest()))
         # 整个文件内容被成功下载后，将临时文件名修改回正式文件名、删除配置文件
         os.rename(temp_filename, official_filename)
         logger.info('{} downloaded'.format(official_filename))
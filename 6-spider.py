@@ -1,30 +1,33 @@
 import click
 from concurrent import futures
 from functools import partial
-import json
 import os
-import threading
 import time
+import zlib
 from tqdm import tqdm
-from custom_request import custom_request
+from custom_request import custom_request, set_pool_size
+from journal import PartJournal, checked_ranges, load_journal, missing_parts
 from logger import logger
+from preallocate import preallocate
 
 
-def _fetchByRange(lock, url, temp_filename, config_filename, part_number, start, stop):
+READ_BUFFER_SIZE = 64 * 1024  # 流式读取响应体时的缓冲区大小
+
+
+def _fetchByRange(url, temp_filename, journal, part_number, start, stop):
     '''根据 HTTP headers 中的 Range 只下载一个块 (rb+ 模式)
-    lock: 互斥锁
     url: 远程目标文件的 URL 地址
     temp_filename: 临时文件
-    config_filename: 配置文件
+    journal: 记录已下载分块的 PartJournal (配置文件)
     part_number: 块编号(从 0 开始)
     start: 块的起始位置
     stop: 块的结束位置
     '''
     headers = {'Range': 'bytes=%d-%d' % (start, stop)}
-    r = custom_request('GET', url, info='Range: bytes={}-{}'.format(start, stop), headers=headers)
+    r = custom_request('GET', url, info='Range: bytes={}-{}'.format(start, stop), headers=headers, stream=True)  # stream=True: 边接收边写入，不把整个分块读入内存
 
     part_length = stop - start + 1
-    if not r or len(r.content) != part_length:  # 请求失败时，r 为 None; 或者，突然网络故障了，连接被服务器强制关闭了，此时客户端读取的响应体的长度不足
+    if not r:  # 请求失败时，r 为 None
         logger.error('Part Number {} [Range: bytes={}-{}] download failed'.format(part_number, start, stop))
         return {
             'failed': True  # 用于告知 _fetchByRange() 的调用方，此 Range 下载失败了
@@ -38,30 +41,39 @@ def _fetchByRange(lock, url, temp_filename, config_filename, part_number, start,
         'Size': part_length
     }
 
-    # 获取锁
-    lock.acquire()
+    # 各分块的字节范围互不重叠，每个线程用自己的文件对象写入即可，不需要加锁，否则所有线程的下载都会被串行化
+    size = 0  # 已写入的字节数
+    crc = 0  # 已写入的字节的 CRC32，记录到配置文件中，续传前可以校验
     try:
         with open(temp_filename, 'rb+') as fp:  # 注意: 不能用 a 模式哦，那样的话就算用 seek(0, 0) 移动指针到文件开头后，还是会从文件末尾处追加
             fp.seek(start)  # 移动文件指针
             logger.debug('File point: {}'.format(fp.tell()))
-            fp.write(r.content)  # 写入已下载的字节
-        # 读取原配置文件中的内容
-        f = open(config_filename, 'r')
-        cfg = json.load(f)
-        f.close()
-        # 更新配置文件，写入此分块的信息
-        f = open(config_filename, 'w')
-        cfg['parts'].append(part)
-        json.dump(cfg, f)
-        f.close()
+            for chunk in r.iter_content(chunk_size=READ_BUFFER_SIZE):  # 每次最多只读取 READ_BUFFER_SIZE 个字节，内存占用与 multipart_chunksize 无关
+                fp.write(chunk)  # 写入已下载的字节
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
     except Exception as e:
         logger.error('Part Number {} [Range: bytes={}-{}] download failed, the reason is that {}'.format(part_number, start, stop, e))
         return {
-            'failed': True  # 用于告知 _fetchByRange() 的调用方，此 Range 下载失败了
+            'failed': True
         }
     finally:
-        # 释放锁
-        lock.release()
+        r.close()  # 释放连接，放回连接池
+
+    if size != part_length:  # 突然网络故障了，连接被服务器强制关闭了，此时客户端读取的响应体的长度不足
+        logger.error('Part Number {} [Range: bytes={}-{}] download failed, received {} bytes'.format(part_number, start, stop, size))
+        return {
+            'failed': True
+        }
+
+    # 向配置文件追加一条此分块的记录，只有这一步需要互斥 (PartJournal 内部加锁)
+    try:
+        journal.append(start, stop, crc)
+    except Exception as e:
+        logger.error('Part Number {} [Range: bytes={}-{}] download failed, the reason is that {}'.format(part_number, start, stop, e))
+        return {
+            'failed': True  # 用于告知 _fetchByRange() 的调用方，此 Range 下载失败了
+        }
 
     logger.debug('Part Number {} [Range: bytes={}-{}] downloaded'.format(part_number, start, stop))
     return {
@@ -73,8 +85,9 @@ def _fetchByRange(lock, url, temp_filename, config_filename, part_number, start,
 @click.command()
 @click.option('--dest_filename', type=click.Path(), help="Name of the local destination file with extension")
 @click.option('--multipart_chunksize', default=8*1024*1024, help="Size of chunk, unit is bytes")
+@click.option('--verify', is_flag=True, help="Verify the CRC32 of every downloaded part before resuming, corrupted parts are downloaded again")
 @click.argument('url', type=click.Path())
-def crawl(dest_filename, multipart_chunksize, url):
+def crawl(dest_filename, multipart_chunksize, verify, url):
     t0 = time.time()
 
     # 如果没有指定本地保存时的文件名，则默认使用 URL 中最后一部分作为文件名
@@ -140,69 +153,62 @@ def crawl(dest_filename, multipart_chunksize, url):
                 if not os.path.exists(config_filename):  # 如果不存在配置文件时
                     os.remove(temp_filename)
                 else:  # 如果配置文件也在，则继续判断 ETag 是否一致
-                    with open(config_filename, 'r') as fp:
-                        cfg = json.load(fp)
-                        if cfg['ETag'] != ETag:  # 如果不一致
-                            os.remove(temp_filename)
-                        else:  # 从配置文件中读取已下载的分块号集合，从而得出未下载的分块号集合
-                            succeed_parts = {part['PartNumber'] for part in cfg['parts']}  # 之前已下载好的分块号集合
-                            succeed_parts_size = sum([part['Size'] for part in cfg['parts']])  # 已下载的块的总大小，注意是列表推导式不是集合推导式
-                            parts = set(range(parts_count)) - succeed_parts  # 本次需要下载的分块号集合
+                    header, records = load_journal(config_filename)
+                    if not header or header['ETag'] != ETag:  # 配置文件无效或 ETag 不一致
+                        os.remove(temp_filename)
+                    else:  # 从配置文件中读取已下载的字节范围 (指定 --verify 时丢弃 CRC32 不一致的分块)，从而得出未下载的分块号集合
+                        ranges = checked_ranges(temp_filename, records, verify)
+                        parts = missing_parts(ranges, file_size, multipart_chunksize)  # 本次需要下载的分块号集合
+                        succeed_parts_size = file_size - sum([min((part_number + 1) * multipart_chunksize, file_size) - part_number * multipart_chunksize for part_number in parts])  # 已下载的块的总大小
+                        journal = PartJournal(config_filename)  # 以追加模式继续记录
 
         # 再次判断临时文件在不在，如果不存在时，表示要下载所有分块号
         if not os.path.exists(temp_filename):
             succeed_parts_size = 0
             parts = range(parts_count)
 
-            # 由于 _fetchByRange() 中使用 rb+ 模式，必须先保证文件存在，所以要先创建指定大小的临时文件 (用0填充)
-            f = open(temp_filename, 'wb')
-            f.seek(file_size - 1)
-            f.write(b'\0')
-            f.close()
-
-            with open(config_filename, 'w') as fp:  # 创建配置文件，写入 ETag
-                cfg = {
-                    'ETag': ETag,
-                    'parts': []
-                }
-                json.dump(cfg, fp)
-
-        logger.debug('The remaining parts that need to be downloaded: {}'.format(set(parts)))
-
-        # 多线程并发下载
-        workers = min(8, len(parts))
-        failed_parts = 0  # 下载失败的分块数目
-
-        # 创建互斥锁
-        lock = threading.Lock()
-
-        # 固定住 lock、url、temp_filename、config_filename，不用每次都传入相同的参数
-        _fetchByRange_partial = partial(_fetchByRange, lock, url, temp_filename, config_filename)
-
-        with futures.ThreadPoolExecutor(workers) as executor:
-            to_do = []
-            # 创建并排定Future
-            for part_number in parts:
-                # 重要: 通过块号计算出块的起始与结束位置，最后一块(编号从0开始，所以最后一块编号为 parts_count - 1)需要特殊处理
-                if part_number != parts_count-1:
-                    start = part_number * multipart_chunksize
-                    stop = (part_number + 1) * multipart_chunksize - 1
-                else:
-                    start = part_number * multipart_chunksize
-                    stop = file_size - 1
-                future = executor.submit(_fetchByRange_partial, part_number, start, stop)
-                to_do.append(future)
-
-            # 获取Future的结果，futures.as_completed(to_do)的参数是Future列表，返回迭代器，
-            # 只有当有Future运行结束后，才产出future
-            done_iter = futures.as_completed(to_do)
-            with tqdm(total=file_size, initial=succeed_parts_size, unit='B', unit_scale=True, unit_divisor=1024, desc=official_filename) as bar:  # 打印下载时的进度条，并动态显示下载速度
-                for future in done_iter:  # future变量表示已完成的Future对象，所以后续future.result()绝不会阻塞
-                    result = future.result()
-                    if result.get('failed'):
-                        failed_parts += 1
+            # 由于 _fetchByRange() 中使用 rb+ 模式，必须先保证文件存在，所以要先创建指定大小的临时文件 (用0填充，真正分配磁盘空间)
+            preallocate(temp_filename, file_size)
+
+            journal = PartJournal.create(config_filename, {'ETag': ETag})  # 创建配置文件，写入 ETag
+
+        try:
+            logger.debug('The remaining parts that need to be downloaded: {}'.format(set(parts)))
+
+            # 多线程并发下载
+            workers = min(8, len(parts))
+            set_pool_size(workers)  # 连接池大小与线程数匹配，每个线程都能复用 keep-alive 连接
+            failed_parts = 0  # 下载失败的分块数目
+
+            # 固定住 url、temp_filename、journal，不用每次都传入相同的参数
+            _fetchByRange_partial = partial(_fetchByRange, url, temp_filename, journal)
+
+            with futures.ThreadPoolExecutor(workers) as executor:
+                to_do = []
+                # 创建并排定Future
+                for part_number in parts:
+                    # 重要: 通过块号计算出块的起始与结束位置，最后一块(编号从0开始，所以最后一块编号为 parts_count - 1)需要特殊处理
+                    if part_number != parts_count-1:
+                        start = part_number * multipart_chunksize
+                        stop = (part_number + 1) * multipart_chunksize - 1
                     else:
-                        bar.update(result.get('part')['Size'])
+                        start = part_number * multipart_chunksize
+                        stop = file_size - 1
+                    future = executor.submit(_fetchByRange_partial, part_number, start, stop)
+                    to_do.append(future)
+
+                # 获取Future的结果，futures.as_completed(to_do)的参数是Future列表，返回迭代器，
+                # 只有当有Future运行结束后，才产出future
+                done_iter = futures.as_completed(to_do)
+                with tqdm(total=file_size, initial=succeed_parts_size, unit='B', unit_scale=True, unit_divisor=1024, desc=official_filename) as bar:  # 打印下载时的进度条，并动态显示下载速度
+                    for future in done_iter:  # future变量表示已完成的Future对象，所以后续future.result()绝不会阻塞
+                        result = future.result()
+                        if result.get('failed'):
+                            failed_parts += 1
+                        else:
+                            bar.update(result.get('part')['Size'])
+        finally:
+            journal.close()  # 出错时也要把缓冲中的记录写入配置文件
 
         if failed_parts > 0:
             logger.error('Failed to download {}, failed parts: {}, successful parts: {}'.format(official_filename, failed_parts, parts_count-failed_parts))
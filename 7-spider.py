@@ -3,20 +3,25 @@ import aiohttp
 import aiofiles
 import click
 from functools import partial
-import json
 import os
 import time
+import zlib
 from tqdm import tqdm
+from journal import PartJournal, checked_ranges, load_journal, missing_parts
 from logger import logger
+from preallocate import preallocate
 
 
-async def _fetchByRange(semaphore, session, url, temp_filename, config_filename, part_number, start, stop):
+READ_BUFFER_SIZE = 64 * 1024  # 流式读取响应体时的缓冲区大小
+
+
+async def _fetchByRange(semaphore, session, url, temp_filename, journal, part_number, start, stop):
     '''根据 HTTP headers 中的 Range 只下载一个块 (rb+ 模式)
     semaphore: 限制并发的协程数
     session: aiohttp 会话
     url: 远程目标文件的 URL 地址
     temp_filename: 临时文件
-    config_filename: 配置文件
+    journal: 记录已下载分块的 PartJournal (配置文件)
     part_number: 块编号(从 0 开始)
     start: 块的起始位置
     stop: 块的结束位置
@@ -35,21 +40,19 @@ async def _fetchByRange(semaphore, session, url, temp_filename, config_filename,
                     'Size': part_length
                 }
 
+                size = 0  # 已写入的字节数
+                crc = 0  # 已写入的字节的 CRC32，记录到配置文件中，续传前可以校验
                 async with aiofiles.open(temp_filename, 'rb+') as fp:  # 注意: 不能用 a 模式哦，那样的话就算用 seek(0, 0) 移动指针到文件开头后，还是会从文件末尾处追加
                     await fp.seek(start)  # 移动文件指针
-                    logger.debug('File point: {}'.format(fp.tell()))
-                    binary_content = await r.read()  # Binary Response Content: access the response body as bytes, for non-text requests
-                    await fp.write(binary_content)  # 写入已下载的字节
-
-                # 读取原配置文件中的内容
-                f = open(config_filename, 'r')
-                cfg = json.load(f)
-                f.close()
-                # 更新配置文件，写入此分块的信息
-                f = open(config_filename, 'w')
-                cfg['parts'].append(part)
-                json.dump(cfg, f)
-                f.close()
+                    async for chunk in r.content.iter_chunked(READ_BUFFER_SIZE):  # 边接收边写入，每次最多只读取 READ_BUFFER_SIZE 个字节，内存占用与 multipart_chunksize 无关
+                        await fp.write(chunk)  # 写入已下载的字节
+                        crc = zlib.crc32(chunk, crc)
+                        size += len(chunk)
+
+                if size != part_length:  # 突然网络故障了，连接被服务器强制关闭了，此时客户端读取的响应体的长度不足
+                    raise ValueError('received {} bytes'.format(size))
+
+                journal.append(start, stop, crc)  # 向配置文件追加一条此分块的记录
 
                 logger.debug('Part Number {} [Range: bytes={}-{}] downloaded'.format(part_number, start, stop))
                 return {
@@ -63,8 +66,10 @@ async def _fetchByRange(semaphore, session, url, temp_filename, config_filename,
         }
 
 
-async def _fetchOneFile(url, dest_filename=None, multipart_chunksize=8*1024*1024):
-    '''下载单个大文件'''
+async def _fetchOneFile(url, dest_filename=None, multipart_chunksize=8*1024*1024, verify=False):
+    '''下载单个大文件
+    verify: 续传前是否校验已下载分块的 CRC32
+    '''
     t0 = time.time()
 
     # 如果没有指定本地保存时的文件名，则默认使用 URL 中最后一部分作为文件名
@@ -133,61 +138,57 @@ async def _fetchOneFile(url, dest_filename=None, multipart_chunksize=8*1024*1024
                             if not os.path.exists(config_filename):  # 如果不存在配置文件时
                                 os.remove(temp_filename)
                             else:  # 如果配置文件也在，则继续判断 ETag 是否一致
-                                with open(config_filename, 'r') as fp:
-                                    cfg = json.load(fp)
-                                    if cfg['ETag'] != ETag:  # 如果不一致
-                                        os.remove(temp_filename)
-                                    else:  # 从配置文件中读取已下载的分块号集合，从而得出未下载的分块号集合
-                                        succeed_parts = {part['PartNumber'] for part in cfg['parts']}  # 之前已下载好的分块号集合
-                                        succeed_parts_size = sum([part['Size'] for part in cfg['parts']])  # 已下载的块的总大小，注意是列表推导式不是集合推导式
-                                        parts = set(range(parts_count)) - succeed_parts  # 本次需要下载的分块号集合
+                                header, records = load_journal(config_filename)
+                                if not header or header['ETag'] != ETag:  # 配置文件无效或 ETag 不一致
+                                    os.remove(temp_filename)
+                                else:  # 从配置文件中读取已下载的字节范围 (verify 为 True 时丢弃 CRC32 不一致的分块，在线程池中校验)，从而得出未下载的分块号集合
+                                    ranges = await asyncio.get_running_loop().run_in_executor(None, checked_ranges, temp_filename, records, verify)
+                                    parts = missing_parts(ranges, file_size, multipart_chunksize)  # 本次需要下载的分块号集合
+                                    succeed_parts_size = file_size - sum([min((part_number + 1) * multipart_chunksize, file_size) - part_number * multipart_chunksize for part_number in parts])  # 已下载的块的总大小
+                                    journal = PartJournal(config_filename)  # 以追加模式继续记录
 
                     # 再次判断临时文件在不在，如果不存在时，表示要下载所有分块号
                     if not os.path.exists(temp_filename):
                         succeed_parts_size = 0
                         parts = range(parts_count)
 
-                        # 由于 _fetchByRange() 中使用 rb+ 模式，必须先保证文件存在，所以要先创建指定大小的临时文件 (用0填充)
-                        async with aiofiles.open(temp_filename, 'wb') as fp:
-                            await fp.seek(file_size - 1)
-                            await fp.write(b'\0')
-
-                        with open(config_filename, 'w') as fp:  # 创建配置文件，写入 ETag
-                            cfg = {
-                                'ETag': ETag,
-                                'parts': []
-                            }
-                            json.dump(cfg, fp)
-
-                    logger.debug('The remaining parts that need to be downloaded: {}'.format(set(parts)))
-
-                    # 用于限制并发请求数量
-                    sem = asyncio.Semaphore(min(64, len(parts)))
-
-                    # 固定住 sem、session、url、temp_filename、config_filename，不用每次都传入相同的参数
-                    _fetchByRange_partial = partial(_fetchByRange, sem, session, url, temp_filename, config_filename)
-
-                    to_do = []  # 保存所有任务的列表
-                    for part_number in parts:
-                        # 重要: 通过块号计算出块的起始与结束位置，最后一块(编号从0开始，所以最后一块编号为 parts_count - 1)需要特殊处理
-                        if part_number != parts_count-1:
-                            start = part_number * multipart_chunksize
-                            stop = (part_number + 1) * multipart_chunksize - 1
-                        else:
-                            start = part_number * multipart_chunksize
-                            stop = file_size - 1
-                        to_do.append(_fetchByRange_partial(part_number, start, stop))
-
-                    to_do_iter = asyncio.as_completed(to_do)
-
-                    failed_parts = 0  # 下载失败的分块数目
-                    with tqdm(total=file_size, initial=succeed_parts_size, unit='B', unit_scale=True, unit_divisor=1024, desc=official_filename) as bar:  # 打印下载时的进度条，并动态显示下载速度
-                        for future in to_do_iter:
-                            result = await future
-                            if result.get('failed'):
-                                failed_parts += 1
+                        # 由于 _fetchByRange() 中使用 rb+ 模式，必须先保证文件存在，所以要先创建指定大小的临时文件 (用0填充，真正分配磁盘空间)
+                        await asyncio.get_running_loop().run_in_executor(None, preallocate, temp_filename, file_size)  # fallocate 可能较慢，放到线程池中执行
+
+                        journal = PartJournal.create(config_filename, {'ETag': ETag})  # 创建配置文件，写入 ETag
+
+                    try:
+                        logger.debug('The remaining parts that need to be downloaded: {}'.format(set(parts)))
+
+                        # 用于限制并发请求数量
+                        sem = asyncio.Semaphore(min(64, len(parts)))
+
+                        # 固定住 sem、session、url、temp_filename、journal，不用每次都传入相同的参数
+                        _fetchByRange_partial = partial(_fetchByRange, sem, session, url, temp_filename, journal)
+
+                        to_do = []  # 保存所有任务的列表
+                        for part_number in parts:
+                            # 重要: 通过块号计算出块的起始与结束位置，最后一块(编号从0开始，所以最后一块编号为 parts_count - 1)需要特殊处理
+                            if part_number != parts_count-1:
+                                start = part_number * multipart_chunksize
+                                stop = (part_number + 1) * multipart_chunksize - 1
                             else:
-                                bar.update(result.get('part')['Size'])
+                                start = part_number * multipart_chunksize
+                                stop = file_size - 1
+                            to_do.append(_fetchByRange_partial(part_number, start, stop))
+
+                        to_do_iter = asyncio.as_completed(to_do)
+
+                        failed_parts = 0  # 下载失败的分块数目
+                        with tqdm(total=file_size, initial=succeed_parts_size, unit='B', unit_scale=True, unit_divisor=1024, desc=official_filename) as bar:  # 打印下载时的进度条，并动态显示下载速度
+                            for future in to_do_iter:
+                                result = await future
+                                if result.get('failed'):
+                                    failed_parts += 1
+                                else:
+                                    bar.update(result.get('part')['Size'])
+                    finally:
+                        journal.close()  # 出错时也要把缓冲中的记录写入配置文件
 
                     if failed_parts > 0:
                         logger.error('Failed to download {}, failed parts: {}, successful parts: {}'.format(official_filename, failed_parts, parts_count-failed_parts))
@@ -209,9 +210,10 @@ async def _fetchOneFile(url, dest_filename=None, multipart_chunksize=8*1024*1024
 @click.command()
 @click.option('--dest_filename', type=click.Path(), help="Name of the local destination file with extension")
 @click.option('--multipart_chunksize', default=8*1024*1024, help="Size of chunk, unit is bytes")
+@click.option('--verify', is_flag=True, help="Verify the CRC32 of every downloaded part before resuming, corrupted parts are downloaded again")
 @click.argument('url', type=click.Path())
-def crawl(dest_filename, multipart_chunksize, url):
-    asyncio.run(_fetchOneFile(url, dest_filename, multipart_chunksize))
+def crawl(dest_filename, multipart_chunksize, verify, url):
+    asyncio.run(_fetchOneFile(url, dest_filename, multipart_chunksize, verify))
 
 
 if __name__ == '__main__':
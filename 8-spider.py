@@ -1,76 +1,196 @@
+import click
 from concurrent import futures
 from functools import partial
+import heapq
 import json
+import logging
 import os
-import threading
+import signal
 import time
+from urllib.parse import urlsplit
+import zlib
 from tqdm import tqdm
-from custom_request import custom_request
+from custom_request import custom_request, parse_content_range, set_pool_size
+from hasher import StreamingHasher, expected_digest
+from journal import PartJournal, checked_ranges, load_journal, missing_ranges, resume_offset
 from logger import logger
+from metrics import Metrics, start_exporters
+from mirrors import MirrorSet
+from part_writer import open_writer
+from preallocate import DiskSpace, preallocate
+from probe_cache import CACHE_TTL, ProbeCache
+from retry import MAX_ATTEMPTS, MAX_RESTARTS, backoff_delay
+from scheduler import MAX_CONNECTIONS, MAX_CONNECTIONS_PER_HOST, ConnectionBudget
+from splitter import AdaptiveSplitter
+from throttle import BandwidthLimiter, load_rate_limits, parse_rate, reload_rate_limits
 
 
-def _fetchByRange(lock, url, temp_filename, config_filename, part_number, start, stop):
-    '''根据 HTTP headers 中的 Range 只下载一个块 (rb+ 模式)
-    lock: 互斥锁
-    url: 远程目标文件的 URL 地址
+READ_BUFFER_SIZE = 64 * 1024  # 流式读取响应体时的缓冲区大小
+
+
+def _fetchByRange(temp_filename, writer, journal, splitter, throttle, hasher, mirrors, metrics, segment, mirror=None, r=None, ttfb=0.0):
+    '''根据 HTTP headers 中的 Range 只下载一个范围
     temp_filename: 临时文件
-    config_filename: 配置文件
-    part_number: 块编号(从 0 开始)
-    start: 块的起始位置
-    stop: 块的结束位置
+    writer: 共享的 PwriteWriter 或 MmapWriter，将字节写入临时文件的指定位置
+    journal: 记录已下载范围的 PartJournal (配置文件)
+    splitter: 分配范围的 AdaptiveSplitter，下载过程中此范围的后半部分可能被空闲的线程拆走
+    throttle: 此文件的 FileThrottle 限速器，为 None 时不限速
+    hasher: 边下载边计算哈希值的 StreamingHasher，为 None 时不校验
+    mirrors: 此文件的 MirrorSet，记录各镜像的 ETag，每个范围请求都带上 If-Range，远程文件变化时服务器会返回 200 (整个新文件) 而不是 206
+    metrics: 所有文件共享的 Metrics，记录写入的字节数、首字节时间、传输时间、写临时文件和追加配置文件的时间
+    segment: 要下载的范围 Segment(start, stop)
+    mirror: 从哪个镜像下载此范围，为 None 时使用主 URL
+    r: 已经收到响应头的此范围的响应 (例如探测请求)，为 None 时才发出请求，ttfb 为它的首字节时间
     '''
-    headers = {'Range': 'bytes=%d-%d' % (start, stop)}
-    r = custom_request('GET', url, info='Range: bytes={}-{}'.format(start, stop), headers=headers)
+    t0 = time.time() - ttfb
+    start, stop = segment.start, segment.stop
+    if mirror is None:
+        mirror = mirrors.primary
+    if r is None:
+        headers = {'Range': 'bytes=%d-%d' % (start, stop)}
+        if mirror.etag and not mirror.etag.startswith('W/'):  # If-Range 只能使用强 ETag，弱 ETag 只能比较响应头；镜像第一次请求时还不知道它的 ETag
+            headers['If-Range'] = mirror.etag
+        r = custom_request('GET', mirror.url, info=('Range: bytes=%d-%d', start, stop), headers=headers, stream=True)  # stream=True: 边接收边写入，不把整个范围读入内存
+        ttfb = time.time() - t0  # 首字节时间，stream=True 时收到响应头就返回
 
-    part_length = stop - start + 1
-    if not r or len(r.content) != part_length:  # 请求失败时，r 为 None; 或者，突然网络故障了，连接被服务器强制关闭了，此时客户端读取的响应体的长度不足
-        logger.error('[{}] Part Number {} [Range: bytes={}-{}] download failed'.format(temp_filename.strip('.swp'), part_number, start, stop))
+    if not r:  # 请求失败时，r 为 None
+        logger.error('[%s] [Range: bytes=%s-%s] download failed', temp_filename.strip('.swp'), start, stop)
         return {
             'failed': True  # 用于告知 _fetchByRange() 的调用方，此 Range 下载失败了
         }
+    metrics.observe('part_ttfb_seconds', ttfb, host=mirror.host)
+
+    # 远程文件在下载过程中变化了 (服务器忽略 Range 返回了整个新文件，或者 ETag、文件大小不一致)，不能把两个版本的字节拼接到同一个临时文件中
+    if not mirrors.validate(mirror, r.status_code, r.headers.get('ETag'), r.headers.get('Content-Range')):
+        r.close()
+        if not mirror.primary:  # 镜像上的文件不一致，此镜像已经被丢弃，由其它镜像重新下载此范围 (它是最后一个镜像时不会被丢弃，按普通的失败重试)
+            return {
+                'dropped': not mirror.alive,
+                'failed': True
+            }
+        logger.error('[%s] [Range: bytes=%s-%s] the remote file has changed, ETag: %s', temp_filename.strip('.swp'), start, stop, r.headers.get('ETag'))
+        splitter.abort()  # 不再切出新的范围，其它正在下载的范围也会提前结束
+        return {
+            'changed': True,  # 用于告知 _fetchByRange() 的调用方，需要放弃此文件已下载的部分
+            'failed': True
+        }
+
+    # 各范围互不重叠，所有线程通过同一个文件描述符 pwrite() 到各自的偏移处，不需要加锁，也不用每个范围都打开一次文件
+    error = None
+    crc = 0  # 已写入的字节的 CRC32，记录到配置文件中，续传前可以校验
+    write_time = 0.0  # 写临时文件的总时间
+    try:
+        for chunk in r.iter_content(chunk_size=READ_BUFFER_SIZE):  # 每次最多只读取 READ_BUFFER_SIZE 个字节，内存占用与范围的大小无关
+            if throttle is not None:
+                throttle.consume(len(chunk))  # 令牌不够时在这里等待，读得慢了服务器也会发得慢
+            offset, count = splitter.claim(segment, len(chunk))  # 后半部分可能已经被拆走了，只写入仍属于自己的字节
+            data = chunk if count == len(chunk) else chunk[:count]
+            t1 = time.perf_counter()
+            try:
+                writer.write(offset, data)  # 写入已下载的字节
+            except Exception:
+                splitter.unclaim(segment, offset)  # 没有写入的字节不能记录到配置文件中，由重试重新下载
+                raise
+            write_time += time.perf_counter() - t1
+            metrics.transferred(mirrors.name, mirror.host, count)
+            crc = zlib.crc32(data, crc)
+            if hasher is not None:
+                hasher.feed(offset, data)  # 正好接在已计算的部分后面时，直接在内存中计算哈希值
+            if segment.pos > segment.stop:  # 自己的部分已经写完 (被拆分时会提前结束，剩余的响应体直接丢弃)
+                break
+    except Exception as e:
+        error = e
+    finally:
+        r.close()  # 释放连接，放回连接池 (提前结束时连接会被关闭)
+    metrics.observe('part_write_seconds', write_time, file=mirrors.name)
+
+    if splitter.aborted:  # 其它范围发现远程文件变化了，此文件已下载的部分都会被丢弃，不需要再记录
+        return {
+            'changed': True,
+            'failed': True
+        }
+
+    stop = segment.stop  # 被拆分后 stop 会变小
+    size = segment.pos - start  # 已写入的字节数
+    if hasher is not None and size > 0:
+        hasher.done(start, segment.pos - 1)  # 如果填上了缺口，会从临时文件读回后面已完成的范围继续计算哈希值
+    if segment.pos <= stop:  # 突然网络故障了，连接被服务器强制关闭了，此时客户端读取的响应体的长度不足
+        logger.error('[%s] [Range: bytes=%s-%s] download failed, received %s bytes, the reason is that %s', temp_filename.strip('.swp'), start, stop, size, error)
+        # 已经写入的前半部分仍然有效，记录下来，重试时只需要下载剩下的字节
+        if size > 0:
+            try:
+                with metrics.timer('journal_seconds', file=mirrors.name):
+                    writer.flush_range(start, segment.pos - 1)
+                    journal.append(start, segment.pos - 1, crc)
+            except Exception:
+                size = 0
+        return {
+            'saved': size,  # 已保存的字节数
+            'failed': True
+        }
 
-    # 此分块的信息
+    # 此范围的信息
     part = {
         'ETag': r.headers['ETag'],
         'Last-Modified': r.headers['Last-Modified'],
-        'PartNumber': part_number,
-        'Size': part_length
+        'Start': start,
+        'Stop': stop,
+        'Size': size
     }
 
-    # 获取锁
-    lock.acquire()
+    # 向配置文件追加一条此范围的记录，只有这一步需要互斥 (PartJournal 内部加锁)
     try:
-        with open(temp_filename, 'rb+') as fp:  # 注意: 不能用 a 模式哦，那样的话就算用 seek(0, 0) 移动指针到文件开头后，还是会从文件末尾处追加
-            fp.seek(start)  # 移动文件指针
-            logger.debug('[{}] File point: {}'.format(temp_filename.strip('.swp'), fp.tell()))
-            fp.write(r.content)  # 写入已下载的字节
-        # 读取原配置文件中的内容
-        f = open(config_filename, 'r')
-        cfg = json.load(f)
-        f.close()
-        # 更新配置文件，写入此分块的信息
-        f = open(config_filename, 'w')
-        cfg['parts'].append(part)
-        json.dump(cfg, f)
-        f.close()
+        with metrics.timer('journal_seconds', file=mirrors.name):
+            writer.flush_range(start, stop)  # 按照 mmap 的同步策略，先让数据落盘再记录
+            journal.append(start, stop, crc)
     except Exception as e:
-        logger.error('[{}] Part Number {} [Range: bytes={}-{}] download failed, the reason is that {}'.format(temp_filename.strip('.swp'), part_number, start, stop, e))
+        logger.error('[%s] [Range: bytes=%s-%s] download failed, the reason is that %s', temp_filename.strip('.swp'), start, stop, e)
         return {
+            'crc': crc,  # 整个范围都已经写入了，调用方重新记录时使用
             'failed': True  # 用于告知 _fetchByRange() 的调用方，此 Range 下载失败了
         }
-    finally:
-        # 释放锁
-        lock.release()
 
-    logger.debug('[{}] Part Number {} [Range: bytes={}-{}] downloaded'.format(temp_filename.strip('.swp'), part_number, start, stop))
+    elapsed = time.time() - t0
+    metrics.observe('part_transfer_seconds', elapsed - ttfb, host=mirror.host)
+    if logger.isEnabledFor(logging.DEBUG):  # 每个范围都会执行，日志级别高于 DEBUG 时连参数都不用计算
+        logger.debug('[%s] [Range: bytes=%s-%s] downloaded', temp_filename.strip('.swp'), start, stop)
     return {
         'part': part,
+        'ttfb': ttfb,
+        'elapsed': elapsed,
         'failed': False  # 用于告知 _fetchByRange() 的调用方，此 Range 成功下载
     }
 
 
-def _fetchOneFile(url, dest_filename=None, multipart_chunksize=8*1024*1024):
-    '''下载单个大文件'''
+def _probe(url, start, multipart_chunksize, if_range=None):
+    '''用 GET 请求从 start 开始的一个范围作为探测请求，返回 (响应, 首字节时间)，请求失败时响应为 None
+    if_range: 上次记录的 ETag，远程文件变化时服务器会忽略 Range 返回整个文件 (200)
+    '''
+    t0 = time.time()
+    stop = start + multipart_chunksize - 1
+    headers = {'Range': 'bytes=%d-%d' % (start, stop)}
+    if if_range:
+        headers['If-Range'] = if_range
+    r = custom_request('GET', url, info=('Range: bytes=%d-%d', start, stop), headers=headers, stream=True)  # stream=True: 只接收响应头，响应体留到后面再读
+    return r, time.time() - t0
+
+
+def _fetchOneFile(url, dest_filename=None, multipart_chunksize=8*1024*1024, writer_mode='pwrite', mmap_flush='close', disk_space=None, max_attempts=MAX_ATTEMPTS, budget=None, throttle=None, checksum=None, verify=False, cache=None, mirror_urls=None, metrics=None, restarts=0):
+    '''下载单个大文件
+    writer_mode: 写入临时文件的方式，'pwrite' 或 'mmap'
+    mmap_flush: writer_mode 为 'mmap' 时的同步策略，'part'、'close' 或 'none'
+    disk_space: 所有文件共享的 DiskSpace 磁盘空间预算
+    max_attempts: 每个分块最多尝试下载的次数，失败后按指数退避重试
+    budget: 所有文件共享的 ConnectionBudget 连接预算，每个范围发出请求之前都要先申请一个连接名额
+    throttle: 此文件的 FileThrottle 限速器 (全局限速 + 此文件的限速)，为 None 时不限速
+    checksum: (算法, 期望的十六进制哈希值)，例如 ('sha256', '...')，边下载边计算，一致时才改为正式文件名
+    verify: 续传前是否并行校验已下载范围的 CRC32，校验失败的范围重新下载
+    cache: 所有文件共享的 ProbeCache 探测结果缓存，为 None 时每次都发探测请求
+    mirror_urls: 同一个文件的其它下载地址，与 url 一起分担各个范围，探测请求只发给 url
+    metrics: 所有文件共享的 Metrics 运行指标，为 None 时只统计此文件
+    restarts: 因为远程文件在下载过程中变化而重新开始下载的次数
+    下载成功 (或者之前已经下载完成) 时返回正式文件名，失败时返回 None
+    '''
     t0 = time.time()
 
     # 如果没有指定本地保存时的文件名，则默认使用 URL 中最后一部分作为文件名
@@ -78,141 +198,292 @@ def _fetchOneFile(url, dest_filename=None, multipart_chunksize=8*1024*1024):
     temp_filename = official_filename + '.swp'  # 没下载完成时，临时文件名
     config_filename = official_filename + '.swp.cfg'  # 没下载完成时，存储 ETag 等信息的配置文件名
 
-    # 获取文件的大小和 ETag
-    r = custom_request('HEAD', url, info='header message')
-    if not r:  # 请求失败时，r 为 None
-        logger.error('Failed to get header message on URL [{}]'.format(url))
+    # 探测结果的缓存还有效时，已经下载完成的文件只需要在本地比较大小，不发任何请求
+    cached = cache.get(url) if cache is not None else None
+    if cached is not None and os.path.exists(official_filename):
+        if os.path.getsize(official_filename) == cached['Size']:
+            logger.warning('The file [%s] has already been downloaded', official_filename)
+            return official_filename
+        logger.warning('The filename [%s] has already exist, but it does not match the remote file', official_filename)
         return
-    file_size = int(r.headers['Content-Length'])
-    ETag = r.headers['ETag']
-    logger.debug('[{}] File size: {} bytes, ETag: {}'.format(official_filename, file_size, ETag))
-
-    # 如果正式文件存在
-    if os.path.exists(official_filename):
-        if os.path.getsize(official_filename) == file_size:  # 且大小与待下载的目标文件大小一致时
-            logger.warning('The file [{}] has already been downloaded'.format(official_filename))
+
+    # 探测请求也要占用一个连接 (它的响应体就是第一个范围)，所以发出之前先从连接预算申请名额，作为第一个范围的名额
+    # 与 9-spider.py 一样，文件数多于连接数时，探测请求也要和各个范围一起排队，不会超出连接数的上限
+    if metrics is None:
+        metrics = Metrics()
+    if budget is None:
+        budget = ConnectionBudget(metrics=metrics)
+    probe_host = urlsplit(url).netloc
+    budget.acquire(official_filename, probe_host)
+    probe_slot = True  # 探测请求的名额还没有交给第一个范围，也还没有归还
+    reserved = 0  # 从磁盘空间预算中预留的字节数，此文件结束 (无论成功与否) 时归还
+    try:
+        # 只发一个探测请求: 直接用 GET 请求第一个范围，同时得到文件的大小、ETag 以及是否支持 Range 下载，不再先发两个 HEAD 请求
+        # 支持 Range 下载时返回 206，Content-Range 中包含文件的总大小，响应体就是第一个范围的数据，之后交给下载线程写入
+        # 不支持时返回 200，响应体就是整个文件
+        # 缓存有效且上次运行留下了临时文件时，直接请求第一个还没有下载的范围，并用 If-Range 让服务器确认文件没有变化 (变化了会返回 200)
+        probe_start, if_range = 0, None
+        if cached is not None and cached['Ranges'] and not cached['ETag'].startswith('W/'):  # If-Range 只能使用强 ETag
+            offset = resume_offset(temp_filename, config_filename, cached['Size'], cached['ETag'])
+            if offset is not None:
+                probe_start, if_range = offset, cached['ETag']
+        probe, probe_ttfb = _probe(url, probe_start, multipart_chunksize, if_range)
+        if probe is not None and if_range and probe.status_code == 200:  # 远程文件已经变化，之前下载的部分都作废了，从头重新探测
+            probe.close()
+            logger.warning('The remote file [%s] has changed, it will be downloaded again', url)
+            cache.invalidate(url)
+            for filename in (temp_filename, config_filename):
+                if os.path.exists(filename):
+                    os.remove(filename)
+            probe_start = 0
+            probe, probe_ttfb = _probe(url, probe_start, multipart_chunksize)
+        if not probe:  # 请求失败时，probe 为 None
+            logger.error('Failed to get header message on URL [%s]', url)
             return
-        else:  # 大小不一致时，提醒用户要保存的文件名已存在，需要手动处理，不能随便覆盖
-            logger.warning('The filename [{}] has already exist, but it does not match the remote file'.format(official_filename))
+        try:
+            if probe.status_code == 206:
+                probe_start, probe_stop, file_size = parse_content_range(probe.headers['Content-Range'])  # 探测范围实际的结束位置 (文件小于 multipart_chunksize 时就是最后一个字节)
+            else:
+                file_size = int(probe.headers['Content-Length'])
+            ETag = probe.headers['ETag']
+        except (KeyError, ValueError) as e:
+            probe.close()
+            logger.error('Failed to get header message on URL [%s], the reason is that %s', url, e)
             return
+        if cache is not None:
+            cache.put(url, file_size, ETag, probe.headers.get('Last-Modified'), probe.status_code == 206)
+        logger.debug('[%s] File size: %s bytes, ETag: %s', official_filename, file_size, ETag)
 
-    # 首先需要判断此文件支不支持 Range 下载，请求第 1 个字节即可
-    headers = {'Range': 'bytes=0-0'}
-    r = custom_request('HEAD', url, info='Range: bytes=0-0', headers=headers)
-    if not r:  # 请求失败时，r 为 None
-        logger.error('Failed to get [Range: bytes=0-0] on URL [{}]'.format(url))
-        return
+        # 如果正式文件存在
+        if os.path.exists(official_filename):
+            probe.close()  # 不需要探测请求的响应体了，关闭连接
+            if os.path.getsize(official_filename) == file_size:  # 且大小与待下载的目标文件大小一致时
+                logger.warning('The file [%s] has already been downloaded', official_filename)
+                return official_filename
+            else:  # 大小不一致时，提醒用户要保存的文件名已存在，需要手动处理，不能随便覆盖
+                logger.warning('The filename [%s] has already exist, but it does not match the remote file', official_filename)
+                return
 
-    if r.status_code != 206:  # 不支持 Range 下载时
-        logger.warning('The file [{}] does not support breakpoint retransmission'.format(official_filename))
-        # 需要重新从头开始下载 (wb 模式)
-        with tqdm(total=file_size, unit='B', unit_scale=True, unit_divisor=1024, desc=official_filename) as bar:  # 打印下载时的进度条，并动态显示下载速度
-            r = custom_request('GET', url, info='all content', stream=True)
-            if not r:  # 请求失败时，r 为 None
-                logger.error('Failed to get all content on URL [{}]'.format(url))
+        # 检查磁盘剩余空间，所有文件共享同一个预算，所有文件加起来空间不够时尽早失败，而不是下载了几个 GB 之后才发现
+        if disk_space is not None:
+            needed = 0 if os.path.exists(temp_filename) and os.path.getsize(temp_filename) == file_size else file_size  # 大小正确的临时文件已经分配过空间了
+            if not disk_space.reserve(temp_filename, needed):
+                probe.close()
+                logger.error('Not enough disk space to download [%s], %s bytes needed', official_filename, needed)
                 return
-            with open(temp_filename, 'wb') as fp:
-                for chunk in r.iter_content(chunk_size=multipart_chunksize):
-                    if chunk:
-                        fp.write(chunk)
-                        bar.update(len(chunk))
-        # 整个文件内容被成功下载后，将临时文件名修改回正式文件名、删除配置文件
-        os.rename(temp_filename, official_filename)
-        if os.path.exists(config_filename):
-            os.remove(config_filename)
-        logger.debug('{} downloaded'.format(official_filename))
-        logger.debug('Cost {:.2f} seconds'.format(time.time() - t0))
-    else:  # 支持 Range 下载时
-        # 获取文件的总块数
-        div, mod = divmod(file_size, multipart_chunksize)
-        parts_count = div if mod == 0 else div + 1  # 计算出多少个分块
-        logger.debug('[{}] Chunk size: {} bytes, total parts: {}'.format(official_filename, multipart_chunksize, parts_count))
-
-        # 如果临时文件存在
-        if os.path.exists(temp_filename):
-            if os.path.getsize(temp_filename) != file_size:  # 说明此临时文件有问题，需要先删除它
+            reserved = needed
+
+        if probe.status_code != 206:  # 不支持 Range 下载时
+            logger.warning('The file [%s] does not support breakpoint retransmission', official_filename)
+            # 需要重新从头开始下载 (wb 模式)，探测请求的响应体就是整个文件
+            hasher = StreamingHasher(temp_filename, file_size, checksum[0]) if checksum else None
+            with tqdm(total=file_size, unit='B', unit_scale=True, unit_divisor=1024, desc=official_filename) as bar:  # 打印下载时的进度条，并动态显示下载速度
+                r = probe
+                with open(temp_filename, 'wb') as fp:
+                    for chunk in r.iter_content(chunk_size=multipart_chunksize):
+                        if chunk:
+                            if throttle is not None:
+                                throttle.consume(len(chunk))
+                            if hasher is not None:
+                                hasher.feed(bar.n, chunk)  # 顺序下载，bar.n 就是此 chunk 的偏移
+                            fp.write(chunk)
+                            bar.update(len(chunk))
+            if hasher is not None and not hasher.verify(checksum[1]):  # 哈希值不一致，下载的内容有误，删除临时文件
                 os.remove(temp_filename)
-            else:  # 临时文件有效时
-                if not os.path.exists(config_filename):  # 如果不存在配置文件时
+                return
+            # 整个文件内容被成功下载后，将临时文件名修改回正式文件名、删除配置文件
+            os.rename(temp_filename, official_filename)
+            if os.path.exists(config_filename):
+                os.remove(config_filename)
+            logger.debug('%s downloaded', official_filename)
+            logger.debug('Cost %.2f seconds', time.time() - t0)
+            return official_filename
+        else:  # 支持 Range 下载时
+            # 如果临时文件存在
+            if os.path.exists(temp_filename):
+                if os.path.getsize(temp_filename) != file_size:  # 说明此临时文件有问题，需要先删除它
                     os.remove(temp_filename)
-                else:  # 如果配置文件也在，则继续判断 ETag 是否一致
-                    with open(config_filename, 'r') as fp:
-                        cfg = json.load(fp)
-                        if cfg['ETag'] != ETag:  # 如果不一致
+                else:  # 临时文件有效时
+                    if not os.path.exists(config_filename):  # 如果不存在配置文件时
+                        os.remove(temp_filename)
+                    else:  # 如果配置文件也在，则继续判断 ETag 是否一致
+                        header, records = load_journal(config_filename)
+                        if not header or header['ETag'] != ETag:  # 配置文件无效或 ETag 不一致
                             os.remove(temp_filename)
-                        else:  # 从配置文件中读取已下载的分块号集合，从而得出未下载的分块号集合
-                            succeed_parts = {part['PartNumber'] for part in cfg['parts']}  # 之前已下载好的分块号集合
-                            succeed_parts_size = sum([part['Size'] for part in cfg['parts']])  # 已下载的块的总大小，注意是列表推导式不是集合推导式
-                            parts = set(range(parts_count)) - succeed_parts  # 本次需要下载的分块号集合
+                        else:  # 从配置文件中读取已下载的字节范围 (verify 为 True 时丢弃 CRC32 不一致的范围)，从而得出未下载的字节范围 (各范围的大小不固定，不再按分块号计算)
+                            ranges = checked_ranges(temp_filename, records, verify)
+                            holes = missing_ranges(ranges, file_size)  # 本次需要下载的字节范围
+                            journal = PartJournal(config_filename)  # 以追加模式继续记录
 
-        # 再次判断临时文件在不在，如果不存在时，表示要下载所有分块号
-        if not os.path.exists(temp_filename):
-            succeed_parts_size = 0
-            parts = range(parts_count)
+            # 再次判断临时文件在不在，如果不存在时，表示要下载整个文件
+            if not os.path.exists(temp_filename):
+                holes = [(0, file_size - 1)]
 
-            # 由于 _fetchByRange() 中使用 rb+ 模式，必须先保证文件存在，所以要先创建指定大小的临时文件 (用0填充)
-            f = open(temp_filename, 'wb')
-            f.seek(file_size - 1)
-            f.write(b'\0')
-            f.close()
+                # 由于 PwriteWriter/MmapWriter 以读写模式打开临时文件，必须先保证文件存在，所以要先创建指定大小的临时文件 (用0填充，真正分配磁盘空间)
+                try:
+                    preallocate(temp_filename, file_size)
+                except OSError as e:  # 例如磁盘空间不足 (ENOSPC)
+                    probe.close()
+                    logger.error('Failed to preallocate [%s], the reason is that %s', temp_filename, e)
+                    return
 
-            with open(config_filename, 'w') as fp:  # 创建配置文件，写入 ETag
-                cfg = {
-                    'ETag': ETag,
-                    'parts': []
-                }
-                json.dump(cfg, fp)
+                journal = PartJournal.create(config_filename, {'ETag': ETag})  # 创建配置文件，写入 ETag
 
-        logger.debug('[{}] The remaining parts that need to be downloaded: {}'.format(official_filename, set(parts)))
+            succeed_parts_size = file_size - sum([stop - start + 1 for start, stop in holes])  # 已下载的总大小
 
-        # 多线程并发下载
-        workers = min(8, len(parts))
-        failed_parts = 0  # 下载失败的分块数目
+            # 边下载边计算哈希值，之前已经下载的范围 (holes 的补集) 等到前面的缺口被填上时再从临时文件读回
+            hasher = None
+            if checksum:
+                hasher = StreamingHasher(temp_filename, file_size, checksum[0])
+                for start, stop in missing_ranges(holes, file_size):
+                    hasher.mark_done(start, stop)
+            logger.debug('[%s] The remaining ranges that need to be downloaded: %s', official_filename, holes)
 
-        # 创建互斥锁
-        lock = threading.Lock()
+            # 探测请求的响应体就是 [probe_start, probe_stop]，如果这部分正好是第一个还没有下载的范围的开头，就把它当作第一个范围，不用再请求一次；否则直接关闭
+            if holes and holes[0][0] == probe_start and holes[0][1] >= probe_stop:
+                holes[0] = (probe_stop + 1, holes[0][1])
+                if holes[0][0] > holes[0][1]:
+                    holes.pop(0)
+            else:
+                probe.close()
+                probe = None
+                probe_slot = False
+                budget.release(official_filename, probe_host)  # 先归还探测请求的名额，下面切出的范围重新申请
 
-        # 固定住 lock、url、temp_filename、config_filename，不用每次都传入相同的参数
-        _fetchByRange_partial = partial(_fetchByRange, lock, url, temp_filename, config_filename)
+            # 多线程并发下载，拿到连接名额时才切出下一个范围，范围的大小由 AdaptiveSplitter 根据测得的吞吐量和 RTT 决定，multipart_chunksize 只是初始大小
+            # 可选的镜像: 每个范围按各镜像测得的吞吐量选择从哪里下载，每个镜像的 host 各自受连接数上限的约束
+            mirrors = MirrorSet(official_filename, url, ETag, file_size, mirror_urls)
+            workers = min(budget.max_connections, budget.max_per_host * len(mirrors.hosts))  # 此文件最多能同时占用的连接数
+            splitter = AdaptiveSplitter(holes, multipart_chunksize, workers)
+            failed_parts = 0  # 下载失败的范围数目
+            changed = False  # 远程文件是否在下载过程中变化了
 
-        with futures.ThreadPoolExecutor(workers) as executor:
-            to_do = []
-            # 创建并排定Future
-            for part_number in parts:
-                # 重要: 通过块号计算出块的起始与结束位置，最后一块(编号从0开始，所以最后一块编号为 parts_count - 1)需要特殊处理
-                if part_number != parts_count-1:
-                    start = part_number * multipart_chunksize
-                    stop = (part_number + 1) * multipart_chunksize - 1
-                else:
-                    start = part_number * multipart_chunksize
-                    stop = file_size - 1
-                future = executor.submit(_fetchByRange_partial, part_number, start, stop)
-                to_do.append(future)
-
-            # 获取Future的结果，futures.as_completed(to_do)的参数是Future列表，返回迭代器，
-            # 只有当有Future运行结束后，才产出future
-            done_iter = futures.as_completed(to_do)
-            with tqdm(total=file_size, initial=succeed_parts_size, unit='B', unit_scale=True, unit_divisor=1024, desc=official_filename) as bar:  # 打印下载时的进度条，并动态显示下载速度
-                for future in done_iter:  # future变量表示已完成的Future对象，所以后续future.result()绝不会阻塞
-                    result = future.result()
-                    if result.get('failed'):
-                        failed_parts += 1
-                    else:
-                        bar.update(result.get('part')['Size'])
-
-        if failed_parts > 0:
-            logger.error('Failed to download {}, failed parts: {}, successful parts: {}'.format(official_filename, failed_parts, parts_count-failed_parts))
-        else:
-            # 整个文件内容被成功下载后，将临时文件名修改回正式文件名、删除配置文件
-            os.rename(temp_filename, official_filename)
-            if os.path.exists(config_filename):
+            # 所有范围共享临时文件的同一个文件描述符 (pwrite) 或同一个内存映射 (mmap)
+            writer = open_writer(temp_filename, writer_mode, mmap_flush)
+
+            # 固定住 temp_filename、writer、journal、splitter、throttle、hasher、mirrors、metrics，不用每次都传入相同的参数
+            _fetchByRange_partial = partial(_fetchByRange, temp_filename, writer, journal, splitter, throttle, hasher, mirrors, metrics)
+
+            def _release(mirror, future):
+                budget.release(official_filename, mirror.host)  # 范围结束 (无论成功与否) 后归还连接名额，其它文件可以马上使用
+                mirrors.release(mirror)
+
+            with futures.ThreadPoolExecutor(workers) as executor:
+                to_do = {}  # Future -> (segment, attempt, mirror)
+                retry_queue = []  # 等待重试的范围 (可以重试的时间, start, stop, attempt)，按时间排序的堆
+                with tqdm(total=file_size, initial=succeed_parts_size, unit='B', unit_scale=True, unit_divisor=1024, desc=official_filename) as bar:  # 打印下载时的进度条，并动态显示下载速度
+                    if probe is not None:  # 第一个范围直接读取探测请求的响应体
+                        mirror = mirrors.pick(mirrors.primary)
+                        probe_slot = False  # 探测请求的名额交给第一个范围，由 _release() 归还
+                        segment = splitter.track(probe_start, probe_stop)
+                        future = executor.submit(_fetchByRange_partial, segment, mirror, r=probe, ttfb=probe_ttfb)
+                        future.add_done_callback(partial(_release, mirror))
+                        to_do[future] = (segment, 0, mirror)
+
+                    while True:
+                        # 有退避时间已到的范围，或者还能切出新的范围时，先从全局预算申请一个连接名额 (总数、每个 host 的上限以及文件之间的公平分配都由 budget 负责)
+                        # 拿到名额后才切出范围，所以范围的大小用的是最新的测量结果；全部分配完以后，拿到名额的线程会拆走正在下载的最大范围的后半部分
+                        while (retry_queue and retry_queue[0][0] <= time.time()) or splitter.has_work():
+                            mirror = mirrors.pick()
+                            budget.acquire(official_filename, mirror.host)
+                            if retry_queue and retry_queue[0][0] <= time.time():
+                                _, start, stop, attempt = heapq.heappop(retry_queue)
+                                segment = splitter.track(start, stop)
+                            else:
+                                segment, attempt = splitter.next_range(), 0
+                                if segment is None:  # 等待名额期间剩下的字节已经被其它范围下载完了
+                                    _release(mirror, None)
+                                    break
+                            future = executor.submit(_fetchByRange_partial, segment, mirror)
+                            future.add_done_callback(partial(_release, mirror))
+                            to_do[future] = (segment, attempt, mirror)
+
+                        if not to_do and not retry_queue:
+                            break
+
+                        # 等待任意一个Future结束，或者等到下一个范围可以重试为止
+                        now = time.time()
+                        timeout = max(0, retry_queue[0][0] - now) if retry_queue else None
+                        if not to_do:
+                            time.sleep(timeout)
+                            continue
+                        done, _ = futures.wait(to_do, timeout=timeout, return_when=futures.FIRST_COMPLETED)
+
+                        for future in done:  # future变量表示已完成的Future对象，所以后续future.result()绝不会阻塞
+                            segment, attempt, mirror = to_do.pop(future)
+                            splitter.done(segment)
+                            result = future.result()
+                            if result.get('changed'):  # 远程文件变化了，不再重试 (splitter 已经放弃了剩下的字节)
+                                changed = True
+                                retry_queue.clear()
+                                continue
+                            if not result.get('failed'):
+                                bar.update(result.get('part')['Size'])
+                                splitter.record(result.get('part')['Size'], result.get('elapsed'), result.get('ttfb'))
+                                mirrors.record(mirror, result.get('part')['Size'], result.get('elapsed'), result.get('ttfb'))
+                                continue
+                            if result.get('dropped'):  # 镜像被丢弃了，马上从其它镜像重新下载，不算一次失败
+                                heapq.heappush(retry_queue, (time.time(), segment.pos, segment.stop, attempt))
+                                continue
+
+                            if segment.pos > segment.stop:  # 整个范围都已经写入，只是追加配置文件时出错了，不能再请求 (pos > stop 的范围会得到 416)，当作已经下载完成并重新记录
+                                try:
+                                    writer.flush_range(segment.start, segment.stop)
+                                    journal.append(segment.start, segment.stop, result.get('crc'))
+                                except Exception as e:  # 仍然失败时只影响续传: 中断后这个范围会重新下载
+                                    logger.warning('[%s] [Range: bytes=%s-%s] is downloaded but not journaled, the reason is that %s', official_filename, segment.start, segment.stop, e)
+                                bar.update(segment.stop - segment.start + 1)
+                                continue
+
+                            mirrors.fail(mirror)
+                            metrics.inc('part_errors_total', host=mirror.host)
+                            bar.update(result.get('saved', 0))  # 失败前已经保存的字节不用重新下载
+                            if attempt + 1 < max_attempts and not changed:  # 还有重试次数时，退避一段时间后重新排队，只重试剩下的字节，不影响其它范围
+                                delay = backoff_delay(attempt)
+                                logger.warning('[%s] [Range: bytes=%s-%s] will be retried in %.2f seconds (attempt %s/%s)', official_filename, segment.pos, segment.stop, delay, attempt + 2, max_attempts)
+                                heapq.heappush(retry_queue, (time.time() + delay, segment.pos, segment.stop, attempt + 1))
+                                metrics.inc('retries_total', file=official_filename)
+                            else:
+                                failed_parts += 1
+                                metrics.inc('failed_parts_total', file=official_filename)
+
+            writer.close()
+            journal.close()
+
+            if changed:  # 删除配置文件，从头探测并重新下载整个文件 (临时文件会被重新分配)，而不是把新旧两个版本拼接在一起
+                os.remove(config_filename)
+                if cache is not None:
+                    cache.invalidate(url)
+                if restarts >= MAX_RESTARTS:  # 已经重新开始了 MAX_RESTARTS 次
+                    logger.error('Failed to download %s, the remote file keeps changing', official_filename)
+                    return
+                logger.warning('The remote file [%s] has changed during downloading, it will be downloaded again', url)
+                metrics.inc('restarts_total', file=official_filename)
+                return _fetchOneFile(url, dest_filename, multipart_chunksize, writer_mode, mmap_flush, disk_space, max_attempts, budget, throttle, checksum, verify, cache, mirror_urls, metrics, restarts + 1)
+            elif failed_parts > 0:
+                logger.error('Failed to download %s, failed ranges: %s', official_filename, failed_parts)
+            elif hasher is not None and not hasher.verify(checksum[1]):  # 哈希值不一致，删除临时文件和配置文件，下次重新下载
+                os.remove(temp_filename)
                 os.remove(config_filename)
-            logger.debug('{} downloaded'.format(official_filename))
-            logger.debug('Cost {:.2f} seconds'.format(time.time() - t0))
+            else:
+                # 整个文件内容被成功下载后，将临时文件名修改回正式文件名、删除配置文件
+                os.rename(temp_filename, official_filename)
+                if os.path.exists(config_filename):
+                    os.remove(config_filename)
+                logger.debug('%s downloaded', official_filename)
+                logger.debug('Cost %.2f seconds', time.time() - t0)
+                return official_filename
+    finally:
+        if probe_slot:
+            budget.release(official_filename, probe_host)
+        if reserved:
+            disk_space.release(temp_filename, reserved)
 
 
-def crawl(config='config.json'):
-    '''多线程并发下载多个大文件'''
+def crawl(config='config.json', rate_limit=None):
+    '''多线程并发下载多个大文件
+    rate_limit: 命令行指定的全局限速 (字节/秒，可以带 K、M、G 后缀)，优先于 config.json 中的 rate_limit
+    '''
     # 读取包含多个大文件相关信息(url、dest_filename、multipart_chunksize)的配置文件 config.json
     with open(config, 'r') as fp:
         cfg = json.load(fp)
@@ -220,13 +491,56 @@ def crawl(config='config.json'):
         dest_filenames = [f['dest_filename'] for f in cfg['files']]
         multipart_chunksizes = [f['multipart_chunksize'] for f in cfg['files']]
 
+        checksums = [expected_digest(f) for f in cfg['files']]  # 可选的 sha256 或 md5 字段
+        mirror_urls = [f.get('mirrors') for f in cfg['files']]  # 可选的 mirrors 字段: 同一个文件的其它下载地址
+
     # 多线程并发下载
     workers = min(8, len(cfg['files']))
-    with futures.ThreadPoolExecutor(workers) as executor:
-        executor.map(_fetchOneFile, urls, dest_filenames, multipart_chunksizes)  # 给 Executor.map() 传多个序列
+    # 运行指标 (可选 metrics_port: Prometheus 的 /metrics 端口，metrics_file、metrics_interval: 定期写入 JSON 快照的文件和间隔秒数)
+    metrics = Metrics()
+    exporters = start_exporters(metrics, cfg)
+    # 所有文件共享同一个连接预算 (可选 max_connections: 总连接数，max_connections_per_host: 每个 host 的连接数)，不再是文件数乘以每个文件的线程数
+    budget = ConnectionBudget(cfg.get('max_connections', MAX_CONNECTIONS), cfg.get('max_connections_per_host', MAX_CONNECTIONS_PER_HOST), metrics=metrics)
+    # 每个 host 一个连接池，大小与每个 host 的连接数上限匹配，让所有文件的所有范围都复用 keep-alive 连接
+    set_pool_size(cfg.get('pool_size', budget.max_per_host))
 
+    # 带宽限制: 所有线程共享全局令牌桶，files 中的各项可以再单独限速，没有单独限速的文件可以用掉剩余的带宽
+    rate, file_rates = load_rate_limits(cfg)
+    limiter = BandwidthLimiter(parse_rate(rate_limit) if rate_limit is not None else rate)
+    throttles = [limiter.for_file(url, file_rates.get(url)) for url in urls]
+    # 下载过程中修改了 config.json 中的限速后，发送 SIGHUP 信号 (kill -HUP <pid>) 即可生效，不需要重新下载
+    old_handler = None
+    if hasattr(signal, 'SIGHUP'):
+        old_handler = signal.signal(signal.SIGHUP, lambda signum, frame: reload_rate_limits(limiter, config, rate_limit))
 
-if __name__ == '__main__':
+    # 写入临时文件的方式 (可选 writer: pwrite/mmap，mmap_flush: part/close/none)、磁盘空间预算、重试次数、连接预算和续传前是否校验 (可选 verify_on_resume) 对所有文件都一样
+    # 探测结果缓存 (可选 probe_cache: 缓存文件，例如 .probe_cache.json，默认不使用缓存；probe_cache_ttl: 有效期秒数)，cron 反复执行时缓存有效的文件不再发探测请求
+    cache = None
+    if cfg.get('probe_cache'):
+        cache = ProbeCache(cfg['probe_cache'], cfg.get('probe_cache_ttl', CACHE_TTL))
+
+    _fetchOneFile_partial = partial(_fetchOneFile, writer_mode=cfg.get('writer', 'pwrite'), mmap_flush=cfg.get('mmap_flush', 'close'), disk_space=DiskSpace(), max_attempts=cfg.get('max_attempts', MAX_ATTEMPTS), budget=budget, verify=cfg.get('verify_on_resume', False), cache=cache, metrics=metrics)
+    try:
+        with futures.ThreadPoolExecutor(workers) as executor:
+            for url, dest_filename, multipart_chunksize, throttle, checksum, mirrors in zip(urls, dest_filenames, multipart_chunksizes, throttles, checksums, mirror_urls):
+                executor.submit(_fetchOneFile_partial, url, dest_filename, multipart_chunksize, throttle=throttle, checksum=checksum, mirror_urls=mirrors)
+    finally:
+        if old_handler is not None:
+            signal.signal(signal.SIGHUP, old_handler)
+        if cache is not None:
+            cache.save()
+        for exporter in exporters:
+            exporter.close()
+
+
+@click.command()
+@click.option('--config', default='config.json', type=click.Path(exists=True), help="Configuration file with the files to download")
+@click.option('--rate_limit', help="Global bandwidth limit in bytes per second, K/M/G suffixes are allowed, e.g. 10M")
+def main(config, rate_limit):
     t0 = time.time()
-    crawl()
-    logger.info('Cost {:.2f} seconds'.format(time.time() - t0))
+    crawl(config, rate_limit)
+    logger.info('Cost %.2f seconds', time.time() - t0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,218 +1,84 @@
 import asyncio
-import aiohttp
-import aiofiles
-from functools import partial
+import click
 import json
-import os
+import signal
 import time
-from tqdm import tqdm
+from async_engine import AiohttpTransport, fetch_file
+from event_loop import IO_WORKERS, IOExecutor, LoopLagMonitor, client_session, run
+from hasher import expected_digest
 from logger import logger
+from metrics import Metrics, start_exporters
+from preallocate import DiskSpace
+from probe_cache import CACHE_TTL, ProbeCache
+from retry import MAX_ATTEMPTS
+from scheduler import MAX_CONNECTIONS, MAX_CONNECTIONS_PER_HOST, AsyncConnectionBudget
+from throttle import BandwidthLimiter, load_rate_limits, parse_rate, reload_rate_limits
 
 
-async def _fetchByRange(semaphore, session, url, temp_filename, config_filename, part_number, start, stop):
-    '''根据 HTTP headers 中的 Range 只下载一个块 (rb+ 模式)
-    semaphore: 限制并发的协程数
-    session: aiohttp 会话
-    url: 远程目标文件的 URL 地址
-    temp_filename: 临时文件
-    config_filename: 配置文件
-    part_number: 块编号(从 0 开始)
-    start: 块的起始位置
-    stop: 块的结束位置
-    '''
-    part_length = stop - start + 1
-    headers = {'Range': 'bytes=%d-%d' % (start, stop)}
-
-    try:
-        async with semaphore:
-            async with session.get(url, headers=headers) as r:
-                # 此分块的信息
-                part = {
-                    'ETag': r.headers['ETag'],
-                    'Last-Modified': r.headers['Last-Modified'],
-                    'PartNumber': part_number,
-                    'Size': part_length
-                }
-
-                async with aiofiles.open(temp_filename, 'rb+') as fp:  # 注意: 不能用 a 模式哦，那样的话就算用 seek(0, 0) 移动指针到文件开头后，还是会从文件末尾处追加
-                    await fp.seek(start)  # 移动文件指针
-                    logger.debug('[{}] File point: {}'.format(temp_filename.strip('.swp'), fp.tell()))
-                    binary_content = await r.read()  # Binary Response Content: access the response body as bytes, for non-text requests
-                    await fp.write(binary_content)  # 写入已下载的字节
-
-                # 读取原配置文件中的内容
-                f = open(config_filename, 'r')
-                cfg = json.load(f)
-                f.close()
-                # 更新配置文件，写入此分块的信息
-                f = open(config_filename, 'w')
-                cfg['parts'].append(part)
-                json.dump(cfg, f)
-                f.close()
+async def _fetchOneFile(session, url, *args, **kwargs):
+    '''用 aiohttp 会话 session 下载单个大文件，其它参数见 async_engine.fetch_file()，下载成功 (或者之前已经下载完成) 时返回正式文件名，失败时返回 None'''
+    return await fetch_file(AiohttpTransport(session), url, *args, **kwargs)
 
-                logger.debug('[{}] Part Number {} [Range: bytes={}-{}] downloaded'.format(temp_filename.strip('.swp'), part_number, start, stop))
-                return {
-                    'part': part,
-                    'failed': False  # 用于告知 _fetchByRange() 的调用方，此 Range 成功下载
-                }
-    except Exception as e:
-        logger.error('[{}] Part Number {} [Range: bytes={}-{}] download failed, the reason is that {}'.format(temp_filename.strip('.swp'), part_number, start, stop, e))
-        return {
-            'failed': True  # 用于告知 _fetchByRange() 的调用方，此 Range 下载失败了
-        }
 
-
-async def _fetchOneFile(session, url, dest_filename=None, multipart_chunksize=8*1024*1024):
+async def crawl(config='config.json', rate_limit=None, fast_loop=False):
+    '''rate_limit: 命令行指定的全局限速 (字节/秒，可以带 K、M、G 后缀)，优先于 config.json 中的 rate_limit
+    fast_loop: 是否使用调优过的连接池 (更长的 DNS 缓存、更大的接收缓冲区和读缓冲区)，事件循环由调用方选择
+    '''
+    tasks = []  # 保存所有任务的列表
+    with open(config, 'r') as fp:  # 读取包含多个大文件相关信息(url、dest_filename、multipart_chunksize)的配置文件 config.json
+        cfg = json.load(fp)
+    # 运行指标 (可选 metrics_port: Prometheus 的 /metrics 端口，metrics_file、metrics_interval: 定期写入 JSON 快照的文件和间隔秒数)，导出器在自己的线程中运行
+    metrics = Metrics()
+    exporters = start_exporters(metrics, cfg)
+    # 所有文件共享同一个连接预算 (可选 max_connections: 总连接数，max_connections_per_host: 每个 host 的连接数)，连接池的上限与之一致
+    budget = AsyncConnectionBudget(cfg.get('max_connections', MAX_CONNECTIONS), cfg.get('max_connections_per_host', MAX_CONNECTIONS_PER_HOST), metrics=metrics)
+
+    # 带宽限制: 所有协程共享全局令牌桶，files 中的各项可以再单独限速，没有单独限速的文件可以用掉剩余的带宽
+    rate, file_rates = load_rate_limits(cfg)
+    limiter = BandwidthLimiter(parse_rate(rate_limit) if rate_limit is not None else rate)
+    # 所有阻塞的文件系统操作都在专用的 I/O 线程池中执行 (可选 io_workers: 线程数)，同时监控事件循环被阻塞的时间
+    io_executor = IOExecutor(cfg.get('io_workers', IO_WORKERS))
+    lag_monitor = LoopLagMonitor(metrics=metrics)
+    lag_monitor.start()
+
+    # 下载过程中修改了 config.json 中的限速后，发送 SIGHUP 信号 (kill -HUP <pid>) 即可生效，不需要重新下载 (在 I/O 线程中重新读取配置文件)
+    loop = asyncio.get_running_loop()
+    if hasattr(signal, 'SIGHUP'):
+        loop.add_signal_handler(signal.SIGHUP, io_executor.executor.submit, reload_rate_limits, limiter, config, rate_limit)
+
+    # 探测结果缓存 (可选 probe_cache: 缓存文件，例如 .probe_cache.json，默认不使用缓存；probe_cache_ttl: 有效期秒数)，cron 反复执行时缓存有效的文件不再发探测请求
+    cache = None
+    if cfg.get('probe_cache'):
+        cache = ProbeCache(cfg['probe_cache'], cfg.get('probe_cache_ttl', CACHE_TTL))
+
+    async with client_session(budget.max_connections, budget.max_per_host, fast_loop) as session:  # aiohttp建议整个应用只创建一个session，不能为每个请求创建一个seesion
+        disk_space = DiskSpace()  # 所有文件共享的磁盘空间预算
+        for f in cfg['files']:
+            task = asyncio.create_task(_fetchOneFile(session, f['url'], f['dest_filename'], f['multipart_chunksize'], writer_mode=cfg.get('writer', 'aiofiles'), mmap_flush=cfg.get('mmap_flush', 'close'), disk_space=disk_space, max_attempts=cfg.get('max_attempts', MAX_ATTEMPTS), budget=budget, throttle=limiter.for_file(f['url'], file_rates.get(f['url'])), checksum=expected_digest(f), verify=cfg.get('verify_on_resume', False), cache=cache, mirror_urls=f.get('mirrors'), io_executor=io_executor, metrics=metrics))  # asyncio.create_task()是Python 3.7新加的，否则使用asyncio.ensure_future()
+            tasks.append(task)
+        await asyncio.gather(*tasks)
+    if cache is not None:
+        await io_executor.run(cache.save)
+    if hasattr(signal, 'SIGHUP'):
+        loop.remove_signal_handler(signal.SIGHUP)
+    for exporter in exporters:
+        await io_executor.run(exporter.close)  # 会等待导出线程结束
+    io_executor.shutdown()
+
+    await lag_monitor.stop()
+    lag = lag_monitor.snapshot()
+    logger.info('Event loop lag: mean %.1f ms, p99 %.1f ms, max %.1f ms', lag['mean_ms'], lag['p99_ms'], lag['max_ms'])
+
+
+@click.command()
+@click.option('--config', default='config.json', type=click.Path(exists=True), help="Configuration file with the files to download")
+@click.option('--rate_limit', help="Global bandwidth limit in bytes per second, K/M/G suffixes are allowed, e.g. 10M")
+@click.option('--fast_loop', is_flag=True, help="Use uvloop (if installed) and a tuned connection pool")
+def main(config, rate_limit, fast_loop):
     t0 = time.time()
+    run(crawl(config, rate_limit, fast_loop), fast_loop)
+    logger.info('Cost %.2f seconds', time.time() - t0)
 
-    # 如果没有指定本地保存时的文件名，则默认使用 URL 中最后一部分作为文件名
-    official_filename = dest_filename if dest_filename else url.split('/')[-1]  # 正式文件名
-    temp_filename = official_filename + '.swp'  # 没下载完成时，临时文件名
-    config_filename = official_filename + '.swp.cfg'  # 没下载完成时，存储 ETag 等信息的配置文件名
-
-    # 获取文件的大小和 ETag
-    try:
-        async with session.head(url) as r:
-            file_size = int(r.headers['Content-Length'])
-            ETag = r.headers['ETag']
-            logger.debug('[{}] file size: {} bytes, ETag: {}'.format(official_filename, file_size, ETag))
-    except Exception as e:
-        logger.error('Failed to get header message on URL [{}], the reason is that {}'.format(url, e))
-        return
-
-    # 如果正式文件存在
-    if os.path.exists(official_filename):
-        if os.path.getsize(official_filename) == file_size:  # 且大小与待下载的目标文件大小一致时
-            logger.warning('The file [{}] has already been downloaded'.format(official_filename))
-            return
-        else:  # 大小不一致时，提醒用户要保存的文件名已存在，需要手动处理，不能随便覆盖
-            logger.warning('The filename [{}] has already exist, but it does not match the remote file'.format(official_filename))
-            return
-
-    # 首先需要判断此文件支不支持 Range 下载，请求第 1 个字节即可
-    headers = {'Range': 'bytes=0-0'}
-
-    try:
-        async with session.head(url, headers=headers) as r:
-            if r.status != 206:  # 不支持 Range 下载时
-                logger.warning('The file [{}] does not support breakpoint retransmission'.format(official_filename))
-                # 需要重新从头开始下载 (wb 模式)
-                with tqdm(total=file_size, unit='B', unit_scale=True, unit_divisor=1024, desc=official_filename) as bar:  # 打印下载时的进度条，并动态显示下载速度
-                    try:
-                        async with session.get(url) as r:
-                            async with aiofiles.open(temp_filename, 'wb') as fp:
-                                while True:
-                                    chunk = await r.content.read(multipart_chunksize)
-                                    if not chunk:
-                                        break
-                                    await fp.write(chunk)
-                                    bar.update(len(chunk))
-                    except Exception as e:
-                        logger.error('Failed to get all content on URL [{}], the reason is that {}'.format(url, e))
-                        return
-                # 整个文件内容被成功下载后，将临时文件名修改回正式文件名、删除配置文件
-                os.rename(temp_filename, official_filename)
-                if os.path.exists(config_filename):
-                    os.remove(config_filename)
-                logger.debug('{} downloaded'.format(official_filename))
-                logger.debug('Cost {:.2f} seconds'.format(time.time() - t0))
-            else:  # 支持 Range 下载时
-                # 获取文件的总块数
-                div, mod = divmod(file_size, multipart_chunksize)
-                parts_count = div if mod == 0 else div + 1  # 计算出多少个分块
-                logger.debug('[{}] Chunk size: {} bytes, total parts: {}'.format(official_filename, multipart_chunksize, parts_count))
-
-                # 如果临时文件存在
-                if os.path.exists(temp_filename):
-                    if os.path.getsize(temp_filename) != file_size:  # 说明此临时文件有问题，需要先删除它
-                        os.remove(temp_filename)
-                    else:  # 临时文件有效时
-                        if not os.path.exists(config_filename):  # 如果不存在配置文件时
-                            os.remove(temp_filename)
-                        else:  # 如果配置文件也在，则继续判断 ETag 是否一致
-                            with open(config_filename, 'r') as fp:
-                                cfg = json.load(fp)
-                                if cfg['ETag'] != ETag:  # 如果不一致
-                                    os.remove(temp_filename)
-                                else:  # 从配置文件中读取已下载的分块号集合，从而得出未下载的分块号集合
-                                    succeed_parts = {part['PartNumber'] for part in cfg['parts']}  # 之前已下载好的分块号集合
-                                    succeed_parts_size = sum([part['Size'] for part in cfg['parts']])  # 已下载的块的总大小，注意是列表推导式不是集合推导式
-                                    parts = set(range(parts_count)) - succeed_parts  # 本次需要下载的分块号集合
-
-                # 再次判断临时文件在不在，如果不存在时，表示要下载所有分块号
-                if not os.path.exists(temp_filename):
-                    succeed_parts_size = 0
-                    parts = range(parts_count)
-
-                    # 由于 _fetchByRange() 中使用 rb+ 模式，必须先保证文件存在，所以要先创建指定大小的临时文件 (用0填充)
-                    async with aiofiles.open(temp_filename, 'wb') as fp:
-                        await fp.seek(file_size - 1)
-                        await fp.write(b'\0')
-
-                    with open(config_filename, 'w') as fp:  # 创建配置文件，写入 ETag
-                        cfg = {
-                            'ETag': ETag,
-                            'parts': []
-                        }
-                        json.dump(cfg, fp)
-
-                logger.debug('[{}] The remaining parts that need to be downloaded: {}'.format(official_filename, set(parts)))
-
-                # 用于限制并发请求数量
-                sem = asyncio.Semaphore(min(64, len(parts)))
-
-                # 固定住 sem、session、url、temp_filename、config_filename，不用每次都传入相同的参数
-                _fetchByRange_partial = partial(_fetchByRange, sem, session, url, temp_filename, config_filename)
-
-                to_do = []  # 保存所有任务的列表
-                for part_number in parts:
-                    # 重要: 通过块号计算出块的起始与结束位置，最后一块(编号从0开始，所以最后一块编号为 parts_count - 1)需要特殊处理
-                    if part_number != parts_count-1:
-                        start = part_number * multipart_chunksize
-                        stop = (part_number + 1) * multipart_chunksize - 1
-                    else:
-                        start = part_number * multipart_chunksize
-                        stop = file_size - 1
-                    to_do.append(_fetchByRange_partial(part_number, start, stop))
-
-                to_do_iter = asyncio.as_completed(to_do)
-
-                failed_parts = 0  # 下载失败的分块数目
-                with tqdm(total=file_size, initial=succeed_parts_size, unit='B', unit_scale=True, unit_divisor=1024, desc=official_filename) as bar:  # 打印下载时的进度条，并动态显示下载速度
-                    for future in to_do_iter:
-                        result = await future
-                        if result.get('failed'):
-                            failed_parts += 1
-                        else:
-                            bar.update(result.get('part')['Size'])
-
-                if failed_parts > 0:
-                    logger.error('Failed to download {}, failed parts: {}, successful parts: {}'.format(official_filename, failed_parts, parts_count-failed_parts))
-                else:
-                    # 整个文件内容被成功下载后，将临时文件名修改回正式文件名、删除配置文件
-                    os.rename(temp_filename, official_filename)
-                    if os.path.exists(config_filename):
-                        os.remove(config_filename)
-                    logger.debug('{} downloaded'.format(official_filename))
-                    logger.debug('Cost {:.2f} seconds'.format(time.time() - t0))
-
-    except Exception as e:
-        logger.error('Failed to get [Range: bytes=0-0] on URL [{}], the reason is that {}'.format(url, e))
-        return
-
-
-async def crawl(config='config.json'):
-    tasks = []  # 保存所有任务的列表
-    async with aiohttp.ClientSession() as session:  # aiohttp建议整个应用只创建一个session，不能为每个请求创建一个seesion
-        with open(config, 'r') as fp:  # 读取包含多个大文件相关信息(url、dest_filename、multipart_chunksize)的配置文件 config.json
-            cfg = json.load(fp)
-            for f in cfg['files']:
-                task = asyncio.create_task(_fetchOneFile(session, f['url'], f['dest_filename'], f['multipart_chunksize']))  # asyncio.create_task()是Python 3.7新加的，否则使用asyncio.ensure_future()
-                tasks.append(task)
-            await asyncio.gather(*tasks)
-    await session.close()
 
 if __name__ == '__main__':
-    t0 = time.time()
-    asyncio.run(crawl())
-    logger.info('Cost {:.2f} seconds'.format(time.time() - t0))
+    main()
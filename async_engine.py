@@ -0,0 +1,657 @@
+'''9-spider.py (asyncio + aiohttp) 和 10-spider.py (httpx HTTP/2) 共用的协程下载引擎
+两个下载器只有发出请求、读取和关闭响应的方式不一样，由 AiohttpTransport 和 HttpxTransport 负责，探测、切分范围、重试、续传都在这里
+所有阻塞的文件系统操作 (临时文件、配置文件、探测结果缓存) 都在 IOExecutor 的线程中执行，不阻塞事件循环
+'''
+import asyncio
+import aiofiles
+from functools import partial
+import logging
+import os
+import time
+from urllib.parse import urlsplit
+import zlib
+from tqdm import tqdm
+from custom_request import parse_content_range
+from event_loop import IOExecutor
+from hasher import StreamingHasher
+from journal import PartJournal, checked_ranges, load_journal, missing_ranges, resume_offset
+from logger import logger
+from metrics import Metrics
+from mirrors import MirrorSet
+from part_writer import open_writer
+from preallocate import preallocate
+from retry import MAX_ATTEMPTS, MAX_RESTARTS, backoff_delay
+from scheduler import AsyncConnectionBudget
+from splitter import AdaptiveSplitter
+
+
+READ_BUFFER_SIZE = 64 * 1024  # 流式读取响应体时的缓冲区大小
+WRITE_BATCH_SIZE = 1024 * 1024  # 攒够多少字节才在 I/O 线程中写入一次临时文件
+DRAIN_LIMIT = 1024 * 1024  # HTTP/2 下提前关闭响应时，剩余的响应体不超过这么多字节就读完再关闭，否则关闭整个连接
+
+
+class AiohttpTransport:
+    '''通过 aiohttp 会话发出请求 (HTTP/1.1，每个范围占用一个连接)'''
+
+    steal = True  # 范围的后半部分被拆走时，提前关闭响应只会关闭这一个连接
+
+    def __init__(self, session):
+        self.session = session
+
+    async def get(self, url, headers):
+        '''发出 GET 请求，收到响应头时就返回，响应体留给 chunks() 读取'''
+        return await self.session.get(url, headers=headers)
+
+    @staticmethod
+    def status(r):
+        return r.status
+
+    @staticmethod
+    def http_version(r):
+        return 'HTTP/{}.{}'.format(*r.version)
+
+    @staticmethod
+    def chunks(r, size):
+        '''边接收边产出响应体，每次最多 size 个字节'''
+        return r.content.iter_chunked(size)
+
+    @staticmethod
+    async def close(r):
+        '''释放响应: 响应体已经读完时连接放回连接池，否则关闭连接'''
+        r.release()
+
+
+class HttpxTransport:
+    '''通过 httpx.AsyncClient 发出请求，HTTP/2 下同一个 host 的所有范围都是同一个连接上的不同的流
+    httpcore 提前关闭 HTTP/2 的流时既不发送 RST_STREAM，也不确认之后收到的这个流的 DATA 帧，服务器已经发出的剩余字节会一直占用连接的流量控制窗口，
+    窗口用完后同一个连接上的所有流都会卡住，所以 close() 要么读完剩余的响应体，要么关闭整个连接
+    '''
+
+    steal = False  # 不拆分正在下载的范围，否则被拆走的后半部分要么白白下载两次，要么连累同一个连接上的其它流
+
+    def __init__(self, client):
+        self.client = client
+        self._bodies = {}  # 正在读取的响应 -> 它的 aiter_raw() 迭代器，aiter_raw() 只能调用一次，读完剩余的响应体时要继续用它
+
+    async def get(self, url, headers):
+        '''发出 GET 请求，stream=True: 只等到收到响应头，响应体留给 chunks() 读取'''
+        return await self.client.send(self.client.build_request('GET', url, headers=headers), stream=True)
+
+    @staticmethod
+    def status(r):
+        return r.status_code
+
+    @staticmethod
+    def http_version(r):
+        return r.http_version
+
+    def chunks(self, r, size):
+        '''aiter_raw(): 不解码 Content-Encoding，Range 的偏移对应的是原始字节；HTTP/2 的流量控制窗口在读取时自动归还'''
+        body = self._bodies[r] = r.aiter_raw(size)
+        return body
+
+    async def close(self, r):
+        '''关闭响应。响应体没有读完时，HTTP/1.1 由 httpx 关闭连接；HTTP/2 剩余不超过 DRAIN_LIMIT 个字节时读完再关闭 (归还流量控制窗口)，
+        否则关闭整个连接，同一个连接上的其它流会失败并重试 (已经写入的字节不会丢失)，连接池之后会建立新的连接
+        '''
+        body = self._bodies.pop(r, None)
+        try:
+            if not r.is_closed and r.http_version == 'HTTP/2':
+                length = r.headers.get('Content-Length')
+                if length is not None and int(length) - r.num_bytes_downloaded <= DRAIN_LIMIT:
+                    try:
+                        async for _ in (body if body is not None else r.aiter_raw()):
+                            pass
+                        return
+                    except Exception:  # 连接已经出错了，下面关闭它
+                        pass
+                await r.extensions['network_stream'].aclose()
+        finally:
+            if body is not None:
+                await body.aclose()
+            await r.aclose()
+
+
+def _reason(e):
+    '''日志中的出错原因: httpx 的超时、连接被关闭等异常的 str() 可能是空字符串，此时用异常的类名'''
+    return str(e) or type(e).__name__
+
+
+async def _fetchByRange(transport, io_executor, temp_filename, writer, journal, splitter, throttle, hasher, mirrors, metrics, segment, mirror=None, r=None, ttfb=0.0):
+    '''根据 HTTP headers 中的 Range 只下载一个范围，调用方必须已经从连接预算中拿到了一个连接名额
+    transport: AiohttpTransport 或 HttpxTransport，发出请求、读取和关闭响应
+    io_executor: 所有文件共享的 IOExecutor，写入临时文件、追加配置文件等阻塞操作都在它的线程中执行，不阻塞事件循环
+    temp_filename: 临时文件
+    writer: 共享的 MmapWriter 或 PwriteWriter，为 None 时用 aiofiles 以 rb+ 模式写入
+    journal: 记录已下载范围的 PartJournal (配置文件)
+    splitter: 分配范围的 AdaptiveSplitter，下载过程中此范围的后半部分可能被空闲的协程拆走
+    throttle: 此文件的 FileThrottle 限速器，为 None 时不限速
+    hasher: 边下载边计算哈希值的 StreamingHasher，为 None 时不校验
+    mirrors: 此文件的 MirrorSet，记录各镜像的 ETag，每个范围请求都带上 If-Range，远程文件变化时服务器会返回 200 (整个新文件) 而不是 206
+    metrics: 所有文件共享的 Metrics，记录写入的字节数、首字节时间、传输时间、写临时文件和追加配置文件的时间
+    segment: 要下载的范围 Segment(start, stop)
+    mirror: 从哪个镜像下载此范围，为 None 时使用主 URL
+    r: 已经收到响应头的此范围的响应 (例如探测请求)，为 None 时才发出请求，ttfb 为它的首字节时间
+    '''
+    start = segment.start
+    if mirror is None:
+        mirror = mirrors.primary
+    crc = 0  # 已写入的字节的 CRC32，记录到配置文件中，续传前可以校验
+    pending = []  # 已经读取、还没有写入临时文件的字节，攒够 WRITE_BATCH_SIZE 个字节后一次性写入，减少切换到 I/O 线程的次数
+    written = start  # 已经写入临时文件的字节的下一个偏移，也是 pending 中第一个字节的偏移
+    write_time = 0.0  # 写临时文件的总时间 (包括等待 I/O 线程的时间)
+
+    async def _flush():
+        '''写入 pending 中的字节，写入成功后才清空 pending、向前移动 written (写入失败时这些字节仍然没有写入)'''
+        nonlocal written, write_time, crc
+        if pending:
+            data = b''.join(pending)
+            t1 = time.perf_counter()
+            await io_executor.run(writer.write, written, data)
+            write_time += time.perf_counter() - t1
+            pending.clear()
+            crc = zlib.crc32(data, crc)
+            if hasher is not None:
+                hasher.feed(written, data)  # 正好接在已计算的部分后面时，直接在内存中计算哈希值
+            written += len(data)
+
+    try:
+        t0 = time.time() - ttfb
+        if r is None:
+            headers = {'Range': 'bytes=%d-%d' % (start, segment.stop)}
+            if mirror.etag and not mirror.etag.startswith('W/'):  # If-Range 只能使用强 ETag，弱 ETag 只能比较响应头；镜像第一次请求时还不知道它的 ETag
+                headers['If-Range'] = mirror.etag
+            r = await transport.get(mirror.url, headers)
+            ttfb = time.time() - t0  # 首字节时间，收到响应头时就返回
+        try:
+            metrics.observe('part_ttfb_seconds', ttfb, host=mirror.host)
+            status = transport.status(r)
+            if status >= 400:  # 服务器暂时出错 (例如 503)，按普通的失败重试，不能当成远程文件变化了
+                logger.error('[%s] [Range: bytes=%s-%s] download failed, HTTP status: %s', temp_filename.strip('.swp'), start, segment.stop, status)
+                return {
+                    'failed': True
+                }
+            # 远程文件在下载过程中变化了 (服务器忽略 Range 返回了整个新文件，或者 ETag、文件大小不一致)，不能把两个版本的字节拼接到同一个临时文件中
+            if not mirrors.validate(mirror, status, r.headers.get('ETag'), r.headers.get('Content-Range')):
+                if not mirror.primary:  # 镜像上的文件不一致，此镜像已经被丢弃，由其它镜像重新下载此范围 (它是最后一个镜像时不会被丢弃，按普通的失败重试)
+                    return {
+                        'dropped': not mirror.alive,
+                        'failed': True
+                    }
+                logger.error('[%s] [Range: bytes=%s-%s] the remote file has changed, ETag: %s', temp_filename.strip('.swp'), start, segment.stop, r.headers.get('ETag'))
+                splitter.abort()  # 不再切出新的范围，其它正在下载的范围也会提前结束
+                return {
+                    'changed': True,  # 用于告知 _fetchByRange() 的调用方，需要放弃此文件已下载的部分
+                    'failed': True
+                }
+            etag, last_modified = r.headers['ETag'], r.headers['Last-Modified']
+
+            if writer is None:
+                async with aiofiles.open(temp_filename, 'rb+', executor=io_executor.executor) as fp:  # 注意: 不能用 a 模式哦，那样的话就算用 seek(0, 0) 移动指针到文件开头后，还是会从文件末尾处追加
+                    await fp.seek(start)  # 移动文件指针
+                    async for chunk in transport.chunks(r, READ_BUFFER_SIZE):  # 边接收边写入，每次最多只读取 READ_BUFFER_SIZE 个字节，内存占用与范围的大小无关
+                        if throttle is not None:
+                            await throttle.consume_async(len(chunk))  # 令牌不够时在这里等待，读得慢了服务器也会发得慢
+                        offset, count = splitter.claim(segment, len(chunk))  # 后半部分可能已经被拆走了，只写入仍属于自己的字节
+                        data = chunk if count == len(chunk) else chunk[:count]
+                        t1 = time.perf_counter()
+                        await fp.write(data)  # 写入已下载的字节
+                        write_time += time.perf_counter() - t1
+                        written += count
+                        metrics.transferred(mirrors.name, mirror.host, count)
+                        crc = zlib.crc32(data, crc)
+                        if hasher is not None:
+                            hasher.feed(offset, data)  # 正好接在已计算的部分后面时，直接在内存中计算哈希值
+                        if segment.pos > segment.stop:  # 自己的部分已经写完 (被拆分时会提前结束，剩余的响应体由 transport.close() 处理)
+                            break
+            else:  # 写入映射区 (或 pwrite)，不需要每个范围都打开文件、seek()；写入时可能因为缺页或脏页回写而阻塞，所以在 I/O 线程中执行
+                pending_size = 0
+                async for chunk in transport.chunks(r, READ_BUFFER_SIZE):
+                    if throttle is not None:
+                        await throttle.consume_async(len(chunk))
+                    _, count = splitter.claim(segment, len(chunk))  # pending 中的字节是连续的，从 written 开始
+                    pending.append(chunk if count == len(chunk) else chunk[:count])
+                    pending_size += count
+                    metrics.transferred(mirrors.name, mirror.host, count)
+                    if pending_size >= WRITE_BATCH_SIZE:
+                        await _flush()
+                        pending_size = 0
+                    if segment.pos > segment.stop:
+                        break
+                await _flush()
+            metrics.observe('part_write_seconds', write_time, file=mirrors.name)
+
+            if splitter.aborted:  # 其它范围发现远程文件变化了，此文件已下载的部分都会被丢弃，不需要再记录
+                return {
+                    'changed': True,
+                    'failed': True
+                }
+            if segment.pos <= segment.stop:  # 突然网络故障了，连接被服务器强制关闭了，此时客户端读取的响应体的长度不足
+                raise ValueError('received {} bytes'.format(segment.pos - start))
+
+            stop = segment.stop  # 被拆分后 stop 会变小
+            await io_executor.run(_save_range, writer, journal, hasher, metrics, mirrors.name, start, stop, crc)  # 如果填上了缺口，hasher 要从临时文件读回后面已完成的范围
+
+            # 此范围的信息
+            part = {
+                'ETag': etag,
+                'Last-Modified': last_modified,
+                'Start': start,
+                'Stop': stop,
+                'Size': stop - start + 1
+            }
+
+            elapsed = time.time() - t0
+            metrics.observe('part_transfer_seconds', elapsed - ttfb, host=mirror.host)
+            if logger.isEnabledFor(logging.DEBUG):  # 每个范围都会执行，日志级别高于 DEBUG 时连参数都不用计算
+                logger.debug('[%s] [Range: bytes=%s-%s] downloaded', temp_filename.strip('.swp'), start, stop)
+            return {
+                'part': part,
+                'ttfb': ttfb,
+                'elapsed': elapsed,
+                'failed': False  # 用于告知 _fetchByRange() 的调用方，此 Range 成功下载
+            }
+        finally:
+            await transport.close(r)  # 提前结束时 HTTP/1.1 的连接会被关闭，HTTP/2 见 HttpxTransport.close()
+    except Exception as e:
+        logger.error('[%s] [Range: bytes=%s-%s] download failed, the reason is that %s', temp_filename.strip('.swp'), start, segment.stop, _reason(e))
+        # 已经写入的前半部分仍然有效，记录下来，重试时只需要下载剩下的字节
+        try:
+            await _flush()  # 出错的不是写入时，把还没有写入的字节写完
+        except Exception:
+            pass
+        splitter.unclaim(segment, written)  # 只记录真正写入了临时文件的字节，其余的由重试重新下载
+        size = written - start
+        if size > 0:
+            try:
+                await io_executor.run(_save_range, writer, journal, hasher, metrics, mirrors.name, start, written - 1, crc)
+            except Exception:
+                size = 0
+        return {
+            'saved': size,  # 已保存的字节数
+            'failed': True  # 用于告知 _fetchByRange() 的调用方，此 Range 下载失败了
+        }
+
+
+def _save_range(writer, journal, hasher, metrics, name, start, stop, crc):
+    '''[start, stop] 已经全部写入临时文件后调用 (在 I/O 线程中执行): 计算哈希值、按照 mmap 的同步策略让数据落盘，再向配置文件追加一条记录'''
+    if hasher is not None:
+        hasher.done(start, stop)
+    with metrics.timer('journal_seconds', file=name):
+        if writer is not None:
+            writer.flush_range(start, stop)
+        journal.append(start, stop, crc)
+
+
+async def _fetchByRangeWithRetry(fetch, budget, mirrors, metrics, splitter, official_filename, max_attempts, segment, mirror, first_fetch=None):
+    '''调用 fetch() 从 mirror 下载一个范围，失败后按带随机抖动的指数退避重试 (只重试还没有下载的字节)，最多尝试 max_attempts 次
+    第一次尝试所用的镜像和连接名额由调用方申请，每次尝试结束后都归还；退避期间不占用名额，重试时重新选择镜像、排队申请，其它范围可以继续下载
+    first_fetch: 第一次尝试时代替 fetch() (例如直接读取探测请求的响应体)
+    远程文件变化时 (结果中 changed 为 True) 不再重试；镜像被丢弃时马上从其它镜像重新下载，不算一次失败
+    返回最后一次的结果，saved 为之前失败的尝试中已经保存的字节数
+    '''
+    saved = 0
+    attempt = 0  # 已经失败的次数
+    while True:
+        if mirror is None:
+            mirror = mirrors.pick()
+            await budget.acquire(official_filename, mirror.host)
+        try:
+            result = await (first_fetch or fetch)(segment, mirror)
+        finally:
+            await budget.release(official_filename, mirror.host)
+            mirrors.release(mirror)
+        splitter.done(segment)
+        saved += result.get('saved', 0)
+        if not result.get('failed'):
+            mirrors.record(mirror, result.get('part')['Size'], result.get('elapsed'), result.get('ttfb'))
+        elif not result.get('dropped'):
+            mirrors.fail(mirror)
+            metrics.inc('part_errors_total', host=mirror.host)
+            attempt += 1
+        if not result.get('failed') or result.get('changed') or attempt == max_attempts:
+            result['saved'] = saved
+            return result
+        if segment.pos > segment.stop:  # 出错之前已经写入并记录了剩下的所有字节 (例如出错后补写了缓冲中的字节)，不需要再请求
+            return {
+                'part': {'Size': 0},
+                'ttfb': 0.0,
+                'elapsed': 0.0,
+                'saved': saved,
+                'failed': False
+            }
+        first_fetch, mirror = None, None
+        if not result.get('dropped'):
+            delay = backoff_delay(attempt - 1)
+            logger.warning('[%s] [Range: bytes=%s-%s] will be retried in %.2f seconds (attempt %s/%s)', official_filename, segment.pos, segment.stop, delay, attempt + 1, max_attempts)
+            metrics.inc('retries_total', file=official_filename)
+            await asyncio.sleep(delay)
+        if splitter.aborted:  # 退避期间其它范围发现远程文件变化了
+            result['saved'] = saved
+            return result
+        segment = splitter.track(segment.pos, segment.stop)
+
+
+async def _probe(transport, url, start, multipart_chunksize, if_range=None):
+    '''用 GET 请求从 start 开始的一个范围作为探测请求，只等到收到响应头，返回 (响应, 首字节时间)，请求失败时抛出异常
+    if_range: 上次记录的 ETag，远程文件变化时服务器会忽略 Range 返回整个文件 (200)
+    '''
+    t0 = time.time()
+    headers = {'Range': 'bytes=%d-%d' % (start, start + multipart_chunksize - 1)}
+    if if_range:
+        headers['If-Range'] = if_range
+    r = await transport.get(url, headers)  # 响应体留到后面再读
+    ttfb = time.time() - t0
+    try:
+        r.raise_for_status()
+    except Exception:
+        await transport.close(r)
+        raise
+    return r, ttfb
+
+
+def _file_size(filename):
+    '''文件存在时返回它的大小，否则返回 None'''
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return None
+
+
+def _remove(*filenames):
+    '''删除存在的文件'''
+    for filename in filenames:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def _finish(temp_filename, official_filename, config_filename):
+    '''整个文件内容被成功下载后，将临时文件名修改回正式文件名、删除配置文件'''
+    os.rename(temp_filename, official_filename)
+    _remove(config_filename)
+
+
+def _prepare_temp(temp_filename, config_filename, file_size, ETag, verify):
+    '''检查上次运行留下的临时文件和配置文件 (在 I/O 线程中执行)，返回 (本次需要下载的字节范围, 以追加模式打开的 PartJournal)
+    临时文件或配置文件无效时删除临时文件，重新分配临时文件并创建配置文件，预分配失败时抛出 OSError
+    '''
+    # 如果临时文件存在
+    if os.path.exists(temp_filename):
+        if os.path.getsize(temp_filename) != file_size:  # 说明此临时文件有问题，需要先删除它
+            os.remove(temp_filename)
+        else:  # 临时文件有效时
+            if not os.path.exists(config_filename):  # 如果不存在配置文件时
+                os.remove(temp_filename)
+            else:  # 如果配置文件也在，则继续判断 ETag 是否一致
+                header, records = load_journal(config_filename)
+                if not header or header['ETag'] != ETag:  # 配置文件无效或 ETag 不一致
+                    os.remove(temp_filename)
+                else:  # 从配置文件中读取已下载的字节范围 (verify 为 True 时在线程池中校验，丢弃 CRC32 不一致的范围)，从而得出未下载的字节范围 (各范围的大小不固定，不再按分块号计算)
+                    ranges = checked_ranges(temp_filename, records, verify)
+                    holes = missing_ranges(ranges, file_size)  # 本次需要下载的字节范围
+                    journal = PartJournal(config_filename)  # 以追加模式继续记录
+
+    # 再次判断临时文件在不在，如果不存在时，表示要下载整个文件
+    if not os.path.exists(temp_filename):
+        holes = [(0, file_size - 1)]
+
+        # 由于 _fetchByRange() 中使用 rb+ 模式，必须先保证文件存在，所以要先创建指定大小的临时文件 (用0填充，真正分配磁盘空间)
+        preallocate(temp_filename, file_size)  # 磁盘空间不足时抛出 OSError (ENOSPC)
+
+        journal = PartJournal.create(config_filename, {'ETag': ETag})  # 创建配置文件，写入 ETag
+
+    return holes, journal
+
+
+async def fetch_file(transport, url, dest_filename=None, multipart_chunksize=8*1024*1024, writer_mode='aiofiles', mmap_flush='close', disk_space=None, max_attempts=MAX_ATTEMPTS, budget=None, throttle=None, checksum=None, verify=False, cache=None, mirror_urls=None, io_executor=None, metrics=None, restarts=0):
+    '''下载单个大文件，临时文件和配置文件 (.swp、.swp.cfg) 与 8-spider.py 完全相同，可以互相续传
+    transport: AiohttpTransport 或 HttpxTransport，同一个会话/客户端的所有请求共享它的连接池
+    writer_mode: 写入临时文件的方式，'aiofiles'、'mmap' 或 'pwrite'
+    mmap_flush: writer_mode 为 'mmap' 时的同步策略，'part'、'close' 或 'none'
+    disk_space: 所有文件共享的 DiskSpace 磁盘空间预算
+    max_attempts: 每个分块最多尝试下载的次数，失败后按指数退避重试
+    budget: 所有文件共享的 AsyncConnectionBudget 连接预算，每个范围发出请求之前都要先申请一个连接名额
+    throttle: 此文件的 FileThrottle 限速器 (全局限速 + 此文件的限速)，为 None 时不限速
+    checksum: (算法, 期望的十六进制哈希值)，例如 ('sha256', '...')，边下载边计算，一致时才改为正式文件名
+    verify: 续传前是否并行校验已下载范围的 CRC32，校验失败的范围重新下载
+    cache: 所有文件共享的 ProbeCache 探测结果缓存，为 None 时每次都发探测请求
+    mirror_urls: 同一个文件的其它下载地址，与 url 一起分担各个范围，探测请求只发给 url
+    io_executor: 所有文件共享的 IOExecutor，所有阻塞的文件系统操作 (临时文件、配置文件、探测结果缓存) 都在它的线程中执行，为 None 时只给此文件创建一个
+    metrics: 所有文件共享的 Metrics 运行指标，为 None 时只统计此文件
+    restarts: 因为远程文件在下载过程中变化而重新开始下载的次数
+    下载成功 (或者之前已经下载完成) 时返回正式文件名，失败时返回 None
+    '''
+    if io_executor is None:  # 没有共享的 I/O 线程池时为此文件单独创建一个，下载结束 (包括重新开始的下载) 后关闭它
+        io_executor = IOExecutor()
+        try:
+            return await fetch_file(transport, url, dest_filename, multipart_chunksize, writer_mode, mmap_flush, disk_space, max_attempts, budget, throttle, checksum, verify, cache, mirror_urls, io_executor, metrics, restarts)
+        finally:
+            io_executor.shutdown()
+    t0 = time.time()
+
+    # 如果没有指定本地保存时的文件名，则默认使用 URL 中最后一部分作为文件名
+    official_filename = dest_filename if dest_filename else url.split('/')[-1]  # 正式文件名
+    temp_filename = official_filename + '.swp'  # 没下载完成时，临时文件名
+    config_filename = official_filename + '.swp.cfg'  # 没下载完成时，存储 ETag 等信息的配置文件名
+
+    # 探测结果的缓存还有效时，已经下载完成的文件只需要在本地比较大小，不发任何请求
+    cached = cache.get(url) if cache is not None else None
+    official_size = await io_executor.run(_file_size, official_filename)  # 正式文件不存在时为 None
+    if cached is not None and official_size is not None:
+        if official_size == cached['Size']:
+            logger.warning('The file [%s] has already been downloaded', official_filename)
+            return official_filename
+        logger.warning('The filename [%s] has already exist, but it does not match the remote file', official_filename)
+        return
+
+    # 探测请求也要占用一个连接 (它的响应体就是第一个范围)，所以发出之前先从连接预算申请名额，作为第一个范围的名额
+    # 否则文件数多于连接数时，所有文件的探测请求都占着连接，又都在等待名额，谁也拿不到
+    if metrics is None:
+        metrics = Metrics()
+    if budget is None:
+        budget = AsyncConnectionBudget(metrics=metrics)
+    probe_host = urlsplit(url).netloc
+    await budget.acquire(official_filename, probe_host)
+    probe_slot = True  # 探测请求的名额还没有交给第一个范围，也还没有归还
+    reserved = 0  # 从磁盘空间预算中预留的字节数，此文件结束 (无论成功与否) 时归还
+    try:
+        # 只发一个探测请求: 直接用 GET 请求第一个范围，同时得到文件的大小、ETag 以及是否支持 Range 下载，不再先发两个 HEAD 请求
+        # 支持 Range 下载时返回 206，Content-Range 中包含文件的总大小，响应体就是第一个范围的数据，之后交给下载协程读取
+        # 不支持时返回 200，响应体就是整个文件
+        # 缓存有效且上次运行留下了临时文件时，直接请求第一个还没有下载的范围，并用 If-Range 让服务器确认文件没有变化 (变化了会返回 200)
+        probe_start, if_range = 0, None
+        if cached is not None and cached['Ranges'] and not cached['ETag'].startswith('W/'):  # If-Range 只能使用强 ETag
+            offset = await io_executor.run(resume_offset, temp_filename, config_filename, cached['Size'], cached['ETag'])
+            if offset is not None:
+                probe_start, if_range = offset, cached['ETag']
+        probe = None
+        try:
+            probe, probe_ttfb = await _probe(transport, url, probe_start, multipart_chunksize, if_range)
+            if if_range and transport.status(probe) == 200:  # 远程文件已经变化，之前下载的部分都作废了，从头重新探测
+                await transport.close(probe)
+                logger.warning('The remote file [%s] has changed, it will be downloaded again', url)
+                await io_executor.run(cache.invalidate, url)
+                await io_executor.run(_remove, temp_filename, config_filename)
+                probe = None
+                probe_start = 0
+                probe, probe_ttfb = await _probe(transport, url, probe_start, multipart_chunksize)
+            probe_ranges = transport.status(probe) == 206  # 是否支持 Range 下载
+            if probe_ranges:
+                probe_start, probe_stop, file_size = parse_content_range(probe.headers['Content-Range'])  # 探测范围实际的结束位置 (文件小于 multipart_chunksize 时就是最后一个字节)
+            else:
+                file_size = int(probe.headers['Content-Length'])
+            ETag = probe.headers['ETag']
+            logger.debug('[%s] file size: %s bytes, ETag: %s, protocol: %s', official_filename, file_size, ETag, transport.http_version(probe))
+        except Exception as e:
+            if probe is not None:
+                await transport.close(probe)
+            logger.error('Failed to get header message on URL [%s], the reason is that %s', url, _reason(e))
+            return
+        if cache is not None:
+            await io_executor.run(cache.put, url, file_size, ETag, probe.headers.get('Last-Modified'), probe_ranges)  # 可能会写入缓存文件
+
+        # 如果正式文件存在
+        if official_size is not None:
+            await transport.close(probe)  # 不需要探测请求的响应体了，关闭连接
+            if official_size == file_size:  # 且大小与待下载的目标文件大小一致时
+                logger.warning('The file [%s] has already been downloaded', official_filename)
+                return official_filename
+            else:  # 大小不一致时，提醒用户要保存的文件名已存在，需要手动处理，不能随便覆盖
+                logger.warning('The filename [%s] has already exist, but it does not match the remote file', official_filename)
+                return
+
+        # 检查磁盘剩余空间，所有文件共享同一个预算，所有文件加起来空间不够时尽早失败，而不是下载了几个 GB 之后才发现
+        if disk_space is not None:
+            needed = 0 if await io_executor.run(_file_size, temp_filename) == file_size else file_size  # 大小正确的临时文件已经分配过空间了
+            if not await io_executor.run(disk_space.reserve, temp_filename, needed):
+                await transport.close(probe)
+                logger.error('Not enough disk space to download [%s], %s bytes needed', official_filename, needed)
+                return
+            reserved = needed
+
+        try:
+            if not probe_ranges:  # 不支持 Range 下载时
+                logger.warning('The file [%s] does not support breakpoint retransmission', official_filename)
+                # 需要重新从头开始下载 (wb 模式)，探测请求的响应体就是整个文件
+                hasher = StreamingHasher(temp_filename, file_size, checksum[0]) if checksum else None
+                with tqdm(total=file_size, unit='B', unit_scale=True, unit_divisor=1024, desc=official_filename) as bar:  # 打印下载时的进度条，并动态显示下载速度
+                    try:
+                        async with aiofiles.open(temp_filename, 'wb', executor=io_executor.executor) as fp:
+                            async for chunk in transport.chunks(probe, multipart_chunksize):
+                                if throttle is not None:
+                                    await throttle.consume_async(len(chunk))
+                                if hasher is not None:
+                                    hasher.feed(bar.n, chunk)  # 顺序下载，bar.n 就是此 chunk 的偏移
+                                await fp.write(chunk)
+                                bar.update(len(chunk))
+                    except Exception as e:
+                        logger.error('Failed to get all content on URL [%s], the reason is that %s', url, _reason(e))
+                        return
+                    finally:
+                        await transport.close(probe)
+                if bar.n != file_size:  # 连接提前断开了
+                    logger.error('Failed to get all content on URL [%s], received %s of %s bytes', url, bar.n, file_size)
+                    return
+                if hasher is not None and not await io_executor.run(hasher.verify, checksum[1]):  # 哈希值不一致，下载的内容有误，删除临时文件
+                    await io_executor.run(_remove, temp_filename)
+                    return
+                # 整个文件内容被成功下载后，将临时文件名修改回正式文件名、删除配置文件
+                await io_executor.run(_finish, temp_filename, official_filename, config_filename)
+                logger.debug('%s downloaded', official_filename)
+                logger.debug('Cost %.2f seconds', time.time() - t0)
+                return official_filename
+            else:  # 支持 Range 下载时
+                # 检查上次运行留下的临时文件和配置文件 (verify 为 True 时校验已下载范围的 CRC32)，或者分配新的临时文件，得出本次需要下载的字节范围
+                try:
+                    holes, journal = await io_executor.run(_prepare_temp, temp_filename, config_filename, file_size, ETag, verify)
+                except OSError as e:  # 例如磁盘空间不足 (ENOSPC)
+                    await transport.close(probe)
+                    logger.error('Failed to preallocate [%s], the reason is that %s', temp_filename, e)
+                    return
+
+                succeed_parts_size = file_size - sum([stop - start + 1 for start, stop in holes])  # 已下载的总大小
+
+                # 边下载边计算哈希值，之前已经下载的范围 (holes 的补集) 等到前面的缺口被填上时再从临时文件读回
+                hasher = None
+                if checksum:
+                    hasher = StreamingHasher(temp_filename, file_size, checksum[0])
+                    for start, stop in missing_ranges(holes, file_size):
+                        hasher.mark_done(start, stop)
+                logger.debug('[%s] The remaining ranges that need to be downloaded: %s', official_filename, holes)
+
+                # 探测请求的响应体就是 [probe_start, probe_stop]，如果这部分正好是第一个还没有下载的范围的开头，就把它当作第一个范围，不用再请求一次；否则直接关闭
+                if holes and holes[0][0] == probe_start and holes[0][1] >= probe_stop:
+                    holes[0] = (probe_stop + 1, holes[0][1])
+                    if holes[0][0] > holes[0][1]:
+                        holes.pop(0)
+                else:
+                    await transport.close(probe)
+                    probe = None
+                    probe_slot = False
+                    await budget.release(official_filename, probe_host)  # 先归还探测请求的名额，下面切出的范围重新申请
+
+                # 并发请求数量由所有文件共享的连接预算限制 (总数、每个 host 的上限以及文件之间的公平分配)，不再是每个文件各自一个信号量
+                # 可选的镜像: 每个范围按各镜像测得的吞吐量选择从哪里下载，每个镜像的 host 各自受连接数上限的约束
+                mirrors = MirrorSet(official_filename, url, ETag, file_size, mirror_urls)
+
+                # 拿到连接名额时才切出下一个范围，范围的大小由 AdaptiveSplitter 根据测得的吞吐量和 RTT 决定，multipart_chunksize 只是初始大小
+                splitter = AdaptiveSplitter(holes, multipart_chunksize, min(budget.max_connections, budget.max_per_host * len(mirrors.hosts)), steal=transport.steal)
+
+                # 所有范围共享同一个内存映射 (mmap) 或文件描述符 (pwrite)
+                writer = None if writer_mode == 'aiofiles' else await io_executor.run(open_writer, temp_filename, writer_mode, mmap_flush)
+
+                # 固定住 transport、io_executor、temp_filename、writer、journal、splitter、throttle、hasher、mirrors、metrics，不用每次都传入相同的参数
+                _fetchByRange_partial = partial(_fetchByRange, transport, io_executor, temp_filename, writer, journal, splitter, throttle, hasher, mirrors, metrics)
+                _fetchByRangeWithRetry_partial = partial(_fetchByRangeWithRetry, _fetchByRange_partial, budget, mirrors, metrics, splitter, official_filename, max_attempts)
+
+                to_do = set()  # 正在下载的任务
+                failed_parts = 0  # 下载失败的范围数目
+                changed = False  # 远程文件是否在下载过程中变化了
+                with tqdm(total=file_size, initial=succeed_parts_size, unit='B', unit_scale=True, unit_divisor=1024, desc=official_filename) as bar:  # 打印下载时的进度条，并动态显示下载速度
+                    if probe is not None:  # 第一个范围直接读取探测请求的响应体
+                        mirror = mirrors.pick(mirrors.primary)
+                        probe_slot = False  # 探测请求的名额交给第一个范围，由 _fetchByRangeWithRetry() 归还
+                        first_fetch = partial(_fetchByRange_partial, r=probe, ttfb=probe_ttfb)
+                        to_do.add(asyncio.create_task(_fetchByRangeWithRetry_partial(splitter.track(probe_start, probe_stop), mirror, first_fetch=first_fetch)))
+
+                    while True:
+                        # 还能切出新的范围时，先从全局预算申请一个连接名额；全部分配完以后，拿到的名额会拆走正在下载的最大范围的后半部分
+                        while splitter.has_work():
+                            mirror = mirrors.pick()
+                            await budget.acquire(official_filename, mirror.host)
+                            segment = splitter.next_range()
+                            if segment is None:  # 等待名额期间剩下的字节已经被其它范围下载完了
+                                await budget.release(official_filename, mirror.host)
+                                mirrors.release(mirror)
+                                break
+                            to_do.add(asyncio.create_task(_fetchByRangeWithRetry_partial(segment, mirror)))
+
+                        if not to_do:
+                            break
+
+                        done, to_do = await asyncio.wait(to_do, return_when=asyncio.FIRST_COMPLETED)
+                        for future in done:
+                            result = future.result()
+                            bar.update(result.get('saved'))  # 失败的尝试中已经保存的字节
+                            if result.get('changed'):  # 远程文件变化了 (splitter 已经放弃了剩下的字节)
+                                changed = True
+                            elif result.get('failed'):
+                                failed_parts += 1
+                                metrics.inc('failed_parts_total', file=official_filename)
+                            else:
+                                bar.update(result.get('part')['Size'])
+                                splitter.record(result.get('part')['Size'], result.get('elapsed'), result.get('ttfb'))
+
+                if writer is not None:
+                    await io_executor.run(writer.close)  # mmap 的同步策略为 close 时，这里会把所有脏页写回磁盘
+                await io_executor.run(journal.close)
+
+                if changed:  # 删除配置文件，从头探测并重新下载整个文件 (临时文件会被重新分配)，而不是把新旧两个版本拼接在一起
+                    await io_executor.run(_remove, config_filename)
+                    if cache is not None:
+                        await io_executor.run(cache.invalidate, url)
+                    if restarts >= MAX_RESTARTS:  # 已经重新开始了 MAX_RESTARTS 次
+                        logger.error('Failed to download %s, the remote file keeps changing', official_filename)
+                        return
+                    logger.warning('The remote file [%s] has changed during downloading, it will be downloaded again', url)
+                    metrics.inc('restarts_total', file=official_filename)
+                    return await fetch_file(transport, url, dest_filename, multipart_chunksize, writer_mode, mmap_flush, disk_space, max_attempts, budget, throttle, checksum, verify, cache, mirror_urls, io_executor, metrics, restarts + 1)
+                elif failed_parts > 0:
+                    logger.error('Failed to download %s, failed ranges: %s', official_filename, failed_parts)
+                elif hasher is not None and not await io_executor.run(hasher.verify, checksum[1]):  # 哈希值不一致，删除临时文件和配置文件，下次重新下载
+                    await io_executor.run(_remove, temp_filename, config_filename)
+                else:
+                    # 整个文件内容被成功下载后，将临时文件名修改回正式文件名、删除配置文件
+                    await io_executor.run(_finish, temp_filename, official_filename, config_filename)
+                    logger.debug('%s downloaded', official_filename)
+                    logger.debug('Cost %.2f seconds', time.time() - t0)
+                    return official_filename
+
+        except Exception as e:
+            logger.error('Failed to download [%s], the reason is that %s', official_filename, _reason(e))
+            return
+    finally:
+        if probe_slot:
+            await budget.release(official_filename, probe_host)
+        if reserved:
+            await io_executor.run(disk_space.release, temp_filename, reserved)
@@ -0,0 +1,302 @@
+'''可重复的本地基准测试: 不依赖 config.json 中的远程服务器，比较各个下载器在不同参数下的性能
+
+在另一个进程中启动一个本地服务器 (aiohttp 的静态文件，带 ETag，支持 Range、206 和 If-Range；--no_range 时忽略 Range，总是返回完整的 200)，
+--h2 时改用 hypercorn 的源站 (fault_server.py 中不注入故障的 FaultInjector，同一个端口上支持 HTTP/1.1 和明文 HTTP/2)，10-spider.py 通过 h2c 下载，
+生成指定大小的随机测试文件，然后按下面的矩阵运行每个下载器，每种组合重复 rounds 次，取耗时最短的一次:
+    下载器 (--engine) x 模式 (--mode，只有 4/9-spider.py 有 fast_loop) x 文件大小 (--size) x 文件数 (--files) x 分段大小 (--chunk_size) x 连接数 (--workers)
+其中连接数只对可以配置 max_connections 的 8/9/10-spider.py 有效，其它下载器的并发数是写死的，不重复运行
+1/2/5/6/7-spider.py 每次只下载一个 URL，多个文件时依次运行，资源占用累加 (峰值内存取最大值)
+
+每种组合输出一条结果 (--json 时为 JSON lines，--output 时追加到文件)，带上 git 提交，方便比较不同提交的性能:
+    吞吐量 (MB/s)、每 GB 消耗的 CPU 时间 (下载器进程的用户态 + 内核态时间，不包括服务器)、峰值内存 (RSS)、
+    上下文切换次数、read/write 类系统调用的次数 (来自 /proc/<pid>/io 的 syscr/syscw，内核不统计 socket 的 recv/send，
+    所以基本上是读写文件的次数，只有 Linux 上有)
+
+用法: python benchmark.py --engine 8-spider.py --engine 9-spider.py --size 256M --files 1 --files 4 --chunk_size 1M --chunk_size 8M --workers 4 --workers 16 --json
+      python benchmark.py --h2 --engine 9-spider.py --engine 10-spider.py --files 4
+'''
+import atexit
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import click
+from aiohttp import web
+
+
+# 本进程、服务器进程和下载器子进程 (继承环境变量) 的日志都写入临时目录，退出时删除，不留在仓库的 logs/ 中
+# 必须在导入 logger (throttle 会导入它) 之前设置；已经设置了 SPIDER_LOG_DIR 时使用它并保留日志
+if not os.environ.get('SPIDER_LOG_DIR'):
+    os.environ['SPIDER_LOG_DIR'] = tempfile.mkdtemp(prefix='bench-logs-')
+    atexit.register(shutil.rmtree, os.environ['SPIDER_LOG_DIR'], ignore_errors=True)
+
+from throttle import parse_rate
+
+
+BASEDIR = os.path.abspath(os.path.dirname(__file__))
+ENGINES = ('1-spider.py', '2-spider.py', '3-spider.py', '4-spider.py', '5-spider.py', '6-spider.py', '7-spider.py', '8-spider.py', '9-spider.py')  # 10-spider.py 需要 httpx，可以用 --engine 指定
+URL_ENGINES = ('1-spider.py', '2-spider.py', '5-spider.py', '6-spider.py', '7-spider.py')  # 命令行参数是单个 URL，其它的读取 config.json
+WORKERS_ENGINES = ('8-spider.py', '9-spider.py', '10-spider.py')  # config.json 中的 max_connections 有效
+FAST_LOOP_ENGINES = ('4-spider.py', '9-spider.py')  # 有 --fast_loop 选项
+MODES = ('default', 'fast_loop')
+
+
+def _serve(root, port, no_range, h2=False):
+    '''服务器进程: 把 root 目录作为静态文件提供下载，支持 Range 和 If-Range；no_range 为 True 时不处理 Range，模拟不支持断点续传的服务器
+    h2 为 True 时使用 fault_server.py 的 hypercorn 源站 (不注入故障)，同时支持 HTTP/1.1 和 h2c
+    '''
+    if h2:
+        from fault_server import serve  # fault_server.py 导入了本模块，不能在模块级别导入
+        return serve(root, port, h2=True, no_range=no_range)
+
+    async def handle(request):
+        path = os.path.join(root, os.path.basename(request.match_info['name']))
+        if not os.path.isfile(path):
+            raise web.HTTPNotFound()
+        if no_range:
+            return await _whole_file(request, path)
+        return web.FileResponse(path, chunk_size=1024 * 1024)
+
+    async def _whole_file(request, path):
+        '''不看 Range 和 If-Range，总是以 200 流式返回完整的文件 (FileResponse 总会处理 Range，所以自己发送)'''
+        st = os.stat(path)
+        resp = web.StreamResponse(headers={'ETag': '"{:x}-{:x}"'.format(st.st_mtime_ns, st.st_size), 'Accept-Ranges': 'none'})
+        resp.content_length = st.st_size
+        resp.last_modified = st.st_mtime
+        await resp.prepare(request)
+        if request.method != 'HEAD':
+            with open(path, 'rb') as fp:  # 测试用的文件在页缓存中，直接在事件循环中读取
+                for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+                    await resp.write(chunk)
+        await resp.write_eof()
+        return resp
+
+    app = web.Application()
+    app.router.add_get('/{name}', handle)  # add_get() 同时处理 HEAD
+    web.run_app(app, host='127.0.0.1', port=port, print=None, access_log=None)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_port(port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('The benchmark server did not start on port {}'.format(port))
+
+
+def make_file(path, size):
+    '''生成 size 字节的随机内容 (不可压缩)，每次写入 1 MB'''
+    with open(path, 'wb') as fp:
+        left = size
+        while left > 0:
+            n = min(left, 1024 * 1024)
+            fp.write(os.urandom(n))
+            left -= n
+
+
+def _make_files(root, size, count):
+    '''返回 count 个大小为 size 的测试文件名，它们都是同一个随机文件的硬链接，只生成一次'''
+    source = 'bench-{}.bin'.format(size)
+    if not os.path.exists(os.path.join(root, source)):
+        make_file(os.path.join(root, source), size)
+    names = []
+    for i in range(count):
+        name = 'bench-{}-{}.bin'.format(size, i)
+        if not os.path.exists(os.path.join(root, name)):
+            os.link(os.path.join(root, source), os.path.join(root, name))
+        names.append(name)
+    return names
+
+
+def _proc_io(pid):
+    '''读取 /proc/<pid>/io (进程退出后、被回收之前也能读取)，不是 Linux 时返回空字典'''
+    try:
+        with open('/proc/{}/io'.format(pid), 'r') as fp:
+            return {k: int(v) for k, v in (line.split(':') for line in fp if ':' in line)}
+    except OSError:
+        return {}
+
+
+def _run_process(args, workdir):
+    '''运行一个下载器进程，返回 (耗时秒数, rusage, /proc/<pid>/io)，下载器失败时抛出 RuntimeError'''
+    with tempfile.TemporaryFile() as stderr:
+        t0 = time.time()
+        proc = subprocess.Popen(args, cwd=workdir, stdout=subprocess.DEVNULL, stderr=stderr)
+        if hasattr(os, 'waitid'):  # 先等它退出但不回收，这时还能读取它的 /proc/<pid>/io
+            os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        io = _proc_io(proc.pid)
+        _, status, rusage = os.wait4(proc.pid, 0)  # 只统计这个子进程的资源占用
+        elapsed = time.time() - t0
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if proc.returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError('{} exited with {}: {}'.format(' '.join(args[1:]), proc.returncode, stderr.read().decode(errors='replace')[-2000:]))
+    return elapsed, rusage, io
+
+
+def run_once(engine, mode, urls, chunk_size, workers, workdir, h2=False):
+    '''在 workdir 中运行一次下载器，下载 urls 中的所有文件，h2 为 True 时 10-spider.py 使用 h2c，返回这次的各项指标'''
+    if engine in URL_ENGINES:
+        commands = [[sys.executable, os.path.join(BASEDIR, engine), '--multipart_chunksize', str(chunk_size), url] for url in urls]
+    else:
+        cfg = {
+            'files': [{'url': url, 'dest_filename': None, 'multipart_chunksize': chunk_size} for url in urls],
+            'probe_cache': None,  # 每次都完整地探测和下载
+            'writer': 'pwrite',
+            'h2c': h2  # 只有 10-spider.py 读取
+        }
+        if workers:
+            cfg.update({'max_connections': workers, 'max_connections_per_host': workers})
+        with open(os.path.join(workdir, 'config.json'), 'w') as fp:  # 3-spider.py 没有 --config 选项，只读取当前目录下的 config.json
+            json.dump(cfg, fp)
+        command = [sys.executable, os.path.join(BASEDIR, engine)]
+        if mode == 'fast_loop':
+            command.append('--fast_loop')
+        commands = [command]
+
+    metrics = {'seconds': 0.0, 'cpu_seconds': 0.0, 'peak_rss_kb': 0, 'voluntary_ctx_switches': 0, 'involuntary_ctx_switches': 0, 'read_syscalls': None, 'write_syscalls': None}
+    for command in commands:
+        elapsed, rusage, io = _run_process(command, workdir)
+        metrics['seconds'] += elapsed
+        metrics['cpu_seconds'] += rusage.ru_utime + rusage.ru_stime
+        metrics['peak_rss_kb'] = max(metrics['peak_rss_kb'], rusage.ru_maxrss)  # Linux 上单位是 KB
+        metrics['voluntary_ctx_switches'] += rusage.ru_nvcsw
+        metrics['involuntary_ctx_switches'] += rusage.ru_nivcsw
+        if io:
+            metrics['read_syscalls'] = (metrics['read_syscalls'] or 0) + io['syscr']
+            metrics['write_syscalls'] = (metrics['write_syscalls'] or 0) + io['syscw']
+    return metrics
+
+
+def _clean(workdir):
+    '''删除上一次下载的文件 (包括没有下载完成的临时文件和配置文件)'''
+    for name in os.listdir(workdir):
+        path = os.path.join(workdir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def _check(workdir, names, size):
+    '''下载器即使失败也可能以 0 退出，所以检查每个文件是否都下载完整了'''
+    for name in names:
+        path = os.path.join(workdir, name)
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            raise RuntimeError('[{}] was not downloaded completely'.format(name))
+
+
+def _commit():
+    '''当前的 git 提交 (有未提交的修改时带 -dirty 后缀)，不是 git 仓库时返回 None'''
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=BASEDIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def matrix(engines=ENGINES, modes=MODES, sizes=(64 * 1024 * 1024,), file_counts=(1,), chunk_sizes=(8 * 1024 * 1024,), worker_counts=(8,)):
+    '''展开所有要运行的组合，不支持某个维度的下载器在这个维度上只运行一次 (值为 None)'''
+    for engine in engines:
+        engine_modes = modes if engine in FAST_LOOP_ENGINES else ('default',)
+        engine_workers = worker_counts if engine in WORKERS_ENGINES else (None,)
+        for mode, size, file_count, chunk_size, workers in itertools.product(engine_modes, sizes, file_counts, chunk_sizes, engine_workers):
+            yield engine, mode, size, file_count, chunk_size, workers
+
+
+def benchmark(combinations, rounds=3, no_range=False, h2=False):
+    '''运行 matrix() 中的每种组合 rounds 次，逐个生成结果 (取耗时最短的一次)，失败的组合只有 error 字段'''
+    root = tempfile.mkdtemp(prefix='bench-srv-')
+    workdir = tempfile.mkdtemp(prefix='bench-dl-')
+    port = free_port()
+    server = multiprocessing.Process(target=_serve, args=(root, port, no_range, h2), daemon=True)
+    common = {'commit': _commit(), 'python': platform.python_version(), 'no_range': no_range, 'h2': h2, 'rounds': rounds}
+    try:
+        server.start()
+        wait_port(port)
+        for engine, mode, size, file_count, chunk_size, workers in combinations:
+            result = dict(common, engine=engine, mode=mode, file_size=size, files=file_count, chunk_size=chunk_size, workers=workers)
+            names = _make_files(root, size, file_count)
+            urls = ['http://127.0.0.1:{}/{}'.format(port, name) for name in names]
+            try:
+                runs = []
+                for _ in range(rounds):
+                    _clean(workdir)
+                    runs.append(run_once(engine, mode, urls, chunk_size, workers, workdir, h2))
+                    _check(workdir, names, size)
+            except RuntimeError as e:
+                result['error'] = str(e)
+                yield result
+                continue
+            best = min(runs, key=lambda m: m['seconds'])
+            total = size * file_count
+            result.update(best, bytes=total)
+            result.update({
+                'seconds': round(best['seconds'], 3),
+                'mb_per_sec': round(total / best['seconds'] / 1e6, 2),
+                'cpu_seconds': round(best['cpu_seconds'], 3),
+                'cpu_seconds_per_gb': round(best['cpu_seconds'] / (total / 1e9), 3),
+                'peak_rss_mb': round(best['peak_rss_kb'] / 1024, 1)
+            })
+            yield result
+    finally:
+        if server.is_alive():
+            server.terminate()
+        server.join()
+        shutil.rmtree(root, ignore_errors=True)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _format(result):
+    '''人类可读的一行结果'''
+    label = '{engine:<12} {mode:<9} size={file_size} files={files} chunk={chunk_size} workers={workers}'.format(**result)
+    if 'error' in result:
+        return '{:<75} ERROR {}'.format(label, result['error'].splitlines()[0][:200])
+    return '{:<75} {mb_per_sec:>9.2f} MB/s {cpu_seconds_per_gb:>7.3f} CPU s/GB {peak_rss_mb:>7.1f} MB RSS {read_syscalls} reads {write_syscalls} writes'.format(label, **result)
+
+
+@click.command()
+@click.option('--engine', 'engines', multiple=True, type=click.Choice(ENGINES + ('10-spider.py',)), help="Spider to benchmark, can be repeated [default: 1-spider.py ... 9-spider.py]")
+@click.option('--mode', 'modes', multiple=True, type=click.Choice(MODES), help="Event loop mode for 4/9-spider.py, can be repeated [default: both]")
+@click.option('--size', 'sizes', multiple=True, help="Size of each test file, K/M/G suffixes are allowed, can be repeated [default: 64M]")
+@click.option('--files', 'file_counts', multiple=True, type=int, help="Number of files downloaded in one run, can be repeated [default: 1]")
+@click.option('--chunk_size', 'chunk_sizes', multiple=True, help="multipart_chunksize, K/M/G suffixes are allowed, can be repeated [default: 8M]")
+@click.option('--workers', 'worker_counts', multiple=True, type=int, help="max_connections for 8/9/10-spider.py, can be repeated [default: 8]")
+@click.option('--rounds', default=3, help="Runs per combination, the fastest one is reported")
+@click.option('--no_range', is_flag=True, help="The server ignores Range and always responds with the whole file")
+@click.option('--h2', is_flag=True, help="Serve with hypercorn (HTTP/1.1 and h2c), 10-spider.py downloads over HTTP/2")
+@click.option('--json', 'as_json', is_flag=True, help="Print the results as JSON lines")
+@click.option('--output', type=click.Path(), help="Append the results as JSON lines to this file")
+def main(engines, modes, sizes, file_counts, chunk_sizes, worker_counts, rounds, no_range, h2, as_json, output):
+    combinations = matrix(
+        engines or ENGINES,
+        modes or MODES,
+        [parse_rate(s) for s in sizes] or [64 * 1024 * 1024],
+        file_counts or [1],
+        [parse_rate(s) for s in chunk_sizes] or [8 * 1024 * 1024],
+        worker_counts or [8]
+    )
+    for result in benchmark(combinations, rounds, no_range, h2):
+        print(json.dumps(result) if as_json else _format(result), flush=True)
+        if output:
+            with open(output, 'a') as fp:
+                fp.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
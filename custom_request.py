@@ -1,39 +1,92 @@
+import threading
+from urllib.parse import urlsplit
 import requests
+from requests.adapters import HTTPAdapter
 from logger import logger
 
 
+# 按 host 复用的会话 (每个会话内部维护一个 keep-alive 连接池)，所有线程共享
+_sessions = {}
+_sessions_lock = threading.Lock()
+_pool_size = 10  # 每个 host 的连接池大小，与 requests 默认值一致
+
+
+def set_pool_size(pool_size):
+    '''设置每个 host 的连接池大小，一般与并发下载的线程数保持一致
+    需要在开始并发下载之前调用，已创建的会话会被关闭，之后按新的大小重新创建
+    '''
+    global _pool_size
+    with _sessions_lock:
+        _pool_size = max(1, pool_size)
+        for s in _sessions.values():
+            s.close()
+        _sessions.clear()
+
+
+def get_session(url):
+    '''返回 URL 所属 host 的共享会话，同一个 host 的所有请求都复用连接池中的 keep-alive 连接'''
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    with _sessions_lock:
+        s = _sessions.get(key)
+        if s is None:
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_pool_size)
+            s.mount(parts.scheme + '://', adapter)
+            _sessions[key] = s
+        return s
+
+
+def parse_content_range(value):
+    '''解析 206 响应的 Content-Range 头部 (例如 bytes 0-1023/4096)，返回 (start, stop, 文件总大小)
+    格式不对或者文件总大小未知 (bytes 0-1023/*) 时抛出 ValueError
+    '''
+    unit, _, spec = value.strip().partition(' ')
+    byte_range, _, total = spec.partition('/')
+    start, _, stop = byte_range.partition('-')
+    if unit != 'bytes':
+        raise ValueError('Unsupported Content-Range: {}'.format(value))
+    return int(start), int(stop), int(total)
+
+
+def _info(info):
+    '''把 custom_request() 的 info 参数转换为字符串'''
+    return info[0] % info[1:] if isinstance(info, tuple) else info
+
+
 def custom_request(method, url, info='common url', *args, **kwargs):
     '''捕获 requests.request() 方法的异常，比如连接超时、被拒绝等
     如果请求成功，则返回响应体；如果请求失败，则返回 None，所以在调用 custom_request() 函数时需要先判断返回值
+    请求通过 get_session() 返回的共享会话发出，从而复用已建立的 TCP/TLS 连接
+    info: 日志中对此请求的说明，也可以是 (格式, 参数...) 元组，只有请求失败、写日志时才格式化 (每个范围都会调用，成功时不用拼接字符串)
     '''
-    s = requests.session()
-    s.keep_alive = False
+    s = get_session(url)
 
     try:
-        resp = requests.request(method, url, *args, **kwargs)
+        resp = s.request(method, url, *args, **kwargs)
         resp.raise_for_status()
     except requests.exceptions.HTTPError as errh:
         # In the event of the rare invalid HTTP response, Requests will raise an HTTPError exception (e.g. 401 Unauthorized)
-        logger.error('Unsuccessfully get {} [{}], HTTP Error: {}'.format(info, url, errh))
+        logger.error('Unsuccessfully get %s [%s], HTTP Error: %s', _info(info), url, errh)
         pass
     except requests.exceptions.ConnectionError as errc:
         # In the event of a network problem (e.g. DNS failure, refused connection, etc)
-        logger.error('Unsuccessfully get {} [{}], Connecting Error: {}'.format(info, url, errc))
+        logger.error('Unsuccessfully get %s [%s], Connecting Error: %s', _info(info), url, errc)
         pass
     except requests.exceptions.Timeout as errt:
         # If a request times out, a Timeout exception is raised. Maybe set up for a retry, or continue in a retry loop
-        logger.error('Unsuccessfully get {} [{}], Timeout Error: {}'.format(info, url, errt))
+        logger.error('Unsuccessfully get %s [%s], Timeout Error: %s', _info(info), url, errt)
         pass
     except requests.exceptions.TooManyRedirects as errr:
         # If a request exceeds the configured number of maximum redirections, a TooManyRedirects exception is raised. Tell the user their URL was bad and try a different one
-        logger.error('Unsuccessfully get {} [{}], Redirect Error: {}'.format(info, url, errr))
+        logger.error('Unsuccessfully get %s [%s], Redirect Error: %s', _info(info), url, errr)
         pass
     except requests.exceptions.RequestException as err:
         # catastrophic error. bail.
-        logger.error('Unsuccessfully get {} [{}], Else Error: {}'.format(info, url, err))
+        logger.error('Unsuccessfully get %s [%s], Else Error: %s', _info(info), url, err)
         pass
     except Exception as err:
-        logger.error('Unsuccessfully get {} [{}], Exception: {}'.format(info, url, err.__class__))
+        logger.error('Unsuccessfully get %s [%s], Exception: %s', _info(info), url, err.__class__)
         pass
     else:
         return resp
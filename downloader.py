@@ -0,0 +1,215 @@
+'''可以在其它程序中导入的下载接口，不需要每次下载都启动一个 Python 进程
+
+    from downloader import download, download_many
+
+    path = download('http://example.com/big.iso').result()  # 默认使用多线程引擎 (8-spider.py)，返回 concurrent.futures.Future
+
+    async def main():
+        async with AsyncioBackend() as backend:  # 协程引擎 (9-spider.py)，返回 asyncio.Task
+            paths = await asyncio.gather(*download_many('config.json', backend=backend))
+
+每个 Future/Task 的结果是下载完成的正式文件名，下载失败时抛出 DownloadError
+同一个后端的多次调用共享线程池、连接池、连接预算、限速器、磁盘空间预算、探测结果缓存和运行指标 (backend.metrics，见 metrics.py)，长时间运行的进程应该一直使用同一个后端
+两个引擎仍然是 8-spider.py 和 9-spider.py 中的 _fetchOneFile()，这里只负责加载它们并管理这些共享的资源
+'''
+import asyncio
+import atexit
+from concurrent import futures
+import importlib.util
+import json
+import os
+import sys
+import threading
+from custom_request import set_pool_size
+from event_loop import IO_WORKERS, IOExecutor, client_session
+from hasher import expected_digest
+from metrics import Metrics
+from preallocate import DiskSpace
+from probe_cache import CACHE_TTL, ProbeCache
+from retry import MAX_ATTEMPTS
+from scheduler import MAX_CONNECTIONS, MAX_CONNECTIONS_PER_HOST, AsyncConnectionBudget, ConnectionBudget
+from throttle import BandwidthLimiter, parse_rate
+
+
+BASEDIR = os.path.abspath(os.path.dirname(__file__))
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024  # 没有指定 multipart_chunksize 时每个范围的初始大小
+MAX_FILES = 8  # 多线程引擎同时下载的文件数
+
+
+class DownloadError(Exception):
+    '''文件没有下载成功，具体原因见日志'''
+
+
+def _load_engine(filename):
+    '''加载 8-spider.py 或 9-spider.py (文件名以数字开头，不能直接 import)，同一个进程中只加载一次'''
+    name = '_engine_' + filename.split('-')[0]
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(BASEDIR, filename))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[name]
+
+
+def load_manifest(manifest):
+    '''manifest 可以是 config.json 的路径、它的内容 (包含 files 的 dict) 或者 files 列表，返回 files 列表'''
+    if isinstance(manifest, (str, os.PathLike)):
+        with open(manifest, 'r') as fp:
+            manifest = json.load(fp)
+    if isinstance(manifest, dict):
+        manifest = manifest['files']
+    return list(manifest)
+
+
+def _file_options(entry):
+    '''把 config.json 中一个文件的配置转换为 submit() 的参数'''
+    return {
+        'url': entry['url'],
+        'dest_filename': entry.get('dest_filename'),
+        'multipart_chunksize': entry.get('multipart_chunksize', MULTIPART_CHUNKSIZE),
+        'checksum': expected_digest(entry),
+        'rate_limit': entry.get('rate_limit'),
+        'mirrors': entry.get('mirrors')
+    }
+
+
+class _Backend:
+    '''两个后端共用的配置，参数名与 config.json 中的顶层字段一致 (probe_cache 为探测结果缓存文件，默认不使用缓存)'''
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_connections_per_host=MAX_CONNECTIONS_PER_HOST, rate_limit=None, writer='pwrite', mmap_flush='close', max_attempts=MAX_ATTEMPTS, verify_on_resume=False, probe_cache=None, probe_cache_ttl=CACHE_TTL):
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.limiter = BandwidthLimiter(parse_rate(rate_limit))
+        self.writer = writer
+        self.mmap_flush = mmap_flush
+        self.max_attempts = max_attempts
+        self.verify = verify_on_resume
+        self.cache = ProbeCache(probe_cache, probe_cache_ttl) if probe_cache else None
+        self.metrics = Metrics()
+
+    def submit(self, url, dest_filename=None, multipart_chunksize=MULTIPART_CHUNKSIZE, checksum=None, rate_limit=None, mirrors=None):
+        '''开始下载 url，返回 Future (ThreadBackend) 或 asyncio.Task (AsyncioBackend)，结果为正式文件名
+        checksum: (算法, 期望的十六进制哈希值)；rate_limit: 此文件的限速；mirrors: 同一个文件的其它下载地址
+        每次调用都重新读取磁盘的剩余空间，后端长期使用时不会受之前的下载影响
+        '''
+        return self._submit(DiskSpace(), url, dest_filename, multipart_chunksize, checksum, rate_limit, mirrors)
+
+    def download_many(self, manifest):
+        '''下载 manifest 中的所有文件，返回与之一一对应的 Future/Task 列表，这些文件共享同一个磁盘空间预算 (每次调用都重新读取剩余空间)'''
+        disk_space = DiskSpace()
+        return [self._submit(disk_space, **_file_options(entry)) for entry in load_manifest(manifest)]
+
+
+class ThreadBackend(_Backend):
+    '''多线程引擎 (8-spider.py)，submit() 返回 concurrent.futures.Future，可以在任何线程中调用
+    max_files: 同时下载的文件数，pool_size: 每个 host 的 keep-alive 连接池大小 (默认与每个 host 的连接数上限一致)
+    '''
+
+    def __init__(self, max_files=MAX_FILES, pool_size=None, **options):
+        super().__init__(**options)
+        self._engine = _load_engine('8-spider.py')
+        self.budget = ConnectionBudget(self.max_connections, self.max_connections_per_host, metrics=self.metrics)
+        set_pool_size(pool_size or self.budget.max_per_host)
+        self._executor = futures.ThreadPoolExecutor(max_files, thread_name_prefix='download')
+
+    def _submit(self, disk_space, url, dest_filename=None, multipart_chunksize=MULTIPART_CHUNKSIZE, checksum=None, rate_limit=None, mirrors=None):
+        throttle = self.limiter.for_file(url, parse_rate(rate_limit))
+        return self._executor.submit(self._download, url, dest_filename, multipart_chunksize, throttle, checksum, mirrors, disk_space)
+
+    def _download(self, url, dest_filename, multipart_chunksize, throttle, checksum, mirrors, disk_space):
+        filename = self._engine._fetchOneFile(url, dest_filename, multipart_chunksize, writer_mode=self.writer, mmap_flush=self.mmap_flush, disk_space=disk_space, max_attempts=self.max_attempts, budget=self.budget, throttle=throttle, checksum=checksum, verify=self.verify, cache=self.cache, mirror_urls=mirrors, metrics=self.metrics)
+        if filename is None:
+            raise DownloadError('Failed to download [{}]'.format(url))
+        return filename
+
+    def close(self):
+        '''等待所有下载结束，保存探测结果缓存'''
+        self._executor.shutdown(wait=True)
+        if self.cache is not None:
+            self.cache.save()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncioBackend(_Backend):
+    '''协程引擎 (9-spider.py)，必须在事件循环中使用，submit() 返回 asyncio.Task
+    aiohttp 会话在第一次下载时创建并绑定到当前的事件循环，用完后要调用 aclose() (或者使用 async with)
+    io_workers: 执行阻塞的文件系统操作的线程数；fast_loop: 是否使用调优过的连接池 (事件循环由调用方选择，见 event_loop.run())
+    '''
+
+    def __init__(self, io_workers=IO_WORKERS, fast_loop=False, writer='aiofiles', **options):
+        super().__init__(writer=writer, **options)  # 与 9-spider.py 一样，默认使用 aiofiles 写临时文件
+        self._engine = _load_engine('9-spider.py')
+        self.budget = AsyncConnectionBudget(self.max_connections, self.max_connections_per_host, metrics=self.metrics)
+        self.io_executor = IOExecutor(io_workers)
+        self.fast_loop = fast_loop
+        self._session = None
+        self._lock = None
+
+    async def _get_session(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._session is None:
+                self._session = client_session(self.budget.max_connections, self.budget.max_per_host, self.fast_loop)
+            return self._session
+
+    def _submit(self, disk_space, url, dest_filename=None, multipart_chunksize=MULTIPART_CHUNKSIZE, checksum=None, rate_limit=None, mirrors=None):
+        throttle = self.limiter.for_file(url, parse_rate(rate_limit))
+        return asyncio.get_running_loop().create_task(self._download(url, dest_filename, multipart_chunksize, throttle, checksum, mirrors, disk_space))
+
+    async def _download(self, url, dest_filename, multipart_chunksize, throttle, checksum, mirrors, disk_space):
+        session = await self._get_session()
+        filename = await self._engine._fetchOneFile(session, url, dest_filename, multipart_chunksize, writer_mode=self.writer, mmap_flush=self.mmap_flush, disk_space=disk_space, max_attempts=self.max_attempts, budget=self.budget, throttle=throttle, checksum=checksum, verify=self.verify, cache=self.cache, mirror_urls=mirrors, io_executor=self.io_executor, metrics=self.metrics)
+        if filename is None:
+            raise DownloadError('Failed to download [{}]'.format(url))
+        return filename
+
+    async def aclose(self):
+        '''关闭 aiohttp 会话和 I/O 线程池，保存探测结果缓存 (不会等待还没有结束的下载)'''
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self.cache is not None:
+            await self.io_executor.run(self.cache.save)
+        self.io_executor.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+
+_default_thread_backend = None
+_default_lock = threading.Lock()
+
+
+def _backend(backend):
+    '''backend 可以是 'thread'、'asyncio' 或者一个后端实例'''
+    global _default_thread_backend
+    if backend == 'thread':
+        with _default_lock:
+            if _default_thread_backend is None:
+                _default_thread_backend = ThreadBackend()
+                atexit.register(_default_thread_backend.close)  # 进程退出前等待下载结束并保存探测结果缓存
+            return _default_thread_backend
+    if backend == 'asyncio':
+        raise ValueError("Create an AsyncioBackend inside the event loop and pass it as backend, e.g. 'async with AsyncioBackend() as backend'")
+    return backend
+
+
+def download(url, dest_filename=None, backend='thread', **options):
+    '''下载单个文件，返回 Future (多线程后端) 或 asyncio.Task (协程后端)，结果为正式文件名
+    backend 为 'thread' 时使用进程内共享的默认 ThreadBackend，options 见 submit()
+    '''
+    return _backend(backend).submit(url, dest_filename, **options)
+
+
+def download_many(manifest, backend='thread'):
+    '''下载 manifest (config.json 的路径、内容或 files 列表) 中的所有文件，返回 Future/Task 列表'''
+    return _backend(backend).download_many(manifest)
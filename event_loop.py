@@ -0,0 +1,131 @@
+'''协程版下载器 (4-spider.py、9-spider.py) 可选的高性能事件循环模式
+
+默认使用 asyncio.run() 的事件循环和 aiohttp 的默认参数；打开 fast_loop 后:
+1. 安装了 uvloop 时用它代替默认的事件循环 (没有安装时给出警告并退回默认的事件循环)
+2. TCPConnector 设置连接数上限、更长的 DNS 缓存时间，每个范围不用重新解析域名
+3. 调大 socket 的接收缓冲区和 aiohttp 的读缓冲区，高带宽、高延迟的链路上每次系统调用可以读到更多字节
+
+另外提供专用的 I/O 线程池 (IOExecutor) 和事件循环延迟的监控 (LoopLagMonitor):
+写临时文件、fsync、读写 JSON、os.rename() 等都可能阻塞几十毫秒，在事件循环中直接调用时所有正在下载的范围都会停下来
+'''
+import asyncio
+from collections import deque
+from concurrent import futures
+from functools import partial
+import socket
+import aiohttp
+from logger import logger
+
+try:  # 可选依赖: pip install uvloop
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+DNS_CACHE_TTL = 300  # DNS 缓存的秒数，aiohttp 默认只有 10 秒
+SOCKET_RCVBUF = 4 * 1024 * 1024  # socket 接收缓冲区的大小 (内核实际分配的是它的两倍，且不超过 net.core.rmem_max)
+READ_BUFSIZE = 1024 * 1024  # aiohttp 每个响应的读缓冲区大小，默认 256 KB
+IO_WORKERS = 8  # I/O 线程池的线程数
+LAG_INTERVAL = 0.1  # 每隔多少秒测量一次事件循环的延迟
+LAG_SAMPLES = 1000  # 保留最近多少次测量结果，用于计算平均值和 p99
+LAG_WARNING = 0.1  # 延迟超过多少秒时记录一条调试日志
+
+
+def run(main, fast_loop=False):
+    '''运行协程 main 直到结束，fast_loop 为 True 且安装了 uvloop 时使用 uvloop 的事件循环'''
+    if fast_loop:
+        if uvloop is not None:
+            return uvloop.run(main)
+        logger.warning('uvloop is not installed, falling back to the default event loop')
+    return asyncio.run(main)
+
+
+def _socket_factory(rcvbuf, addr_info):
+    '''在 connect() 之前设置接收缓冲区，TCP 握手时才能通告更大的窗口缩放因子'''
+    family, type_, proto, _, _ = addr_info
+    sock = socket.socket(family=family, type=type_, proto=proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    return sock
+
+
+def client_session(limit=100, limit_per_host=0, fast_loop=False, dns_cache_ttl=DNS_CACHE_TTL, rcvbuf=SOCKET_RCVBUF, read_bufsize=READ_BUFSIZE):
+    '''创建 aiohttp.ClientSession，limit/limit_per_host 为连接池的总上限和每个 host 的上限 (0 表示不限制)
+    fast_loop 为 False 时除了连接数上限以外都使用 aiohttp 的默认参数
+    rcvbuf 为 None 时不设置接收缓冲区 (注意: Linux 上设置 SO_RCVBUF 会关闭接收缓冲区的自动调整)
+    '''
+    if not fast_loop:
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host))
+
+    options = {'limit': limit, 'limit_per_host': limit_per_host, 'use_dns_cache': True, 'ttl_dns_cache': dns_cache_ttl}
+    if rcvbuf:
+        try:  # socket_factory 是 aiohttp 3.12 新加的参数，更早的版本只能使用默认的接收缓冲区
+            connector = aiohttp.TCPConnector(socket_factory=lambda addr_info: _socket_factory(rcvbuf, addr_info), **options)
+        except TypeError:
+            logger.warning('aiohttp %s does not support socket_factory, the socket receive buffer is not changed', aiohttp.__version__)
+            connector = aiohttp.TCPConnector(**options)
+    else:
+        connector = aiohttp.TCPConnector(**options)
+    return aiohttp.ClientSession(connector=connector, read_bufsize=read_bufsize)
+
+
+class IOExecutor:
+    '''协程中执行阻塞的文件系统操作的专用线程池，线程数有上限，不与 run_in_executor(None, ...) 的默认线程池争抢'''
+
+    def __init__(self, workers=IO_WORKERS):
+        self.executor = futures.ThreadPoolExecutor(workers, thread_name_prefix='io')
+
+    async def run(self, func, *args, **kwargs):
+        '''在 I/O 线程中执行 func(*args, **kwargs) 并等待结果，不阻塞事件循环'''
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class LoopLagMonitor:
+    '''事件循环延迟的监控: 每隔 interval 秒醒来一次，实际醒来的时间比预期晚了多少，就是这段时间内事件循环被阻塞了多久'''
+
+    def __init__(self, interval=LAG_INTERVAL, samples=LAG_SAMPLES, metrics=None):
+        self.interval = interval
+        self.metrics = metrics  # 可选的 Metrics，每次测量结果也记录到它的直方图中
+        self.max = 0.0  # 最大延迟 (秒)
+        self.count = 0  # 测量次数
+        self._samples = deque(maxlen=samples)
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self._samples.append(lag)
+            self.count += 1
+            self.max = max(self.max, lag)
+            if self.metrics is not None:
+                self.metrics.observe('event_loop_lag_seconds', lag)
+            if lag > LAG_WARNING:
+                logger.debug('The event loop was blocked for %.1f ms', lag * 1000)
+
+    def snapshot(self):
+        '''返回当前的指标 (毫秒): 最近一次、最近 samples 次的平均值和 p99、从开始以来的最大值'''
+        samples = sorted(self._samples)
+        return {
+            'samples': self.count,
+            'last_ms': self._samples[-1] * 1000 if self._samples else 0.0,
+            'mean_ms': sum(samples) / len(samples) * 1000 if samples else 0.0,
+            'p99_ms': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000 if samples else 0.0,
+            'max_ms': self.max * 1000
+        }
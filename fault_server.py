@@ -0,0 +1,414 @@
+'''注入故障的本地源站，以及在它上面运行的恢复场景 (尾延迟、kill -9 之后的续传)
+
+服务器 (python fault_server.py serve) 把 root 目录作为静态文件提供下载，支持 HEAD、单个 Range、206、ETag、Last-Modified 和 If-Range，
+--h2 时由 hypercorn 提供服务 (同一个端口上的 HTTP/1.1 和明文 HTTP/2 h2c，需要 pip install hypercorn)，用来测试 10-spider.py 的多路复用，
+并且可以按下面的参数注入故障，用来在可控的条件下触发下载器的各个恢复路径:
+    latency: 每个请求在响应之前等待的秒数
+    bandwidth: 每个响应的带宽上限 (字节/秒)
+    reset_rate: 响应体发送到随机位置时直接断开连接 (RST) 的概率，下载器会收到不完整的分段
+    slow_rate: 慢速响应 (slow-loris) 的概率: 发送到随机位置后，slow_seconds 秒内只以 slow_bandwidth 的速度滴漏
+    error_every / error_burst: 每 error_every 个请求中，最后 error_burst 个连续返回 503
+    etag_change_after: 一共发送了这么多字节之后，所有文件的 ETag 变化一次 (内容不变，相当于源站重新上传了文件)
+    no_range: 忽略 Range，总是返回完整的 200
+GET /_stats 返回 JSON 格式的统计 (请求数、发送的字节数、各种故障的次数、各状态码的次数)，DELETE /_stats 清零
+
+场景 (python fault_server.py scenarios) 为每个场景启动一个新的服务器，运行下载器直到文件下载完整 (最多 max_runs 次)，
+kill_at 为文件总大小的比例，服务器发送了这么多字节后对下载器 kill -9，然后重新启动它继续下载，输出:
+    完成的总耗时 (包括所有重启)、运行次数、是否完整且 SHA256 一致、服务器一共发送的字节数和其中重复下载的字节数、注入的故障次数
+
+用法:
+    python fault_server.py serve --root /data --port 8080 --reset_rate 0.1 --latency 0.05
+    python fault_server.py scenarios --engine 8-spider.py --engine 9-spider.py --size 64M --json
+    python fault_server.py scenarios --engine 10-spider.py --h2 --scenario resets --scenario kill9
+'''
+import asyncio
+from email.utils import formatdate
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.request import Request, urlopen
+import click
+from aiohttp import web
+from benchmark import BASEDIR, free_port, make_file, wait_port  # 导入 benchmark 时设置了 SPIDER_LOG_DIR，日志写入临时目录
+from throttle import parse_rate
+try:  # HTTP/2 源站需要额外安装: pip install hypercorn
+    from hypercorn.asyncio import serve as serve_asgi
+    from hypercorn.config import Config as HypercornConfig
+except ImportError:
+    serve_asgi = None
+
+
+CHUNK_SIZE = 64 * 1024  # 每次写入响应的字节数，也是限速和注入故障的粒度
+SCENARIO_ENGINES = ('3-spider.py', '4-spider.py', '8-spider.py', '9-spider.py', '10-spider.py')  # 读取 config.json 的下载器
+MAX_RUNS = 5  # 每个场景最多运行下载器的次数
+
+# 每个场景的故障参数，kill_at 和 etag_change_after 是相对于文件总大小的比例
+SCENARIOS = {
+    'baseline': {},
+    'latency': {'latency': 0.2},
+    'bandwidth': {'bandwidth': 16 * 1024 * 1024},
+    'resets': {'reset_rate': 0.2},
+    'slowloris': {'slow_rate': 0.2, 'slow_seconds': 3.0},
+    '5xx': {'error_every': 10, 'error_burst': 3},
+    'etag_change': {'etag_change_after': 0.5},
+    'kill9': {'bandwidth': 16 * 1024 * 1024, 'kill_at': 0.5},
+    'kill9_resets': {'bandwidth': 16 * 1024 * 1024, 'reset_rate': 0.2, 'kill_at': 0.5}
+}
+
+
+class FaultInjector:
+    '''按参数注入故障并统计的源站，app() 为 aiohttp 的应用 (HTTP/1.1)，asgi() 为 hypercorn 使用的 ASGI 应用 (HTTP/1.1 和 HTTP/2)'''
+
+    def __init__(self, root, latency=0.0, bandwidth=0, reset_rate=0.0, slow_rate=0.0, slow_seconds=5.0, slow_bandwidth=16 * 1024, error_every=0, error_burst=0, etag_change_after=0, no_range=False, seed=None):
+        self.root = root
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.reset_rate = reset_rate
+        self.slow_rate = slow_rate
+        self.slow_seconds = slow_seconds
+        self.slow_bandwidth = slow_bandwidth
+        self.error_every = error_every
+        self.error_burst = error_burst
+        self.etag_change_after = etag_change_after
+        self.no_range = no_range
+        self.random = random.Random(seed)
+        self.generation = 0  # ETag 变化的次数
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'requests': 0, 'bytes_sent': 0, 'resets': 0, 'slow': 0, 'errors': 0, 'etag_changes': 0, 'status': {}}
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/_stats', self._get_stats)
+        app.router.add_delete('/_stats', self._delete_stats)
+        app.router.add_get('/{name}', self.handle)  # add_get() 同时处理 HEAD
+        return app
+
+    async def _get_stats(self, request):
+        return web.json_response(self.stats)
+
+    async def _delete_stats(self, request):
+        self.reset_stats()
+        return web.json_response(self.stats)
+
+    def etag(self, st):
+        return '"{:x}-{:x}-{}"'.format(st.st_mtime_ns, st.st_size, self.generation)
+
+    def _count(self, status):
+        self.stats['status'][str(status)] = self.stats['status'].get(str(status), 0) + 1
+
+    def _sent(self, n):
+        self.stats['bytes_sent'] += n
+        if self.etag_change_after and self.generation == 0 and self.stats['bytes_sent'] >= self.etag_change_after:
+            self.generation += 1
+            self.stats['etag_changes'] += 1
+
+    def _range(self, value, if_range, etag, size):
+        '''根据请求头 Range 和 If-Range 的值返回要发送的 (start, stop)，stop 包含在内，以及是否是 206；Range 无效时抛出 ValueError'''
+        if self.no_range or not value or (if_range is not None and if_range != etag):  # If-Range 不一致时返回完整的文件
+            return 0, size - 1, False
+        try:
+            unit, _, spec = value.partition('=')
+            first, _, last = spec.strip().partition('-')
+            if unit.strip() != 'bytes' or ',' in spec:
+                raise ValueError(value)
+            if first:
+                start, stop = int(first), min(int(last), size - 1) if last else size - 1
+            else:  # bytes=-N 表示最后 N 个字节
+                start, stop = max(0, size - int(last)), size - 1
+            if start > stop:
+                raise ValueError(value)
+        except ValueError:
+            raise ValueError('bytes */{}'.format(size))
+        return start, stop, True
+
+    async def _respond(self, name, range_value, if_range):
+        '''两种应用共用的请求处理: 返回 (状态码, 响应头, 文件路径, 响应体的起始位置, 长度)，没有响应体 (503、404、416) 时文件路径为 None'''
+        self.stats['requests'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_every and self.stats['requests'] % self.error_every >= self.error_every - self.error_burst:
+            self.stats['errors'] += 1
+            self._count(503)
+            return 503, {}, None, 0, 0
+
+        path = os.path.join(self.root, os.path.basename(name))
+        if not os.path.isfile(path):
+            self._count(404)
+            return 404, {}, None, 0, 0
+        st = os.stat(path)
+        etag = self.etag(st)
+        try:
+            start, stop, partial = self._range(range_value, if_range, etag, st.st_size)
+        except ValueError as e:
+            self._count(416)
+            return 416, {'Content-Range': str(e)}, None, 0, 0
+
+        headers = {'ETag': etag, 'Last-Modified': formatdate(st.st_mtime, usegmt=True), 'Accept-Ranges': 'none' if self.no_range else 'bytes'}
+        if partial:
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop, st.st_size)
+        status = 206 if partial else 200
+        self._count(status)
+        return status, headers, path, start, stop - start + 1
+
+    async def handle(self, request):
+        status, headers, path, start, length = await self._respond(request.match_info['name'], request.headers.get('Range'), request.headers.get('If-Range'))
+        resp = web.StreamResponse(status=status, headers=headers)
+        resp.content_length = length
+        await resp.prepare(request)
+        if path is None or request.method == 'HEAD':
+            return resp
+
+        try:
+            if await self._send_body(resp.write, request.transport.abort, path, start, length):
+                await resp.write_eof()
+        except ConnectionError:  # 客户端放弃了这个响应 (下载器被 kill -9 或者主动断开)
+            pass
+        return resp
+
+    async def asgi(self, scope, receive, send):
+        '''ASGI 应用 (由 hypercorn 提供 HTTP/2)，注入的故障和统计与 handle() 相同
+        HTTP/2 下不能只断开一个流的连接，断开 (reset_rate) 时提前结束这个流，下载器收到的响应体比 Content-Length 短
+        '''
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['path'] == '/_stats':
+            if scope['method'] == 'DELETE':
+                self.reset_stats()
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'application/json')]})
+            await send({'type': 'http.response.body', 'body': json.dumps(self.stats).encode()})
+            return
+
+        request_headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+        status, headers, path, start, length = await self._respond(scope['path'].lstrip('/'), request_headers.get('range'), request_headers.get('if-range'))
+        headers['Content-Length'] = str(length)
+        await send({'type': 'http.response.start', 'status': status, 'headers': [(k.lower().encode(), v.encode()) for k, v in headers.items()]})
+        if path is not None and scope['method'] != 'HEAD':
+            disconnected = asyncio.Event()
+
+            async def watch():
+                while (await receive())['type'] != 'http.disconnect':
+                    pass
+                disconnected.set()
+
+            async def write(data):
+                if disconnected.is_set():  # 客户端已经重置了这个流或者断开了连接，不再统计发送的字节
+                    raise ConnectionResetError()
+                await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+            watcher = asyncio.ensure_future(watch())
+            try:
+                await self._send_body(write, lambda: None, path, start, length)
+            except ConnectionError:
+                pass
+            finally:
+                watcher.cancel()
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def _send_body(self, write, abort, path, start, length):
+        '''发送 [start, start + length) 的响应体，按参数限速、滴漏或者中途断开连接 (调用 abort()，返回 False)
+        write: 写入一块响应体的协程函数
+        '''
+        reset_at = self.random.randrange(length) if self.random.random() < self.reset_rate else None
+        slow_at = self.random.randrange(length) if self.random.random() < self.slow_rate else None
+        if slow_at is not None:
+            self.stats['slow'] += 1
+        loop = asyncio.get_running_loop()
+        sent = 0
+        paced = 0  # 已经按 bandwidth 限速的字节数
+        t0 = loop.time()
+        with open(path, 'rb') as fp:  # 测试用的文件在页缓存中，直接在事件循环中读取
+            fp.seek(start)
+            while sent < length:
+                if reset_at is not None and sent >= reset_at:  # 直接丢弃连接，客户端读到的响应体比 Content-Length 短
+                    self.stats['resets'] += 1
+                    abort()
+                    return False
+                n = min(CHUNK_SIZE, length - sent)
+                if reset_at is not None:
+                    n = min(n, reset_at - sent)
+                await write(fp.read(n))
+                sent += n
+                paced += n
+                self._sent(n)
+
+                if slow_at is not None and sent >= slow_at:  # 滴漏 slow_seconds 秒之后恢复正常速度
+                    slow_at = None
+                    deadline = loop.time() + self.slow_seconds
+                    while sent < length and loop.time() < deadline:
+                        n = min(max(1, int(self.slow_bandwidth / 10)), length - sent)
+                        await write(fp.read(n))
+                        sent += n
+                        self._sent(n)
+                        await asyncio.sleep(0.1)
+                    paced, t0 = 0, loop.time()
+                if self.bandwidth:
+                    delay = t0 + paced / self.bandwidth - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+        return True
+
+
+async def _serve_h2(injector, config):
+    def ignore_cancelled(loop, context):  # 下载器被 kill -9 时 hypercorn 取消连接的任务，会打印 CancelledError，不是服务器的错误
+        if not isinstance(context.get('exception'), asyncio.CancelledError):
+            loop.default_exception_handler(context)
+
+    asyncio.get_running_loop().set_exception_handler(ignore_cancelled)
+    await serve_asgi(injector.asgi, config)
+
+
+def serve(root, port, h2=False, **faults):
+    '''服务器进程的入口，h2 为 True 时使用 hypercorn (HTTP/1.1 和 h2c)'''
+    injector = FaultInjector(root, **faults)
+    if h2:
+        if serve_asgi is None:
+            raise RuntimeError('The HTTP/2 origin requires hypercorn, run: pip install hypercorn')
+        config = HypercornConfig()
+        config.bind = ['127.0.0.1:{}'.format(port)]
+        config.accesslog = config.errorlog = None
+        asyncio.run(_serve_h2(injector, config))
+    else:
+        web.run_app(injector.app(), host='127.0.0.1', port=port, print=None, access_log=None)
+
+
+def _stats(port, method='GET'):
+    '''读取 (method 为 DELETE 时清零) 服务器的统计'''
+    with urlopen(Request('http://127.0.0.1:{}/_stats'.format(port), method=method), timeout=5) as r:
+        return json.load(r)
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def run_scenario(engine, name, faults, source, max_runs=MAX_RUNS, h2=False):
+    '''在新的服务器上运行一个场景，source 为测试文件的路径，h2 为 True 时源站支持明文 HTTP/2 (10-spider.py 使用 h2c)，返回结果字典'''
+    faults = dict(faults)
+    size = os.path.getsize(source)
+    kill_at = faults.pop('kill_at', None)
+    if faults.get('etag_change_after'):
+        faults['etag_change_after'] = int(faults['etag_change_after'] * size)
+    root, filename = os.path.split(source)
+    port = free_port()
+    server = multiprocessing.Process(target=serve, args=(root, port, h2), kwargs=faults, daemon=True)
+    workdir = tempfile.mkdtemp(prefix='fault-dl-')
+    result = {'scenario': name, 'engine': engine, 'h2': h2, 'file_size': size, 'faults': faults, 'kill_at': kill_at}
+    try:
+        server.start()
+        wait_port(port)
+        with open(os.path.join(workdir, 'config.json'), 'w') as fp:
+            json.dump({'files': [{'url': 'http://127.0.0.1:{}/{}'.format(port, filename), 'dest_filename': None, 'multipart_chunksize': 8 * 1024 * 1024}], 'probe_cache': None, 'h2c': h2}, fp)
+
+        runs = kills = 0
+        t0 = time.time()
+        with open(os.path.join(workdir, 'spider.log'), 'wb') as log:
+            while runs < max_runs and not os.path.exists(os.path.join(workdir, filename)):
+                runs += 1
+                proc = subprocess.Popen([sys.executable, os.path.join(BASEDIR, engine)], cwd=workdir, stdout=subprocess.DEVNULL, stderr=log)
+                if kill_at is not None and kills == 0:  # 只在第一次运行时 kill -9
+                    while proc.poll() is None and _stats(port)['bytes_sent'] < kill_at * size:
+                        time.sleep(0.02)
+                    if proc.poll() is None:
+                        os.kill(proc.pid, signal.SIGKILL)
+                        kills += 1
+                proc.wait()
+        elapsed = time.time() - t0
+
+        stats = _stats(port)
+        downloaded = os.path.join(workdir, filename)
+        complete = os.path.exists(downloaded) and os.path.getsize(downloaded) == size
+        result.update({
+            'seconds': round(elapsed, 3),
+            'runs': runs,
+            'kills': kills,
+            'complete': complete,
+            'sha256_ok': complete and _sha256(downloaded) == _sha256(source),
+            'bytes_sent': stats['bytes_sent'],
+            'redownloaded_bytes': max(0, stats['bytes_sent'] - size),
+            'requests': stats['requests'],
+            'resets': stats['resets'],
+            'slow': stats['slow'],
+            'errors': stats['errors'],
+            'etag_changes': stats['etag_changes'],
+            'status': stats['status']
+        })
+        if not complete:
+            with open(os.path.join(workdir, 'spider.log'), 'rb') as fp:
+                result['log_tail'] = fp.read()[-2000:].decode(errors='replace')
+    finally:
+        if server.is_alive():
+            server.terminate()
+        server.join()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command('serve')
+@click.option('--root', default='.', type=click.Path(exists=True, file_okay=False), help="Directory with the files to serve")
+@click.option('--port', default=8080, help="Port to listen on 127.0.0.1")
+@click.option('--latency', default=0.0, help="Seconds to wait before every response")
+@click.option('--bandwidth', default='0', help="Bandwidth limit of every response in bytes per second, K/M/G suffixes are allowed, 0 means unlimited")
+@click.option('--reset_rate', default=0.0, help="Probability that a response body is cut by a connection reset")
+@click.option('--slow_rate', default=0.0, help="Probability that a response body trickles at --slow_bandwidth for --slow_seconds")
+@click.option('--slow_seconds', default=5.0, help="Seconds a slow response trickles")
+@click.option('--slow_bandwidth', default='16K', help="Bytes per second of a slow response")
+@click.option('--error_every', default=0, help="Length of the 5xx burst cycle in requests, 0 disables bursts")
+@click.option('--error_burst', default=0, help="Requests at the end of every cycle answered with 503")
+@click.option('--etag_change_after', default='0', help="Change the ETag of all files once after this many bytes are sent, K/M/G suffixes are allowed")
+@click.option('--no_range', is_flag=True, help="Ignore Range and always respond with the whole file")
+@click.option('--h2', is_flag=True, help="Serve with hypercorn, which speaks HTTP/1.1 and cleartext HTTP/2 (h2c) on the same port")
+@click.option('--seed', type=int, help="Seed of the fault random generator")
+def serve_command(root, port, bandwidth, slow_bandwidth, etag_change_after, **faults):
+    serve(root, port, bandwidth=parse_rate(bandwidth) or 0, slow_bandwidth=parse_rate(slow_bandwidth), etag_change_after=parse_rate(etag_change_after) or 0, **faults)
+
+
+@main.command('scenarios')
+@click.option('--engine', 'engines', multiple=True, type=click.Choice(SCENARIO_ENGINES), help="Spider to run, can be repeated [default: 8-spider.py and 9-spider.py]")
+@click.option('--scenario', 'names', multiple=True, type=click.Choice(sorted(SCENARIOS)), help="Scenario to run, can be repeated [default: all]")
+@click.option('--size', default='64M', help="Size of the test file, K/M/G suffixes are allowed")
+@click.option('--max_runs', default=MAX_RUNS, help="Maximum runs of the spider per scenario")
+@click.option('--h2', is_flag=True, help="Run the origin with hypercorn so that 10-spider.py downloads over HTTP/2 (h2c)")
+@click.option('--json', 'as_json', is_flag=True, help="Print the results as JSON lines")
+def scenarios_command(engines, names, size, max_runs, h2, as_json):
+    root = tempfile.mkdtemp(prefix='fault-srv-')
+    try:
+        source = os.path.join(root, 'fault.bin')
+        make_file(source, parse_rate(size))
+        for engine in engines or ('8-spider.py', '9-spider.py'):
+            for name in names or SCENARIOS:
+                result = run_scenario(engine, name, SCENARIOS[name], source, max_runs, h2)
+                if as_json:
+                    print(json.dumps(result), flush=True)
+                else:
+                    print('{engine:<12} {scenario:<13} {seconds:>8.2f} s {runs} runs complete={complete} sha256_ok={sha256_ok} redownloaded={redownloaded_bytes} B requests={requests} resets={resets} slow={slow} errors={errors} etag_changes={etag_changes}'.format(**result), flush=True)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+'''边下载边计算整个文件的哈希值 (sha256/md5)，下载完最后一个字节时哈希值也就算好了，不需要再把整个文件读一遍
+
+哈希必须按字节顺序计算，而各范围是乱序完成的:
+    - 正好接在已哈希部分后面的字节，在写入临时文件的同时直接在内存中计算
+    - 其它范围完成时只记录下来，等到前面的缺口被填上以后，再从临时文件中读回 (刚写入的数据通常还在 page cache 中，不会真正读磁盘)
+'''
+import hashlib
+import heapq
+import threading
+from logger import logger
+
+
+ALGORITHMS = ('sha256', 'md5')  # config.json 中每个文件可选的校验字段
+READ_BUFFER_SIZE = 1024 * 1024  # 从临时文件读回时每次读取的字节数
+
+
+def expected_digest(entry):
+    '''从 config.json 中一个文件的配置里取出期望的哈希值，返回 (算法, 十六进制哈希值)，没有配置时返回 None'''
+    for algorithm in ALGORITHMS:
+        if entry.get(algorithm):
+            return algorithm, entry[algorithm].strip().lower()
+    return None
+
+
+class StreamingHasher:
+    '''按字节顺序计算 filename 的哈希值，多个线程/协程可以同时调用 feed() 和 done()
+    pos 之前的字节都已经计算过了
+    '''
+
+    def __init__(self, filename, file_size, algorithm='sha256'):
+        self.filename = filename
+        self.file_size = file_size
+        self.algorithm = algorithm
+        self.pos = 0
+        self._hash = hashlib.new(algorithm)
+        self._completed = []  # 已经写入临时文件、但前面还有缺口的范围 (start, stop)，最小堆
+        self._reading = False  # 是否有线程正在从临时文件读回数据
+        self._lock = threading.Lock()
+
+    def feed(self, offset, data):
+        '''data 刚刚被写入 offset 处，如果它正好接在已计算的字节后面，直接计算，之后就不需要再从文件读回了
+        拿不到锁 (其它线程正在计算) 时立即返回，不会阻塞下载，这部分字节以后再从文件读回
+        '''
+        if offset != self.pos or not self._lock.acquire(blocking=False):
+            return
+        try:
+            if offset == self.pos and not self._reading:
+                self._hash.update(data)
+                self.pos += len(data)
+        finally:
+            self._lock.release()
+
+    def mark_done(self, start, stop):
+        '''登记已经在临时文件中的范围 (例如上次运行时下载的部分)，等到前面的缺口被填上时才读回'''
+        with self._lock:
+            heapq.heappush(self._completed, (start, stop))
+
+    def done(self, start, stop):
+        '''[start, stop] 已经完整地写入了临时文件，如果它填上了缺口，就把后面连续的已完成范围从文件读回并计算'''
+        with self._lock:
+            heapq.heappush(self._completed, (start, stop))
+        self._catch_up()
+
+    def _catch_up(self):
+        with self._lock:
+            if self._reading:  # 其它线程正在读回，它会顺便处理刚加入的范围
+                return
+            self._reading = True
+        while True:
+            with self._lock:
+                while self._completed and self._completed[0][1] < self.pos:  # 已经在内存中计算过了
+                    heapq.heappop(self._completed)
+                if not self._completed or self._completed[0][0] > self.pos:  # 前面还有缺口，与检查在同一把锁内清除标志，不会漏掉刚加入的范围
+                    self._reading = False
+                    return
+                begin, stop = self.pos, heapq.heappop(self._completed)[1]
+            try:
+                self._read(begin, stop)
+            except OSError as e:  # 读回失败时放回去，下次再试，hexdigest() 会因为字节数不够而报错
+                logger.error('Failed to read back [%s] for hashing, the reason is that %s', self.filename, e)
+                with self._lock:
+                    heapq.heappush(self._completed, (self.pos, stop))
+                    self._reading = False
+                return
+
+    def _read(self, begin, stop):
+        '''从临时文件读回 [begin, stop] 并计算，读回期间 feed() 不会计算，所以不需要一直持有锁'''
+        with open(self.filename, 'rb') as fp:
+            fp.seek(begin)
+            while begin <= stop:
+                data = fp.read(min(READ_BUFFER_SIZE, stop - begin + 1))
+                if not data:
+                    raise OSError('Unexpected end of file [{}] at {}'.format(self.filename, begin))
+                with self._lock:
+                    self._hash.update(data)
+                    self.pos = begin + len(data)
+                begin += len(data)
+
+    def hexdigest(self):
+        '''所有字节都下载完成后调用，返回十六进制的哈希值'''
+        self._catch_up()
+        if self.pos != self.file_size:
+            raise ValueError('Only {} of {} bytes of [{}] have been hashed'.format(self.pos, self.file_size, self.filename))
+        return self._hash.hexdigest()
+
+    def verify(self, expected):
+        '''计算出的哈希值与 expected 一致时返回 True，不一致或者无法计算时记录日志并返回 False'''
+        try:
+            digest = self.hexdigest()
+        except (OSError, ValueError) as e:
+            logger.error('Failed to compute %s of [%s], the reason is that %s', self.algorithm, self.filename, e)
+            return False
+        if digest != expected.lower():
+            logger.error('[%s] %s mismatch, expected %s but got %s', self.filename, self.algorithm, expected, digest)
+            return False
+        logger.debug('[%s] %s verified: %s', self.filename, self.algorithm, digest)
+        return True
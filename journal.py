@@ -0,0 +1,194 @@
+'''断点续传的配置文件 (<file>.swp.cfg)，只追加写入，不再每完成一个分块就重写整个 JSON 文件
+
+文件格式:
+    第 1 行: JSON 头部，以 \n 结尾，例如 {"version": 1, "ETag": "..."}
+    之后: 定长的二进制记录，每成功下载一个分块就追加一条，记录此分块的字节范围 [start, stop] 以及这些字节的 CRC32
+
+每条记录本身也带有 CRC32 校验值，程序崩溃时最后一条记录可能只写入了一半，加载时会丢弃它
+分块数据的 CRC32 用于续传前校验临时文件: 写入一半时崩溃的分块可能已经有记录但字节是错的，校验失败的分块会被重新下载
+'''
+from concurrent import futures
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from logger import logger
+
+
+JOURNAL_VERSION = 2  # 版本 1 的记录没有分块数据的 CRC32，遇到版本 1 的配置文件时重新下载
+# 每条记录: start (8 字节)、stop (8 字节)、分块数据的 CRC32 (4 字节)、前 20 个字节的 CRC32 (4 字节)
+RECORD = struct.Struct('<QQII')
+READ_BUFFER_SIZE = 1024 * 1024  # 校验时每次从临时文件读取的字节数
+
+
+def _pack(start, stop, crc):
+    data = struct.pack('<QQI', start, stop, crc)
+    return data + struct.pack('<I', zlib.crc32(data))
+
+
+def load_journal(filename):
+    '''读取配置文件，返回 (头部, 已下载的分块记录列表 [(start, stop, crc), ...])
+    如果文件不存在、格式不对或版本不一致，返回 (None, [])
+    末尾不完整或校验失败的记录会被丢弃，并截断文件，保证后续追加的记录是对齐的
+    '''
+    try:
+        with open(filename, 'rb') as fp:
+            header = json.loads(fp.readline().decode('utf-8'))
+            offset = fp.tell()
+            body = fp.read()
+    except (OSError, ValueError):
+        return None, []
+    if not isinstance(header, dict) or header.get('version') != JOURNAL_VERSION:
+        return None, []
+
+    records = []
+    valid = 0  # 有效记录的总字节数
+    for i in range(len(body) // RECORD.size):
+        start, stop, crc, record_crc = RECORD.unpack_from(body, i * RECORD.size)
+        if zlib.crc32(body[i * RECORD.size:i * RECORD.size + 20]) != record_crc:  # 遇到损坏的记录，后面的都不再信任
+            break
+        records.append((start, stop, crc))
+        valid += RECORD.size
+
+    if valid != len(body):  # 截断被撕裂的最后一条记录
+        with open(filename, 'rb+') as fp:
+            fp.truncate(offset + valid)
+    return header, records
+
+
+def file_crc32(filename, start, stop):
+    '''计算文件中 [start, stop] 这些字节的 CRC32'''
+    crc = 0
+    with open(filename, 'rb') as fp:
+        fp.seek(start)
+        while start <= stop:
+            data = fp.read(min(READ_BUFFER_SIZE, stop - start + 1))
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            start += len(data)
+    return crc
+
+
+def checked_ranges(filename, records, verify=False, workers=None):
+    '''根据配置文件中的记录返回可以信任的字节范围列表 [(start, stop), ...]
+    verify 为 True 时，先用多个线程并行计算临时文件 filename 中每个分块的 CRC32 (zlib.crc32 计算较大的数据时会释放 GIL，可以用上多个 CPU 核心)，
+    与记录不一致的分块被丢弃，之后会当作还没有下载的字节重新下载，而不是重新下载整个文件
+    '''
+    if not verify or not records:
+        return [(start, stop) for start, stop, _ in records]
+    with futures.ThreadPoolExecutor(workers or os.cpu_count()) as executor:
+        crcs = executor.map(lambda record: file_crc32(filename, record[0], record[1]), records)
+        ranges = []
+        for (start, stop, crc), actual in zip(records, crcs):
+            if actual == crc:
+                ranges.append((start, stop))
+            else:
+                logger.warning('[%s] [Range: bytes=%s-%s] is corrupted, it will be downloaded again', filename, start, stop)
+    return ranges
+
+
+def merge_ranges(ranges):
+    '''将字节范围排序并合并相邻或重叠的部分，返回 [(start, stop), ...]'''
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            if stop > merged[-1][1]:
+                merged[-1] = (merged[-1][0], stop)
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def missing_ranges(ranges, file_size):
+    '''根据已下载的字节范围，返回还需要下载的字节范围列表 [(start, stop), ...]'''
+    holes = []
+    offset = 0
+    for start, stop in merge_ranges(ranges):
+        if start > offset:
+            holes.append((offset, start - 1))
+        offset = max(offset, stop + 1)
+    if offset < file_size:
+        holes.append((offset, file_size - 1))
+    return holes
+
+
+def resume_offset(temp_filename, config_filename, file_size, ETag):
+    '''还没有发出请求时，根据上次运行留下的临时文件和配置文件，返回续传时第一个还没有下载的字节的位置
+    临时文件的大小不是 file_size、配置文件无效、ETag 不一致或者已经全部下载时返回 None (此时要从头探测)
+    '''
+    try:
+        if os.path.getsize(temp_filename) != file_size:
+            return None
+    except OSError:
+        return None
+    header, records = load_journal(config_filename)
+    if not header or header.get('ETag') != ETag:
+        return None
+    holes = missing_ranges([(start, stop) for start, stop, _ in records], file_size)
+    return holes[0][0] if holes else None
+
+
+def missing_parts(ranges, file_size, multipart_chunksize):
+    '''根据已下载的字节范围，返回还需要下载的分块号集合 (没有被完整覆盖的分块都需要重新下载)'''
+    div, mod = divmod(file_size, multipart_chunksize)
+    parts_count = div if mod == 0 else div + 1
+    merged = merge_ranges(ranges)
+    parts = set()
+    i = 0
+    for part_number in range(parts_count):
+        start = part_number * multipart_chunksize
+        stop = min(start + multipart_chunksize, file_size) - 1
+        while i < len(merged) and merged[i][1] < start:  # 分块号递增，合并后的范围也是递增的，只需向前移动
+            i += 1
+        if i == len(merged) or merged[i][0] > start or merged[i][1] < stop:
+            parts.add(part_number)
+    return parts
+
+
+class PartJournal:
+    '''以追加模式打开配置文件，记录已成功下载的分块，多个线程可以共享同一个实例
+    每条记录都立即用一次 write 系统调用写入文件 (不经过 Python 的缓冲)，进程被 kill -9 时已追加的记录不会丢失
+    为了减少磁盘同步的开销，每 sync_every 条记录或每隔 sync_interval 秒才调用一次 fsync (只有断电时才会丢失还没有 fsync 的记录)
+    '''
+
+    def __init__(self, filename, sync_every=64, sync_interval=1.0):
+        self.filename = filename
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._fp = open(filename, 'ab', buffering=0)  # 无缓冲，每次 write 都是一次系统调用
+        self._lock = threading.Lock()
+        self._pending = 0  # 还没有 fsync 的记录数
+        self._last_sync = time.time()
+
+    @classmethod
+    def create(cls, filename, header, **kwargs):
+        '''创建新的配置文件并写入头部 (例如 ETag)'''
+        header = dict(header, version=JOURNAL_VERSION)
+        with open(filename, 'wb') as fp:
+            fp.write(json.dumps(header).encode('utf-8') + b'\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        return cls(filename, **kwargs)
+
+    def append(self, start, stop, crc):
+        '''追加一条分块记录 [start, stop]，crc 为这些字节的 CRC32'''
+        with self._lock:
+            self._fp.write(_pack(start, stop, crc))
+            self._pending += 1
+            if self._pending >= self.sync_every or time.time() - self._last_sync >= self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self._fp.fileno())
+        self._pending = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        with self._lock:
+            if self._fp.closed:
+                return
+            self._sync()
+            self._fp.close()
@@ -1,6 +1,9 @@
+import atexit
 import os
+import queue
 import time
 import logging
+from logging.handlers import QueueHandler, QueueListener
 
 
 ###
@@ -8,8 +11,12 @@ import logging
 ###
 
 logger = logging.getLogger('spider')
+# 日志文件的级别，默认 DEBUG (包括每个范围的日志)，环境变量 SPIDER_LOG_LEVEL=INFO 时不再产生 DEBUG 日志，下载每个范围时跳过它们
+LOG_LEVEL = logging.getLevelName(os.environ.get('SPIDER_LOG_LEVEL', 'DEBUG').upper())
+if not isinstance(LOG_LEVEL, int):
+    LOG_LEVEL = logging.DEBUG
 # 设置总日志级别, 也可以给不同的handler设置不同的日志级别
-logger.setLevel(logging.DEBUG)
+logger.setLevel(min(LOG_LEVEL, logging.INFO))
 
 ###
 # 2. 创建Handler, 输出日志到控制台和文件
@@ -20,13 +27,13 @@ formatter = logging.Formatter('%(asctime)s - %(levelname)s: %(message)s')
 
 # 日志文件FileHandler
 basedir = os.path.abspath(os.path.dirname(__file__))
-log_dest = os.path.join(basedir, 'logs')  # 日志文件所在目录
+log_dest = os.environ.get('SPIDER_LOG_DIR') or os.path.join(basedir, 'logs')  # 日志文件所在目录，环境变量 SPIDER_LOG_DIR 可以指定其它目录
 if not os.path.isdir(log_dest):
-    os.mkdir(log_dest)
+    os.makedirs(log_dest)
 filename = time.strftime('%Y-%m-%d-%H-%M-%S', time.localtime(time.time())) + '.log'  # 日志文件名，以当前时间命名
 file_handler = logging.FileHandler(os.path.join(log_dest, filename), encoding='utf-8')  # 创建日志文件handler
 file_handler.setFormatter(formatter)  # 设置Formatter
-# file_handler.setLevel(logging.INFO)  # 单独设置日志文件的日志级别，注释掉则使用总日志级别
+file_handler.setLevel(LOG_LEVEL)  # 单独设置日志文件的日志级别
 
 # 控制台日志StreamHandler
 stream_handler = logging.StreamHandler()
@@ -34,8 +41,13 @@ stream_handler.setFormatter(formatter)
 stream_handler.setLevel(logging.INFO)
 
 ###
-# 3. 将handler添加到logger中
+# 3. logger 只把日志放入队列，由 QueueListener 的后台线程交给上面的 handler 写文件和控制台
+#    下载线程和事件循环不会阻塞在日志 I/O 上；调用时使用 %-style 参数 (logger.debug('%s downloaded', name))，被级别过滤掉的日志不会格式化
 ###
 
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
+log_queue = queue.SimpleQueue()
+queue_listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+queue_listener.start()
+atexit.register(queue_listener.stop)  # 进程退出前写完队列中剩余的日志
+
+logger.addHandler(QueueHandler(log_queue))
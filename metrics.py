@@ -0,0 +1,265 @@
+'''下载器的运行指标，用来判断一次下载是受网络、磁盘还是锁的限制
+
+- 每个文件、每个 host 写入临时文件的字节数 (吞吐量)
+- 每个范围的首字节时间 (TTFB) 和传输时间 (从首字节到最后一个字节，包括写临时文件的时间) 的直方图
+- 每个范围写临时文件的时间、追加配置文件 (.swp.cfg，包括等待 PartJournal 的锁和 mmap 的落盘) 的时间、等待连接名额的时间的直方图
+- 失败的请求、重试、最终失败的范围、远程文件变化后重新下载的次数，正在使用的连接数，事件循环的延迟 (9-spider.py)
+
+传输时间远大于写文件的时间时受网络限制，写文件的时间占了大部分时受磁盘限制，配置文件或者连接名额的等待时间长时受锁/并发数限制
+
+两种导出方式 (config.json 中的可选字段):
+    metrics_port: 在 127.0.0.1 的这个端口上提供 Prometheus 文本格式的 GET /metrics
+    metrics_file: 每隔 metrics_interval 秒把 JSON 快照写入这个文件 (先写临时文件再改名，读取时不会读到一半)，
+                  快照中的 bytes_per_sec 是与上一次快照之间的吞吐量
+'''
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import threading
+import time
+from logger import logger
+
+
+PREFIX = 'download_'  # Prometheus 指标名的前缀
+METRICS_INTERVAL = 5.0  # 默认每隔多少秒写一次 JSON 快照
+TTFB_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+TRANSFER_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# 指标名 -> (类型, 说明, 直方图的桶)
+METRICS = {
+    'file_bytes_total': ('counter', 'Bytes written to the temporary file', None),
+    'host_bytes_total': ('counter', 'Bytes downloaded from the host', None),
+    'part_ttfb_seconds': ('histogram', 'Time to first byte of a range request', TTFB_BUCKETS),
+    'part_transfer_seconds': ('histogram', 'Time from the first to the last byte of a range, including the writes', TRANSFER_BUCKETS),
+    'part_write_seconds': ('histogram', 'Time a range spent writing to the temporary file', WAIT_BUCKETS),
+    'journal_seconds': ('histogram', 'Time spent appending a range to the .swp.cfg journal, including the lock and the mmap flush', WAIT_BUCKETS),
+    'connection_wait_seconds': ('histogram', 'Time spent waiting for a connection slot', WAIT_BUCKETS),
+    'inflight_connections': ('gauge', 'Connections in use', None),
+    'part_errors_total': ('counter', 'Range requests that failed', None),
+    'retries_total': ('counter', 'Ranges scheduled for another attempt', None),
+    'failed_parts_total': ('counter', 'Ranges that failed after all attempts', None),
+    'restarts_total': ('counter', 'Downloads restarted because the remote file changed', None),
+    'event_loop_lag_seconds': ('histogram', 'How late the event loop woke up', WAIT_BUCKETS)
+}
+
+
+class Histogram:
+    '''累积直方图，counts[i] 为小于等于 buckets[i] 的观测值个数 (最后一个为 +Inf)'''
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        '''按桶估计分位数 (返回所在桶的上界，落在 +Inf 桶时返回最后一个有限的上界)'''
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _label_key(labels):
+    '''JSON 快照中的键: 只有一个标签时为标签值，否则为 k=v,k=v'''
+    if len(labels) == 1:
+        return str(labels[0][1])
+    return ','.join('{}={}'.format(k, v) for k, v in labels)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels) + '}'
+
+
+class Metrics:
+    '''所有文件、线程和协程共享的指标，内部加锁'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = defaultdict(dict)  # 指标名 -> {标签: 数值或 Histogram}
+        self._t0 = time.time()
+        self._last = None  # 上一次快照的 (时间, {(指标名, 标签): 字节数})，用于计算吞吐量
+
+    def inc(self, name, value=1, **labels):
+        '''计数器加 value，或者 gauge 加 value (可以是负数)'''
+        key = _labels(labels)
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[name][_labels(labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = _labels(labels)
+        with self._lock:
+            values = self._values[name]
+            h = values.get(key)
+            if h is None:
+                h = values[key] = Histogram(METRICS[name][2])
+            h.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''把 with 语句块的耗时记录到直方图 name 中'''
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    def transferred(self, filename, host, size):
+        '''文件 filename 从 host 下载的 size 个字节已经写入临时文件'''
+        file_key, host_key = _labels({'file': filename}), _labels({'host': host})
+        with self._lock:
+            files, hosts = self._values['file_bytes_total'], self._values['host_bytes_total']
+            files[file_key] = files.get(file_key, 0) + size
+            hosts[host_key] = hosts.get(host_key, 0) + size
+
+    def render(self):
+        '''Prometheus 文本格式 (version 0.0.4)'''
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, _) in METRICS.items():
+                full = PREFIX + name
+                lines.append('# HELP {} {}'.format(full, help_text))
+                lines.append('# TYPE {} {}'.format(full, kind))
+                for labels, value in sorted(self._values.get(name, {}).items()):
+                    if kind != 'histogram':
+                        lines.append('{}{} {}'.format(full, _format_labels(labels), value))
+                        continue
+                    cumulative = 0
+                    for bound, n in zip(value.buckets + ('+Inf',), value.counts):
+                        cumulative += n
+                        lines.append('{}_bucket{} {}'.format(full, _format_labels(labels, (('le', bound),)), cumulative))
+                    lines.append('{}_sum{} {}'.format(full, _format_labels(labels), value.sum))
+                    lines.append('{}_count{} {}'.format(full, _format_labels(labels), value.count))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        '''JSON 快照: 计数器和 gauge 的当前值、直方图的次数/总和/平均值/p50/p99，以及每个文件和 host 与上一次快照之间的吞吐量'''
+        now = time.time()
+        data = {'time': now, 'uptime_seconds': round(now - self._t0, 3), 'counters': {}, 'gauges': {}, 'histograms': {}, 'bytes_per_sec': {}}
+        with self._lock:
+            for name, (kind, _, _) in METRICS.items():
+                values = self._values.get(name, {})
+                if kind == 'histogram':
+                    data['histograms'][name] = {_label_key(labels): {
+                        'count': h.count,
+                        'sum': round(h.sum, 6),
+                        'mean': round(h.sum / h.count, 6) if h.count else 0.0,
+                        'p50': h.quantile(0.5),
+                        'p99': h.quantile(0.99)
+                    } for labels, h in values.items()}
+                else:
+                    data[kind + 's'][name] = {_label_key(labels): value for labels, value in values.items()}
+            transferred = {(name, labels): value for name in ('file_bytes_total', 'host_bytes_total') for labels, value in self._values.get(name, {}).items()}
+            last_time, last = self._last or (self._t0, {})
+            self._last = (now, transferred)
+        elapsed = max(now - last_time, 1e-9)
+        for (name, labels), value in transferred.items():
+            group = data['bytes_per_sec'].setdefault(name.split('_')[0], {})
+            group[_label_key(labels)] = round((value - last.get((name, labels), 0)) / elapsed, 1)
+        return data
+
+
+class MetricsServer:
+    '''在后台线程中提供 GET /metrics (Prometheus 文本格式)'''
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # 不输出每个请求的访问日志
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+        logger.debug('Serving metrics on http://%s:%s/metrics', host, self._server.server_port)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class JsonReporter:
+    '''在后台线程中每隔 interval 秒把 Metrics.snapshot() 写入 filename，close() 时再写最后一次'''
+
+    def __init__(self, metrics, filename, interval=METRICS_INTERVAL):
+        self.metrics = metrics
+        self.filename = filename
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        temp = self.filename + '.tmp'
+        try:
+            with open(temp, 'w') as fp:
+                json.dump(self.metrics.snapshot(), fp)
+            os.replace(temp, self.filename)
+        except OSError as e:
+            logger.error('Failed to write metrics to [%s], the reason is that %s', self.filename, e)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+
+def start_exporters(metrics, cfg):
+    '''按 config.json 中的 metrics_port、metrics_file、metrics_interval 启动导出器，返回需要在结束时 close() 的列表'''
+    exporters = []
+    if cfg.get('metrics_port'):
+        exporters.append(MetricsServer(metrics, cfg['metrics_port']))
+    if cfg.get('metrics_file'):
+        exporters.append(JsonReporter(metrics, cfg['metrics_file'], cfg.get('metrics_interval', METRICS_INTERVAL)))
+    return exporters
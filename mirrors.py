@@ -0,0 +1,110 @@
+'''一个文件的多个镜像: 同一个文件的各范围可以从不同的 URL 下载，突破单个服务器的带宽上限
+config.json 中每个文件可选 mirrors 字段 (URL 列表)，url 字段仍然是主 URL，探测请求只发给它，配置文件 (.swp.cfg) 中记录的也是它的 ETag
+
+每次分配范围时，按各镜像测得的吞吐量除以它正在下载的范围数选择镜像，吞吐量越大的镜像分到的范围越多
+不同服务器的 ETag 一般不一样，所以每个镜像第一次响应时记下它的 ETag，之后的请求都带上 If-Range 校验
+镜像返回的文件大小或 ETag 不一致，或者连续失败多次，就不再使用它，它的范围由其它镜像重新下载
+'''
+import threading
+from urllib.parse import urlsplit
+from custom_request import parse_content_range
+from logger import logger
+
+
+MAX_FAILURES = 3  # 镜像连续失败多少次后不再使用
+EWMA_ALPHA = 0.3  # 指数加权移动平均的系数，越大越看重最近的测量值
+
+
+class Mirror:
+    '''一个下载源，primary 为 True 的是 config.json 中的 url'''
+
+    __slots__ = ('url', 'host', 'etag', 'primary', 'alive', 'throughput', 'active', 'failures')
+
+    def __init__(self, url, etag=None, primary=False):
+        self.url = url
+        self.host = urlsplit(url).netloc
+        self.etag = etag  # 此镜像上这个文件的 ETag，镜像第一次响应时才知道
+        self.primary = primary
+        self.alive = True
+        self.throughput = None  # 单个请求的吞吐量 (字节/秒)
+        self.active = 0  # 正在使用此镜像的范围数
+        self.failures = 0  # 连续失败的次数
+
+    def __repr__(self):
+        return 'Mirror({})'.format(self.url)
+
+
+class MirrorSet:
+    '''一个文件的所有下载源，多个线程/协程可以共享同一个实例'''
+
+    def __init__(self, name, url, etag, file_size, mirrors=None):
+        self.name = name  # 文件名，用于日志
+        self.file_size = file_size
+        self.primary = Mirror(url, etag, primary=True)
+        self._mirrors = [self.primary] + [Mirror(m) for m in (mirrors or []) if m != url]
+        self._lock = threading.Lock()
+
+    @property
+    def hosts(self):
+        '''所有还在使用的镜像所在的 host'''
+        with self._lock:
+            return {m.host for m in self._mirrors if m.alive}
+
+    def pick(self, mirror=None):
+        '''选择下一个范围使用的镜像 (已经指定 mirror 时直接使用它)，用完后必须调用 release()
+        还没有测量值的镜像按已知的最大吞吐量计算，所以每个镜像都会先被试用
+        '''
+        with self._lock:
+            if mirror is None:
+                alive = [m for m in self._mirrors if m.alive]
+                known = [m.throughput for m in alive if m.throughput]
+                default = max(known) if known else 1.0
+                mirror = max(alive, key=lambda m: (m.throughput or default) / (m.active + 1))  # 相同时 max() 返回第一个，即优先使用主 URL
+            mirror.active += 1
+            return mirror
+
+    def release(self, mirror):
+        with self._lock:
+            mirror.active -= 1
+
+    def validate(self, mirror, status, etag, content_range):
+        '''检查 mirror 的响应是否属于同一个文件: 必须是 206，文件总大小一致，ETag 与此镜像之前的 ETag 一致
+        镜像第一次响应时记下它的 ETag；不一致时丢弃此镜像 (主 URL 不一致说明远程文件变化了，由调用方处理) 并返回 False
+        '''
+        try:
+            total = parse_content_range(content_range)[2] if status == 206 and content_range else None
+        except ValueError:
+            total = None
+        with self._lock:
+            if total == self.file_size and etag and (mirror.etag is None or mirror.etag == etag):
+                mirror.etag = etag
+                return True
+        if not mirror.primary:
+            self.drop(mirror, 'it responds with status {}, ETag {} and Content-Range {}'.format(status, etag, content_range))
+        return False
+
+    def record(self, mirror, size, elapsed, ttfb):
+        '''mirror 成功下载了 size 字节，总耗时 elapsed 秒，其中首字节时间 ttfb 秒'''
+        transfer = elapsed - ttfb
+        with self._lock:
+            mirror.failures = 0
+            if size <= 0 or transfer <= 0:
+                return
+            throughput = size / transfer
+            mirror.throughput = throughput if mirror.throughput is None else EWMA_ALPHA * throughput + (1 - EWMA_ALPHA) * mirror.throughput
+
+    def fail(self, mirror):
+        '''mirror 下载失败了一次，连续失败 MAX_FAILURES 次后不再使用它'''
+        with self._lock:
+            mirror.failures += 1
+            failures = mirror.failures
+        if failures >= MAX_FAILURES:
+            self.drop(mirror, 'it failed {} times in a row'.format(failures))
+
+    def drop(self, mirror, reason):
+        '''不再使用 mirror，但至少保留一个镜像，否则剩下的范围就没有地方下载了'''
+        with self._lock:
+            if not mirror.alive or sum(m.alive for m in self._mirrors) <= 1:
+                return
+            mirror.alive = False
+        logger.warning('[%s] Mirror [%s] is dropped, the reason is that %s', self.name, mirror.url, reason)
@@ -0,0 +1,93 @@
+'''把分块写入临时文件 (<file>.swp) 的指定位置，多个线程共享同一个实例'''
+import mmap
+import os
+import threading
+
+
+class PwriteWriter:
+    '''整个临时文件只打开一个文件描述符，用 os.pwrite() 在分块的偏移处写入
+    pwrite() 不依赖也不移动文件指针，各分块的字节范围又互不重叠，所以多个线程可以同时写入，不需要加锁
+    没有 os.pwrite() 的平台 (例如 Windows) 退化为加锁后 lseek() + write()
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        self._lock = None if hasattr(os, 'pwrite') else threading.Lock()
+
+    def write(self, offset, data):
+        '''将 data 写入 offset 处，返回写入的字节数'''
+        view = memoryview(data)
+        if self._lock is None:
+            while view:
+                n = os.pwrite(self.fd, view, offset)
+                view = view[n:]
+                offset += n
+        else:
+            with self._lock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                while view:
+                    n = os.write(self.fd, view)
+                    view = view[n:]
+        return len(data)
+
+    def flush_range(self, start, stop):
+        '''pwrite() 写入的数据由操作系统负责落盘，这里什么也不做，只是与 MmapWriter 保持相同的接口'''
+        pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class MmapWriter:
+    '''把预分配好大小的临时文件整个映射到内存，各分块直接把字节拷贝到映射区的 [start, stop+1) 切片中
+    不需要每个分块都打开文件、seek()，也不需要系统调用，多个线程/协程写入互不重叠的切片时不需要加锁
+    flush: 脏页同步到磁盘 (msync) 的策略
+        'part'  每个分块下载完成后同步此分块，断电后丢失的数据最少
+        'close' 只在关闭时同步一次 (默认)
+        'none'  完全交给操作系统回写
+    '''
+
+    FLUSH_POLICIES = ('part', 'close', 'none')
+
+    def __init__(self, filename, flush='close'):
+        if flush not in self.FLUSH_POLICIES:
+            raise ValueError('Unknown mmap flush policy: {}'.format(flush))
+        self.filename = filename
+        self.flush = flush
+        self._fp = open(filename, 'rb+')
+        self._mm = mmap.mmap(self._fp.fileno(), 0)
+        self._view = memoryview(self._mm)
+
+    def write(self, offset, data):
+        '''将 data 拷贝到映射区的 offset 处，返回写入的字节数'''
+        self._view[offset:offset + len(data)] = data
+        return len(data)
+
+    def flush_range(self, start, stop):
+        '''flush='part' 时，把 [start, stop] 所在的页同步到磁盘，msync 的起始位置必须按页对齐'''
+        if self.flush != 'part':
+            return
+        offset = start - start % mmap.ALLOCATIONGRANULARITY
+        self._mm.flush(offset, stop + 1 - offset)
+
+    def close(self):
+        if self._mm is None:
+            return
+        if self.flush != 'none':
+            self._mm.flush()
+        self._view.release()
+        self._mm.close()
+        self._fp.close()
+        self._mm = None
+
+
+def open_writer(filename, mode='pwrite', mmap_flush='close'):
+    '''根据 mode ('pwrite' 或 'mmap') 创建写入临时文件的对象'''
+    if mode == 'mmap':
+        return MmapWriter(filename, flush=mmap_flush)
+    if mode == 'pwrite':
+        return PwriteWriter(filename)
+    raise ValueError('Unknown writer mode: {}'.format(mode))
@@ -0,0 +1,59 @@
+'''创建临时文件时真正分配磁盘空间，并在下载开始前检查磁盘剩余空间是否足够'''
+import errno
+import os
+import shutil
+import threading
+
+
+def preallocate(filename, file_size):
+    '''创建大小为 file_size 的临时文件
+    优先用 os.posix_fallocate() 一次性分配连续的磁盘块，乱序写入各分块时不会产生大量碎片，磁盘空间不足时也会立刻抛出 OSError (ENOSPC)
+    当前平台或文件系统不支持时，退化为创建稀疏文件 (与之前 seek(file_size - 1) 后写入 1 个字节的效果相同)
+    '''
+    with open(filename, 'wb') as fp:
+        if file_size > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fp.fileno(), 0, file_size)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):  # 只有"不支持"才退化，空间不足等错误要抛出
+                    raise
+        fp.truncate(file_size)
+
+
+class DiskSpace:
+    '''多个文件共享的磁盘空间预算
+    第一次用到某个磁盘 (按 st_dev 区分) 时记录它的剩余空间，之后每个文件开始下载前都要从预算中预留自己需要的字节数，
+    所有文件加起来超出剩余空间时，后面的文件会立刻失败，而不是下载了几个 GB 之后才发现磁盘满了
+    '''
+
+    def __init__(self):
+        self._free = {}  # st_dev -> 剩余字节数 (已扣除预留的部分)
+        self._reserved = {}  # st_dev -> 还没有归还的预留字节数
+        self._lock = threading.Lock()
+
+    def reserve(self, filename, size):
+        '''为 filename 预留 size 个字节，预留成功返回 True，空间不足返回 False'''
+        dirname = os.path.dirname(os.path.abspath(filename))
+        dev = os.stat(dirname).st_dev
+        with self._lock:
+            if dev not in self._free:
+                self._free[dev] = shutil.disk_usage(dirname).free
+            if size > self._free[dev]:
+                return False
+            self._free[dev] -= size
+            self._reserved[dev] = self._reserved.get(dev, 0) + size
+            return True
+
+    def release(self, filename, size):
+        '''filename 下载结束 (无论成功与否) 后归还 reserve() 为它预留的 size 个字节
+        这些字节已经被临时文件或正式文件真正占用了，不能加回剩余空间；同一个磁盘上的预留全部归还以后丢弃记录的剩余空间，
+        下次 reserve() 时重新读取，所以长期使用同一个 DiskSpace 时预留不会一直累积
+        '''
+        dirname = os.path.dirname(os.path.abspath(filename))
+        dev = os.stat(dirname).st_dev
+        with self._lock:
+            self._reserved[dev] = self._reserved.get(dev, 0) - size
+            if self._reserved[dev] <= 0:
+                del self._reserved[dev]
+                self._free.pop(dev, None)
@@ -0,0 +1,83 @@
+'''探测结果的磁盘缓存: URL -> 文件大小、ETag、Last-Modified、是否支持 Range 下载
+config.json 中有成千上万个文件、又被 cron 反复执行时，缓存还有效的文件不需要再发探测请求:
+    - 已经下载完成的文件只需要在本地 stat() 比较大小
+    - 需要续传的文件直接请求第一个还没有下载的范围，并带上 If-Range，由服务器确认文件没有变化
+默认不使用缓存，config.json 中设置 probe_cache (缓存文件的路径，例如 CACHE_FILENAME) 时才启用
+'''
+import json
+import os
+import threading
+import time
+from logger import logger
+
+
+CACHE_FILENAME = '.probe_cache.json'  # 建议的缓存文件名 (已加入 .gitignore)
+CACHE_TTL = 24 * 60 * 60  # 缓存的有效期 (秒)
+SAVE_INTERVAL = 5.0  # 有修改时最多每隔多少秒写一次磁盘，程序被 kill -9 时也只会丢失最近几秒的探测结果
+
+
+class ProbeCache:
+    '''多个线程/协程共享的探测结果缓存，put()/invalidate() 最多每隔 SAVE_INTERVAL 秒写一次磁盘，结束时调用 save() 写入剩余的修改'''
+
+    def __init__(self, filename=CACHE_FILENAME, ttl=CACHE_TTL):
+        self.filename = filename
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._last_save = 0.0
+        try:
+            with open(filename, 'r') as fp:
+                self._entries = json.load(fp)
+        except FileNotFoundError:
+            self._entries = {}
+        except (OSError, ValueError) as e:  # 缓存文件损坏时当作没有缓存
+            logger.warning('Ignore the probe cache [%s], the reason is that %s', filename, e)
+            self._entries = {}
+
+    def get(self, url):
+        '''返回 url 还在有效期内的探测结果 {'Size': ..., 'ETag': ..., 'Last-Modified': ..., 'Ranges': True/False}，没有或已过期时返回 None'''
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None or time.time() - entry.get('Time', 0) > self.ttl:
+                return None
+            return entry
+
+    def put(self, url, size, etag, last_modified, ranges):
+        '''记录 url 的探测结果 (重新确认过的结果也要调用，以刷新有效期)'''
+        with self._lock:
+            self._entries[url] = {
+                'Size': size,
+                'ETag': etag,
+                'Last-Modified': last_modified,
+                'Ranges': ranges,
+                'Time': time.time()
+            }
+            self._dirty = True
+        self.save(force=False)
+
+    def invalidate(self, url):
+        '''远程文件已经变化时，删除 url 的探测结果'''
+        with self._lock:
+            if self._entries.pop(url, None) is not None:
+                self._dirty = True
+        self.save(force=False)
+
+    def save(self, force=True):
+        '''先写入临时文件再替换，程序崩溃时不会留下写了一半的缓存文件
+        force 为 False 时，距离上次写入不到 SAVE_INTERVAL 秒就先不写
+        '''
+        with self._lock:
+            now = time.time()
+            if not self._dirty or (not force and now - self._last_save < SAVE_INTERVAL):
+                return
+            entries = {url: entry for url, entry in self._entries.items() if now - entry.get('Time', 0) <= self.ttl}  # 顺便清理过期的结果
+            temp_filename = self.filename + '.tmp'
+            try:
+                with open(temp_filename, 'w') as fp:
+                    json.dump(entries, fp)
+                os.replace(temp_filename, self.filename)
+            except OSError as e:  # 缓存写不进去不影响下载，下次运行时重新探测
+                logger.error('Failed to save the probe cache [%s], the reason is that %s', self.filename, e)
+                return
+            self._dirty = False
+            self._last_save = now
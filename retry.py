@@ -0,0 +1,15 @@
+'''分块下载失败后的重试策略: 带随机抖动的指数退避'''
+import random
+
+
+MAX_ATTEMPTS = 5  # 每个分块最多尝试下载的次数 (包括第一次)
+BACKOFF_BASE = 0.5  # 第一次重试前最多等待的秒数
+BACKOFF_CAP = 30.0  # 最多等待的秒数
+MAX_RESTARTS = 3  # 远程文件在下载过程中变化时，整个文件最多重新开始下载的次数
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    '''返回第 attempt 次 (从 0 开始) 失败后、重试之前需要等待的秒数
+    采用 full jitter: 在 [0, min(cap, base * 2 ** attempt)] 中均匀随机，避免大量分块在同一时刻一起重试
+    '''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,117 @@
+'''所有文件共享的连接预算: 限制总的并发连接数和每个 host 的并发连接数，并在多个文件之间公平分配
+
+之前每个文件各自创建线程池 (8-spider.py) 或 Semaphore(64) (9-spider.py)，总并发数等于文件数乘以每个文件的上限，
+现在所有范围在发出请求之前都要先从同一个预算中申请一个连接名额，用完后归还
+'''
+import asyncio
+from collections import Counter
+import threading
+import time
+
+
+MAX_CONNECTIONS = 32  # 所有文件加起来最多同时打开的连接数
+MAX_CONNECTIONS_PER_HOST = 16  # 同一个 host 最多同时打开的连接数
+
+
+class _Budget:
+    '''线程版与协程版共用的计数和公平策略，调用方负责加锁'''
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_per_host=MAX_CONNECTIONS_PER_HOST, metrics=None):
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.metrics = metrics  # 可选的 Metrics，记录等待名额的时间和每个 host 正在使用的连接数
+        self.active = 0
+        self._host_active = Counter()
+        self._file_active = Counter()
+        self._waiting = Counter()  # 正在等待名额的 (文件, host) -> 等待者的数目 (9-spider.py 中同一个文件的主循环和重试的范围可能同时在等待)
+
+    def _can_grant(self, name, host):
+        if self.active >= self.max_connections or self._host_active[host] >= self.max_per_host:
+            return False
+        # 公平分配: 如果其它正在等待 (且它的 host 还有名额) 的文件占用的连接更少，让它先拿
+        mine = self._file_active[name]
+        for other, other_host in self._waiting:
+            if other != name and self._file_active[other] < mine and self._host_active[other_host] < self.max_per_host:
+                return False
+        return True
+
+    def _grant(self, name, host, t0):
+        self.active += 1
+        self._host_active[host] += 1
+        self._file_active[name] += 1
+        if self.metrics is not None:
+            self.metrics.observe('connection_wait_seconds', time.perf_counter() - t0, host=host)
+            self.metrics.set('inflight_connections', self._host_active[host], host=host)
+
+    def _release(self, name, host):
+        self.active -= 1
+        self._host_active[host] -= 1
+        self._file_active[name] -= 1
+        if not self._file_active[name]:
+            del self._file_active[name]
+        if self.metrics is not None:
+            self.metrics.set('inflight_connections', self._host_active[host], host=host)
+
+    def _wait(self, name, host):
+        self._waiting[name, host] += 1
+
+    def _unwait(self, name, host):
+        self._waiting[name, host] -= 1
+        if not self._waiting[name, host]:
+            del self._waiting[name, host]
+
+    def file_active(self, name):
+        '''name 这个文件当前占用的连接数'''
+        return self._file_active[name]
+
+
+class ConnectionBudget(_Budget):
+    '''多线程版本 (8-spider.py)'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cond = threading.Condition()
+
+    def acquire(self, name, host, timeout=None):
+        '''为文件 name (位于 host) 申请一个连接名额，成功返回 True，超时返回 False'''
+        t0 = time.perf_counter()
+        with self._cond:
+            self._wait(name, host)
+            try:
+                if not self._cond.wait_for(lambda: self._can_grant(name, host), timeout):
+                    return False
+                self._grant(name, host, t0)
+                return True
+            finally:
+                self._unwait(name, host)
+                self._cond.notify_all()  # 等待队列变了，其它文件可能可以拿到名额了
+
+    def release(self, name, host):
+        with self._cond:
+            self._release(name, host)
+            self._cond.notify_all()
+
+
+class AsyncConnectionBudget(_Budget):
+    '''协程版本 (9-spider.py)，必须在事件循环中创建和使用'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, name, host):
+        '''为文件 name (位于 host) 申请一个连接名额'''
+        t0 = time.perf_counter()
+        async with self._cond:
+            self._wait(name, host)
+            try:
+                await self._cond.wait_for(lambda: self._can_grant(name, host))
+                self._grant(name, host, t0)
+            finally:
+                self._unwait(name, host)
+                self._cond.notify_all()
+
+    async def release(self, name, host):
+        async with self._cond:
+            self._release(name, host)
+            self._cond.notify_all()
@@ -0,0 +1,151 @@
+'''自适应地划分下载范围: 根据测得的吞吐量和 RTT 决定每次请求多少字节，不再固定使用 multipart_chunksize
+没有未分配的字节时，空闲的 worker 会把正在下载的最大范围的后半部分拆走 (work stealing)，消除长尾
+'''
+import threading
+
+
+MIN_CHUNKSIZE = 1024 * 1024  # 每个范围最少 1 MB，太小的话请求次数过多
+MAX_CHUNKSIZE = 64 * 1024 * 1024  # 每个范围最多 64 MB，太大的话最后几个范围会拖慢整个文件
+TARGET_SECONDS = 2.0  # 希望每个范围大约用多少秒下载完
+RTT_FACTOR = 10  # 范围至少要能传输 RTT_FACTOR 个 RTT，使每次请求的往返开销不超过约 1/RTT_FACTOR
+ALIGN = 64 * 1024  # 范围大小按 64 KB 对齐
+EWMA_ALPHA = 0.3  # 指数加权移动平均的系数，越大越看重最近的测量值
+
+
+class Segment:
+    '''一个正在下载的范围 [start, stop]，pos 是下一个要写入的字节的位置
+    stop 可能被 AdaptiveSplitter 缩小 (后半部分被其它 worker 拆走)，所以下载时要通过 AdaptiveSplitter.claim() 确认哪些字节仍属于自己
+    '''
+
+    __slots__ = ('start', 'stop', 'pos')
+
+    def __init__(self, start, stop):
+        self.start = start
+        self.stop = stop
+        self.pos = start
+
+    def __repr__(self):
+        return 'Segment({}, {}, pos={})'.format(self.start, self.stop, self.pos)
+
+
+class AdaptiveSplitter:
+    '''从还没有下载的字节范围 (holes) 中按需切出下一个要下载的范围 [start, stop]
+    每个范围下载完成后调用 record() 汇报耗时，后续切出的范围大小会随之调整:
+    - 单个连接的吞吐量越大，范围越大，让每个请求大约持续 TARGET_SECONDS 秒
+    - RTT 越大，范围也越大，摊薄建立请求的往返开销
+    - 剩余字节不多时，把剩余部分平均分给所有 workers，避免最后只剩一个大范围在下载 (长尾)
+    - 所有字节都分配出去以后，next_range() 会把正在下载的、剩余字节最多的范围一分为二，后半部分交给空闲的 worker 并行下载
+    '''
+
+    def __init__(self, holes, initial_size, workers, min_size=MIN_CHUNKSIZE, max_size=MAX_CHUNKSIZE, steal=True):
+        self._holes = sorted(holes, reverse=True)  # 倒序存放，从列表末尾 pop() 即是偏移最小的范围
+        self._active = set()  # 正在下载的 Segment
+        self._lock = threading.Lock()
+        self.workers = max(1, workers)
+        self.min_size = min(min_size, initial_size)
+        self.max_size = max(max_size, initial_size)
+        self.part_size = initial_size  # 还没有测量值时，使用 multipart_chunksize 作为初始大小
+        self.throughput = None  # 单个连接的吞吐量 (字节/秒)
+        self.rtt = None  # 首字节时间 (秒)，近似为 RTT
+        self.aborted = False  # 是否已经放弃剩下的所有字节
+        self.steal = steal  # 是否拆分正在下载的范围，为 False 时每个范围都完整地下载到它的 stop
+
+    @property
+    def remaining(self):
+        '''还没有分配出去的字节数'''
+        return sum(stop - start + 1 for start, stop in self._holes)
+
+    def next_range(self):
+        '''切出下一个要下载的范围，返回 Segment；没有可以分配或拆分的字节时返回 None'''
+        with self._lock:
+            if not self._holes:
+                return self._steal()
+            size = self._size()
+            start, stop = self._holes.pop()
+            if stop - start + 1 > size:
+                self._holes.append((start + size, stop))  # 剩下的部分放回去，下次继续切
+                stop = start + size - 1
+            return self._track(start, stop)
+
+    def has_work(self):
+        '''还有没分配出去的字节，或者有值得拆分的范围时返回 True，此时调用 next_range() 才有意义'''
+        with self._lock:
+            return bool(self._holes) or self.steal and any(segment.stop - segment.pos + 1 >= 2 * self.min_size for segment in self._active)
+
+    def track(self, start, stop):
+        '''登记一个不是由 next_range() 切出的范围 (例如重试剩余的字节)，返回 Segment'''
+        with self._lock:
+            return self._track(start, stop)
+
+    def _track(self, start, stop):
+        segment = Segment(start, stop)
+        self._active.add(segment)
+        return segment
+
+    def _steal(self):
+        '''把剩余字节最多的 Segment 一分为二，后半部分作为新的 Segment 返回'''
+        if not self.steal:
+            return None
+        victim = max(self._active, key=lambda segment: segment.stop - segment.pos, default=None)
+        if victim is None:
+            return None
+        left = victim.stop - victim.pos + 1
+        if left < 2 * self.min_size:  # 剩下的太少了，再发一个请求并不划算
+            return None
+        middle = victim.pos + left // 2
+        if middle - middle % ALIGN > victim.pos:
+            middle -= middle % ALIGN
+        segment = self._track(middle, victim.stop)
+        victim.stop = middle - 1  # 原来的 worker 只需要下载到这里
+        return segment
+
+    def claim(self, segment, n):
+        '''下载 segment 的 worker 收到了 n 个字节，返回 (offset, count): 应该写入的位置，以及其中仍属于 segment 的字节数
+        与 _steal() 用同一把锁，保证被拆走的后半部分不会被原来的 worker 写入
+        '''
+        with self._lock:
+            offset = segment.pos
+            count = min(n, segment.stop - segment.pos + 1)
+            segment.pos += count
+            return offset, count
+
+    def unclaim(self, segment, offset):
+        '''claim() 分给 segment 的、从 offset 开始的字节没有写入临时文件 (例如写入时出错)，把 segment.pos 退回到 offset
+        之后记录到配置文件中的只有真正写入的字节，剩下的字节 (包括这些) 由重试重新下载；被拆走的后半部分都在 segment.pos 之后，不受影响
+        '''
+        with self._lock:
+            if offset < segment.pos:
+                segment.pos = offset
+
+    def abort(self):
+        '''放弃剩下的所有字节 (例如远程文件已经变化)，不再切出新的范围，正在下载的范围在下一次 claim() 时就会结束'''
+        with self._lock:
+            self.aborted = True
+            self._holes = []
+            for segment in self._active:
+                segment.stop = segment.pos - 1
+
+    def done(self, segment):
+        '''segment 结束下载 (无论成功与否)，不再参与拆分'''
+        with self._lock:
+            self._active.discard(segment)
+
+    def _size(self):
+        size = self.part_size
+        # 剩余的字节平均分给所有 workers，让最后一批范围差不多同时下载完
+        share = -(-self.remaining // self.workers)  # 向上取整
+        if share < size:
+            size = max(self.min_size, share)
+        return max(ALIGN, size - size % ALIGN)
+
+    def record(self, size, elapsed, ttfb):
+        '''汇报一个范围的下载情况: size 字节，总耗时 elapsed 秒，其中首字节时间 ttfb 秒'''
+        transfer = elapsed - ttfb
+        if size <= 0 or transfer <= 0:
+            return
+        with self._lock:
+            throughput = size / transfer
+            self.throughput = throughput if self.throughput is None else EWMA_ALPHA * throughput + (1 - EWMA_ALPHA) * self.throughput
+            self.rtt = ttfb if self.rtt is None else EWMA_ALPHA * ttfb + (1 - EWMA_ALPHA) * self.rtt
+            size = max(self.throughput * TARGET_SECONDS, self.throughput * self.rtt * RTT_FACTOR)
+            self.part_size = int(min(self.max_size, max(self.min_size, size)))
@@ -0,0 +1,135 @@
+'''用令牌桶限制下载带宽: 一个所有文件共享的全局限速，每个文件还可以有自己的限速
+每个线程/协程读取一个 chunk 后先从令牌桶中取走同样多的令牌，令牌不够时等待，读取变慢后 TCP 接收窗口会让服务器也放慢发送速度
+'''
+import asyncio
+import json
+import threading
+import time
+from logger import logger
+
+
+BURST_SECONDS = 1.0  # 令牌桶的容量: 空闲之后最多允许突发多少秒的流量
+MIN_BURST = 256 * 1024  # 令牌桶的最小容量，至少能放下几个 chunk
+_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_rate(value):
+    '''把限速的配置值转换为 字节/秒，支持 K、M、G 后缀 (例如 "512K"、"10M")，None、0 或空字符串表示不限速'''
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.strip().upper().rstrip('B')  # 允许写成 10MB
+        if not value:
+            return None
+        if value[-1] in _UNITS:
+            value = float(value[:-1]) * _UNITS[value[-1]]
+    rate = int(float(value))
+    if rate < 0:
+        raise ValueError('Invalid rate limit: {}'.format(value))
+    return rate or None
+
+
+def load_rate_limits(cfg):
+    '''从 config.json 的内容中读取限速，返回 (全局限速, {url: 此文件的限速})
+    全局限速为顶层的 rate_limit，每个文件的限速为 files 中各项的 rate_limit，都是可选的
+    '''
+    return parse_rate(cfg.get('rate_limit')), {f['url']: parse_rate(f.get('rate_limit')) for f in cfg['files']}
+
+
+def reload_rate_limits(limiter, config, rate_limit=None):
+    '''重新读取配置文件 config 中的限速并应用到 limiter 上，rate_limit 为命令行指定的全局限速，它优先于配置文件'''
+    try:
+        with open(config, 'r') as fp:
+            rate, file_rates = load_rate_limits(json.load(fp))
+    except (OSError, ValueError, KeyError) as e:  # 配置文件有误时保持原来的限速
+        logger.error('Failed to reload rate limits from [%s], the reason is that %s', config, e)
+        return
+    if rate_limit is not None:
+        rate = parse_rate(rate_limit)
+    limiter.update(rate, file_rates)
+    logger.info('Rate limits reloaded, global: %s', '{} bytes/s'.format(rate) if rate else 'unlimited')
+
+
+class TokenBucket:
+    '''线程安全的令牌桶，rate 为每秒补充的令牌数 (字节/秒)，None 表示不限速
+    取令牌时不够也先取走 (令牌数变为负数，相当于欠账)，调用方按欠账的多少等待相应的时间，
+    这样每次只需加锁计算一下，等待时不占用锁，线程和协程都可以使用
+    '''
+
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self.rate = None
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        '''修改限速，下载过程中随时可以调用'''
+        with self._lock:
+            was_limited = self.rate is not None
+            self._refill()
+            self.rate = rate or None
+            self.burst = burst or max(MIN_BURST, (rate or 0) * BURST_SECONDS)
+            self._tokens = min(self._tokens, self.burst) if was_limited else self.burst
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self, n):
+        '''取走 n 个令牌，返回调用方还需要等待的秒数'''
+        with self._lock:
+            if self.rate is None:
+                return 0.0
+            self._refill()
+            self._tokens -= n
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+class FileThrottle:
+    '''一个文件的所有范围共用的限速器，依次经过此文件自己的令牌桶和全局的令牌桶
+    先等待文件自己的令牌桶，再从全局令牌桶中取令牌，所以被单独限速的文件不会提前占用全局带宽，没有单独限速的文件可以用掉剩余的全部带宽
+    '''
+
+    def __init__(self, global_bucket, file_bucket):
+        self.global_bucket = global_bucket
+        self.file_bucket = file_bucket
+
+    def consume(self, n):
+        '''线程版本: 取走 n 个字节的令牌，不够时 sleep'''
+        for bucket in (self.file_bucket, self.global_bucket):
+            delay = bucket.reserve(n)
+            if delay > 0:
+                time.sleep(delay)
+
+    async def consume_async(self, n):
+        '''协程版本: 取走 n 个字节的令牌，不够时 asyncio.sleep()，不阻塞事件循环'''
+        for bucket in (self.file_bucket, self.global_bucket):
+            delay = bucket.reserve(n)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+
+class BandwidthLimiter:
+    '''管理全局令牌桶和每个文件的令牌桶，update() 可以在运行时修改所有限速 (例如收到 SIGHUP 时重新读取 config.json)'''
+
+    def __init__(self, rate=None):
+        self.bucket = TokenBucket(rate)
+        self._files = {}  # 文件的 key (URL) -> TokenBucket
+        self._lock = threading.Lock()
+
+    def for_file(self, key, rate=None):
+        '''返回 key 这个文件使用的 FileThrottle，rate 为此文件自己的限速'''
+        with self._lock:
+            if key not in self._files:
+                self._files[key] = TokenBucket(rate)
+            return FileThrottle(self.bucket, self._files[key])
+
+    def update(self, rate, file_rates):
+        '''修改全局限速为 rate，file_rates 为 {key: 限速}，不在 file_rates 中的文件不再单独限速'''
+        self.bucket.set_rate(rate)
+        with self._lock:
+            for key, bucket in self._files.items():
+                bucket.set_rate(file_rates.get(key))